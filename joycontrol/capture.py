@@ -0,0 +1,646 @@
+import bisect
+import collections
+import enum
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+from joycontrol.controller import Controller
+
+logger = logging.getLogger(__name__)
+
+"""
+Capture files of the communication between controller and console.
+
+Version 2 capture format, all values little endian:
+
+    file header     magic b'JCCAP\\x00', version (u8), controller (u8, 0 if unknown), adapter address (6 bytes),
+                    start wall time (i64, ns since epoch), start monotonic time (i64, ns)
+    blocks          block header: magic b'JCBK', compressed size (u32), uncompressed size (u32),
+                                  record count (u32), timestamp of the first record (i64)
+                    zlib compressed block data: one record header per record (timestamp (i64, monotonic ns),
+                                  size (u16), direction (u8)) followed by the data of all records
+    block index     one entry per block: file offset (u64), number of the first record (u64),
+                                  timestamp of the first record (i64), record count (u32)
+    footer          file offset of the block index (u64), block count (u32), magic b'JCIX'
+
+The block index allows seeking to a record number or time with a binary search. If it is missing, e.g. because
+the capture was not closed properly, the blocks are scanned instead.
+
+Version 1 capture files are a plain sequence of records: capture time (double, time.time()), size (int), data.
+"""
+
+CAPTURE_VERSION = 2
+
+_FILE_MAGIC = b'JCCAP\x00'
+_FILE_HEADER = struct.Struct('<6sBB6sqq')
+_BLOCK_MAGIC = b'JCBK'
+_BLOCK_HEADER = struct.Struct('<4sIIIq')
+_RECORD_HEADER = struct.Struct('<qHB')
+_INDEX_ENTRY = struct.Struct('<QQqI')
+_INDEX_MAGIC = b'JCIX'
+_FOOTER = struct.Struct('<QI4s')
+
+# Record header of version 1 captures: capture time (time.time()), size of the data
+_V1_RECORD_HEADER = struct.Struct('di')
+
+
+class Direction(enum.IntEnum):
+    # input reports, send by the controller
+    SENT = 0
+    # output reports, received from the console
+    RECEIVED = 1
+
+
+CaptureRecord = collections.namedtuple('CaptureRecord', ['timestamp', 'direction', 'data'])
+CaptureRecord.__doc__ = """
+Captured report.
+timestamp: time of capture in ns
+direction: Direction of the report
+data: report bytes
+"""
+
+_BlockIndexEntry = collections.namedtuple('_BlockIndexEntry', ['offset', 'first_record', 'first_timestamp',
+                                                               'record_count'])
+
+
+def _address_to_bytes(address):
+    if not address:
+        return bytes(6)
+    return bytes(int(part, 16) for part in address.split(':'))
+
+
+def _bytes_to_address(_bytes):
+    return ':'.join(f'{byte:02X}' for byte in _bytes)
+
+
+class CaptureWriter:
+    """
+    Writes captured reports to a version 2 capture file without blocking the caller.
+
+    Records are appended to a bounded in-memory buffer and written to the file in compressed blocks by a background
+    thread. If the buffer is full because the file can not be written fast enough, new records are dropped and counted
+    instead of blocking the caller.
+    """
+    def __init__(self, file, controller: Controller = None, address=None, max_pending=4096, flush_interval=0.5,
+                 block_records=1024, block_interval=5.0):
+        """
+        :param file: file opened for binary writing
+        :param controller: emulated controller, stored in the file header
+        :param address: Bluetooth address of the adapter in string notation, stored in the file header
+        :param max_pending: maximum number of records buffered in memory
+        :param flush_interval: time in seconds between two runs of the background thread
+        :param block_records: maximum number of records per block
+        :param block_interval: maximum time in seconds between the first record of a block and writing the block
+        """
+        self._file = file
+        self._max_pending = max_pending
+        self._flush_interval = flush_interval
+        self._block_records = block_records
+        self._block_interval_ns = int(block_interval * 1e9)
+
+        self._pending = collections.deque()
+        self._wakeup = threading.Event()
+        self._closed = False
+
+        # block currently assembled by the background thread
+        self._block_headers = bytearray()
+        self._block_data = []
+        self._block_count = 0
+        self._block_first_timestamp = None
+
+        self._index = []
+        self._record_count = 0
+
+        # statistics
+        self.written_records = 0
+        self.dropped_records = 0
+
+        header = _FILE_HEADER.pack(_FILE_MAGIC, CAPTURE_VERSION, controller.value if controller is not None else 0,
+                                   _address_to_bytes(address), time.time_ns(), time.monotonic_ns())
+        self._file.write(header)
+        self._offset = self._file.tell()
+
+        self._thread = threading.Thread(target=self._run, name='CaptureWriter', daemon=True)
+        self._thread.start()
+
+    def write(self, data, direction: Direction, timestamp=None):
+        """
+        Queues a record for writing. Never blocks.
+
+        :param data: captured report, copied since it might be a reused buffer
+        :param direction: Direction of the report
+        :param timestamp: capture time in ns, defaults to time.monotonic_ns()
+        :returns False if the record was dropped because too many records are pending
+        """
+        if self._closed:
+            raise ValueError('Capture writer is closed.')
+
+        pending = self._pending
+        if len(pending) >= self._max_pending:
+            self.dropped_records += 1
+            return False
+
+        pending.append((time.monotonic_ns() if timestamp is None else timestamp, direction, bytes(data)))
+
+        # write early if the buffer fills up
+        if len(pending) == self._max_pending // 2:
+            self._wakeup.set()
+        return True
+
+    def _run(self):
+        while not self._closed:
+            self._wakeup.wait(self._flush_interval)
+            self._wakeup.clear()
+            self._collect()
+        # write records queued before closing
+        self._collect()
+        self._write_block()
+        self._write_index()
+
+    def _collect(self):
+        """
+        Moves pending records into the current block and writes the block if it is full or old enough.
+        """
+        pending = self._pending
+        while pending:
+            timestamp, direction, data = pending.popleft()
+            if self._block_first_timestamp is None:
+                self._block_first_timestamp = timestamp
+            self._block_headers += _RECORD_HEADER.pack(timestamp, len(data), direction)
+            self._block_data.append(data)
+            self._block_count += 1
+
+            if self._block_count >= self._block_records:
+                self._write_block()
+
+        if self._block_count and time.monotonic_ns() - self._block_first_timestamp >= self._block_interval_ns:
+            self._write_block()
+
+    def _write_block(self):
+        if not self._block_count:
+            return
+
+        raw = bytes(self._block_headers) + b''.join(self._block_data)
+        compressed = zlib.compress(raw)
+        header = _BLOCK_HEADER.pack(_BLOCK_MAGIC, len(compressed), len(raw), self._block_count,
+                                    self._block_first_timestamp)
+        count = self._block_count
+
+        self._block_headers = bytearray()
+        self._block_data = []
+        self._block_count = 0
+        first_timestamp = self._block_first_timestamp
+        self._block_first_timestamp = None
+
+        try:
+            self._file.write(header + compressed)
+            self._file.flush()
+        except (OSError, ValueError) as err:
+            logger.error(f'Failed to write {count} capture records - {err}')
+            self.dropped_records += count
+            return
+
+        self._index.append(_BlockIndexEntry(self._offset, self._record_count, first_timestamp, count))
+        self._offset += len(header) + len(compressed)
+        self._record_count += count
+        self.written_records += count
+
+    def _write_index(self):
+        chunks = [_INDEX_ENTRY.pack(*entry) for entry in self._index]
+        chunks.append(_FOOTER.pack(self._offset, len(self._index), _INDEX_MAGIC))
+        try:
+            self._file.write(b''.join(chunks))
+            self._file.flush()
+        except (OSError, ValueError) as err:
+            logger.error(f'Failed to write capture index - {err}')
+
+    def close(self):
+        """
+        Writes all pending records and the block index and stops the background thread. Does not close the file.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        self._wakeup.set()
+        self._thread.join()
+
+        if self.dropped_records:
+            logger.warning(f'Dropped {self.dropped_records} capture records.')
+
+
+class CaptureReader:
+    """
+    Streaming reader for version 2 and version 1 capture files.
+
+    The file is memory mapped, records are decoded lazily by generators, so memory usage does not depend on the size
+    of the capture. Version 2 captures support seeking to a record number or time in O(log n) blocks. Version 1
+    captures have no index, they are scanned from the start and the direction of their records is derived from the
+    first byte (0xA1 input report, 0xA2 output report).
+    """
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        self._file_size = os.fstat(self._file.fileno()).st_size
+        # empty files can not be mapped
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if self._file_size else b''
+
+        self.version = 1
+        self.controller = None
+        self.address = None
+        self.start_wall_time = None
+        self.start_timestamp = None
+
+        self._index = []
+
+        if self._file_size >= _FILE_HEADER.size and self._map[:len(_FILE_MAGIC)] == _FILE_MAGIC:
+            magic, self.version, controller, address, self.start_wall_time, self.start_timestamp = \
+                _FILE_HEADER.unpack_from(self._map)
+            if self.version != CAPTURE_VERSION:
+                raise ValueError(f'Unsupported capture version {self.version}.')
+            self.controller = Controller(controller) if controller else None
+            self.address = _bytes_to_address(address)
+            self._index = self._read_index()
+        # bisect keys of the block index
+        self._first_records = [entry.first_record for entry in self._index]
+        self._first_timestamps = [entry.first_timestamp for entry in self._index]
+
+    def _read_index(self):
+        """
+        Reads the block index from the end of the file, scans the blocks if there is none.
+        """
+        if self._file_size >= _FILE_HEADER.size + _FOOTER.size:
+            index_offset, block_count, magic = _FOOTER.unpack_from(self._map, self._file_size - _FOOTER.size)
+            if magic == _INDEX_MAGIC and \
+                    index_offset + block_count * _INDEX_ENTRY.size + _FOOTER.size == self._file_size:
+                data = self._map[index_offset:index_offset + block_count * _INDEX_ENTRY.size]
+                return [_BlockIndexEntry(*entry) for entry in _INDEX_ENTRY.iter_unpack(data)]
+
+        logger.warning('Capture has no block index, scanning blocks.')
+        index = []
+        offset = _FILE_HEADER.size
+        record_count = 0
+        while offset + _BLOCK_HEADER.size <= self._file_size:
+            magic, compressed_size, _, count, first_timestamp = _BLOCK_HEADER.unpack_from(self._map, offset)
+            if magic != _BLOCK_MAGIC or offset + _BLOCK_HEADER.size + compressed_size > self._file_size:
+                break
+            index.append(_BlockIndexEntry(offset, record_count, first_timestamp, count))
+            offset += _BLOCK_HEADER.size + compressed_size
+            record_count += count
+        return index
+
+    def _read_block(self, entry):
+        """
+        :returns decompressed block data and the number of records in the block
+        """
+        magic, compressed_size, raw_size, count, _ = _BLOCK_HEADER.unpack_from(self._map, entry.offset)
+        if magic != _BLOCK_MAGIC:
+            raise ValueError(f'No capture block at offset {entry.offset}.')
+        start = entry.offset + _BLOCK_HEADER.size
+        raw = zlib.decompress(self._map[start:start + compressed_size])
+        if len(raw) != raw_size:
+            raise ValueError(f'Corrupted capture block at offset {entry.offset}.')
+        return raw, count
+
+    def _block_records(self, entry, skip=0):
+        raw, count = self._read_block(entry)
+        data_offset = count * _RECORD_HEADER.size
+        for i, (timestamp, size, direction) in enumerate(_RECORD_HEADER.iter_unpack(raw[:data_offset])):
+            if i >= skip:
+                yield CaptureRecord(timestamp, Direction(direction), raw[data_offset:data_offset + size])
+            data_offset += size
+
+    def _v1_records(self):
+        _map = self._map
+        offset = 0
+        while offset + _V1_RECORD_HEADER.size <= self._file_size:
+            timestamp, size = _V1_RECORD_HEADER.unpack_from(_map, offset)
+            offset += _V1_RECORD_HEADER.size
+            if offset + size > self._file_size:
+                return
+            data = _map[offset:offset + size]
+            offset += size
+            if not data:
+                # no direction can be derived from empty records
+                continue
+            if data[0] == 0xA1:
+                direction = Direction.SENT
+            elif data[0] == 0xA2:
+                direction = Direction.RECEIVED
+            else:
+                raise ValueError('Unexpected data.')
+            yield CaptureRecord(int(timestamp * 1e9), direction, data)
+
+    def blocks(self):
+        """
+        Decompresses the blocks of a version 2 capture one after another.
+
+        :returns iterator over (block data, record count) tuples. The block data starts with the record headers
+                 followed by the data of all records.
+        """
+        if self.version == 1:
+            raise ValueError('Version 1 captures have no blocks.')
+        for entry in self._index:
+            yield self._read_block(entry)
+
+    def records(self, start=0):
+        """
+        :param start: number of the first record
+        :returns iterator over the records of the capture
+        """
+        if self.version == 1:
+            for i, record in enumerate(self._v1_records()):
+                if i >= start:
+                    yield record
+            return
+
+        i = max(0, bisect.bisect_right(self._first_records, start) - 1)
+        for entry in self._index[i:]:
+            yield from self._block_records(entry, skip=max(0, start - entry.first_record))
+
+    def records_since(self, timestamp):
+        """
+        :param timestamp: capture time in ns
+        :returns iterator over the records captured at or after the given time
+        """
+        if self.version == 1:
+            for record in self._v1_records():
+                if record.timestamp >= timestamp:
+                    yield record
+            return
+
+        i = max(0, bisect.bisect_right(self._first_timestamps, timestamp) - 1)
+        for entry in self._index[i:]:
+            for record in self._block_records(entry):
+                if record.timestamp >= timestamp:
+                    yield record
+
+    def get_wall_time(self, timestamp):
+        """
+        :param timestamp: capture time of a record in ns
+        :returns corresponding time since epoch in seconds
+        """
+        if self.version == 1:
+            return timestamp / 1e9
+        return (self.start_wall_time + timestamp - self.start_timestamp) / 1e9
+
+    def __len__(self):
+        if self.version == 1:
+            return sum(1 for _ in self._v1_records())
+        return sum(entry.record_count for entry in self._index)
+
+    def __iter__(self):
+        return self.records()
+
+    def close(self):
+        if isinstance(self._map, mmap.mmap):
+            self._map.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+# Bulk analysis using NumPy (optional dependency, install with "pip install joycontrol[analysis]").
+# Records are decoded block by block into structured arrays holding the fixed-offset fields of the reports, all
+# statistics are updated per block so memory usage is bounded by the block size.
+
+# Fields of the structured arrays returned by iter_field_blocks and load_fields.
+# Fields a report is too short for are 0. sub_command is the sub command id of 0x01 output reports and of 0x21 input
+# reports (sub command replies), 0 otherwise.
+FIELD_DTYPE = [
+    ('timestamp', '<i8'),
+    ('direction', 'u1'),
+    ('size', '<u2'),
+    ('report_id', 'u1'),
+    ('timer', 'u1'),
+    ('buttons', 'u1', (3,)),
+    ('left_stick', 'u1', (3,)),
+    ('right_stick', 'u1', (3,)),
+    ('sub_command', 'u1'),
+]
+
+# Number of leading report bytes extracted per record
+_FIELD_WINDOW = 16
+
+# Number of records decoded at once from version 1 captures
+V1_BATCH_SIZE = 4096
+
+# Default bin edges of the inter-arrival histogram in milliseconds, inter-arrival times above the last edge are counted
+# in the last bin
+JITTER_BIN_EDGES_MS = tuple(range(0, 51))
+
+
+def _import_numpy():
+    try:
+        import numpy
+    except ImportError as err:
+        raise ImportError('Capture analysis requires NumPy, install it using "pip install joycontrol[analysis]".') \
+            from err
+    return numpy
+
+
+def _fields_from_arrays(np, timestamps, directions, sizes, data):
+    """
+    :param timestamps, directions, sizes: per record arrays
+    :param data: uint8 array containing the data of all records back to back
+    :returns structured array of FIELD_DTYPE
+    """
+    count = len(sizes)
+    fields = np.zeros(count, dtype=FIELD_DTYPE)
+    if not count:
+        return fields
+
+    sizes = sizes.astype(np.int64)
+    offsets = np.cumsum(sizes) - sizes
+
+    # leading bytes of every record, bytes past the end of a record are 0
+    if len(data):
+        positions = offsets[:, None] + np.arange(_FIELD_WINDOW)
+        in_record = np.arange(_FIELD_WINDOW) < sizes[:, None]
+        window = np.where(in_record, data[np.minimum(positions, len(data) - 1)], 0).astype(np.uint8)
+    else:
+        # all records are empty
+        window = np.zeros((count, _FIELD_WINDOW), dtype=np.uint8)
+
+    fields['timestamp'] = timestamps
+    fields['direction'] = directions
+    fields['size'] = sizes
+    fields['report_id'] = window[:, 1]
+    fields['timer'] = window[:, 2]
+    fields['buttons'] = window[:, 4:7]
+    fields['left_stick'] = window[:, 7:10]
+    fields['right_stick'] = window[:, 10:13]
+
+    received = directions == Direction.RECEIVED
+    sub_command_requests = received & (window[:, 1] == 0x01)
+    sub_command_replies = ~received & (window[:, 1] == 0x21)
+    fields['sub_command'][sub_command_requests] = window[sub_command_requests, 11]
+    fields['sub_command'][sub_command_replies] = window[sub_command_replies, 15]
+    return fields
+
+
+def _fields_from_block(np, raw, count):
+    headers = np.frombuffer(raw, dtype=[('timestamp', '<i8'), ('size', '<u2'), ('direction', 'u1')], count=count)
+    data = np.frombuffer(raw, dtype=np.uint8, offset=count * _RECORD_HEADER.size)
+    return _fields_from_arrays(np, headers['timestamp'], headers['direction'], headers['size'], data)
+
+
+def _fields_from_records(np, records):
+    timestamps = np.fromiter((record.timestamp for record in records), dtype=np.int64, count=len(records))
+    directions = np.fromiter((record.direction for record in records), dtype=np.uint8, count=len(records))
+    sizes = np.fromiter((len(record.data) for record in records), dtype=np.uint16, count=len(records))
+    data = np.frombuffer(b''.join(record.data for record in records), dtype=np.uint8)
+    return _fields_from_arrays(np, timestamps, directions, sizes, data)
+
+
+def iter_field_blocks(reader: CaptureReader):
+    """
+    Decodes the fixed-offset fields of all records, one block at a time.
+
+    :param reader: CaptureReader of the capture
+    :returns iterator over NumPy structured arrays of FIELD_DTYPE
+    """
+    np = _import_numpy()
+
+    if reader.version == 1:
+        batch = []
+        for record in reader.records():
+            batch.append(record)
+            if len(batch) == V1_BATCH_SIZE:
+                yield _fields_from_records(np, batch)
+                batch = []
+        if batch:
+            yield _fields_from_records(np, batch)
+    else:
+        for raw, count in reader.blocks():
+            yield _fields_from_block(np, raw, count)
+
+
+def load_fields(reader: CaptureReader, direction: Direction = None):
+    """
+    Loads the fixed-offset fields of all records into one structured array.
+
+    :param reader: CaptureReader of the capture
+    :param direction: only load records of this Direction, None to load all records
+    :returns NumPy structured array of FIELD_DTYPE
+    """
+    np = _import_numpy()
+
+    blocks = []
+    for fields in iter_field_blocks(reader):
+        if direction is not None:
+            fields = fields[fields['direction'] == direction]
+        blocks.append(fields)
+    if not blocks:
+        return np.zeros(0, dtype=FIELD_DTYPE)
+    return np.concatenate(blocks)
+
+
+class CaptureStatistics:
+    """
+    Summary statistics of a capture, updated incrementally with structured arrays of FIELD_DTYPE.
+    """
+    def __init__(self, jitter_bin_edges_ms=JITTER_BIN_EDGES_MS):
+        """
+        :param jitter_bin_edges_ms: bin edges of the input report inter-arrival histogram in milliseconds
+        """
+        np = _import_numpy()
+
+        self.input_reports = 0
+        self.output_reports = 0
+        self.first_timestamp = None
+        self.last_timestamp = None
+
+        # counts indexed by input report id
+        self.input_report_ids = np.zeros(0x100, dtype=np.int64)
+        # counts indexed by sub command id of received sub command requests
+        self.sub_commands = np.zeros(0x100, dtype=np.int64)
+
+        # input report inter-arrival histogram
+        self.jitter_bin_edges_ms = np.asarray(jitter_bin_edges_ms, dtype=np.float64)
+        self.jitter_histogram = np.zeros(len(self.jitter_bin_edges_ms) - 1, dtype=np.int64)
+
+        # number of input report timer values missing in the capture
+        self.dropped_timer_values = 0
+
+        # last sent input report of the previous update, to continue across blocks
+        self._last_input_timestamp = None
+        self._last_timer = None
+
+    def update(self, fields):
+        """
+        :param fields: structured array of FIELD_DTYPE containing the next records of the capture
+        """
+        np = _import_numpy()
+
+        if not len(fields):
+            return
+
+        if self.first_timestamp is None:
+            self.first_timestamp = int(fields['timestamp'][0])
+        self.last_timestamp = int(fields['timestamp'][-1])
+
+        sent = fields[fields['direction'] == Direction.SENT]
+        received = fields[fields['direction'] == Direction.RECEIVED]
+        self.input_reports += len(sent)
+        self.output_reports += len(received)
+
+        self.input_report_ids += np.bincount(sent['report_id'], minlength=0x100)
+        requests = received[received['report_id'] == 0x01]
+        self.sub_commands += np.bincount(requests['sub_command'], minlength=0x100)
+
+        if not len(sent):
+            return
+
+        timestamps = sent['timestamp']
+        timers = sent['timer'].astype(np.int64)
+        if self._last_input_timestamp is not None:
+            timestamps = np.concatenate(([self._last_input_timestamp], timestamps))
+            timers = np.concatenate(([self._last_timer], timers))
+        self._last_input_timestamp = int(sent['timestamp'][-1])
+        self._last_timer = int(sent['timer'][-1])
+
+        inter_arrival_ms = np.diff(timestamps) / 1e6
+        # count values above the last edge in the last bin
+        inter_arrival_ms = np.minimum(inter_arrival_ms, self.jitter_bin_edges_ms[-1])
+        self.jitter_histogram += np.histogram(inter_arrival_ms, bins=self.jitter_bin_edges_ms)[0]
+
+        # the timer is incremented by one for every input report
+        steps = np.diff(timers) % 0x100
+        self.dropped_timer_values += int(np.sum(steps[steps > 1] - 1))
+
+    def get_duration(self):
+        """
+        :returns time between the first and the last record in seconds
+        """
+        if self.first_timestamp is None:
+            return 0.0
+        return (self.last_timestamp - self.first_timestamp) / 1e9
+
+    def get_report_rate(self):
+        """
+        :returns average number of input reports per second
+        """
+        duration = self.get_duration()
+        return self.input_reports / duration if duration else 0.0
+
+
+def analyse(reader: CaptureReader, jitter_bin_edges_ms=JITTER_BIN_EDGES_MS) -> CaptureStatistics:
+    """
+    Computes summary statistics of a capture in a single streaming pass.
+
+    :param reader: CaptureReader of the capture
+    :param jitter_bin_edges_ms: bin edges of the input report inter-arrival histogram in milliseconds
+    :returns CaptureStatistics
+    """
+    stats = CaptureStatistics(jitter_bin_edges_ms)
+    for fields in iter_field_blocks(reader):
+        stats.update(fields)
+    return stats
@@ -5,6 +5,7 @@ import shlex
 from aioconsole import ainput
 
 from joycontrol.controller_state import button_push, ControllerState
+from joycontrol.scheduler import ReportRate
 from joycontrol.transport import NotConnectedError
 
 logger = logging.getLogger(__name__)
@@ -158,6 +159,15 @@ class ControllerCLI(CLI):
         else:
             raise ValueError('Value of side must be "l", "left" or "r", "right"')
 
+    async def cmd_rate(self, rate=None):
+        """
+        rate - Show or set the input report rate.
+        :param rate: 'normal' (15ms), 'fast' (8ms) or 'adaptive' (8ms, 15ms while the host can not keep up)
+        """
+        if rate is not None:
+            self.controller_state.set_report_rate(ReportRate.from_arg(rate))
+        return f'Input report rate is {self.controller_state.get_report_rate().value}.'
+
     async def run(self):
         while True:
             user_input = await ainput(prompt='cmd >> ')
@@ -1,7 +1,8 @@
 import asyncio
+import functools
 
-from joycontrol import utils
 from joycontrol.controller import Controller
+from joycontrol.flash_layout import decode_flash, decode_l_stick_calibration, decode_r_stick_calibration
 from joycontrol.memory import FlashMemory
 
 
@@ -10,39 +11,23 @@ class ControllerState:
         self._protocol = protocol
         self._controller = controller
         self._nfc_content = None
+        self._nfc_store = None
+        self._ir_source = None
 
         self._spi_flash = spi_flash
 
         self.button_state = ButtonState(controller)
 
-        # create left stick state
+        # decoded calibration, colors and parameters of the flash memory
+        self._flash_layout = self._flash_layout_generation = None
+
+        # create stick states, calibrated and centered by get_flash_layout
         self.l_stick_state = self.r_stick_state = None
         if controller in (Controller.PRO_CONTROLLER, Controller.JOYCON_L):
-            # load calibration data from memory
-            calibration = None
-            if spi_flash is not None:
-                calibration_data = spi_flash.get_user_l_stick_calibration()
-                if calibration_data is None:
-                    calibration_data = spi_flash.get_factory_l_stick_calibration()
-                calibration = LeftStickCalibration.from_bytes(calibration_data)
-
-            self.l_stick_state = StickState(calibration=calibration)
-            if calibration is not None:
-                self.l_stick_state.set_center()
-
-        # create right stick state
+            self.l_stick_state = StickState()
         if controller in (Controller.PRO_CONTROLLER, Controller.JOYCON_R):
-            # load calibration data from memory
-            calibration = None
-            if spi_flash is not None:
-                calibration_data = spi_flash.get_user_r_stick_calibration()
-                if calibration_data is None:
-                    calibration_data = spi_flash.get_factory_r_stick_calibration()
-                calibration = RightStickCalibration.from_bytes(calibration_data)
-
-            self.r_stick_state = StickState(calibration=calibration)
-            if calibration is not None:
-                self.r_stick_state.set_center()
+            self.r_stick_state = StickState()
+        self.get_flash_layout()
 
         self.sig_is_send = asyncio.Event()
 
@@ -52,12 +37,85 @@ class ControllerState:
     def get_flash_memory(self):
         return self._spi_flash
 
-    def set_nfc(self, nfc_content):
+    def get_flash_layout(self):
+        """
+        :returns dictionary of decoded flash memory regions (see joycontrol.flash_layout.decode_flash),
+                 None if there is no flash memory
+        """
+        if self._spi_flash is None:
+            return None
+        # decode again after writes to the flash memory, e.g. calibration by the console
+        if self._flash_layout_generation != self._spi_flash.get_generation():
+            self._flash_layout = decode_flash(self._spi_flash)
+            self._flash_layout_generation = self._spi_flash.get_generation()
+            self._update_stick_calibration()
+        return self._flash_layout
+
+    def _update_stick_calibration(self):
+        """
+        Sets the stick calibration of the flash memory. Centered sticks are moved to the new center.
+        """
+        for side, stick_state in (('l', self.l_stick_state), ('r', self.r_stick_state)):
+            if stick_state is None:
+                continue
+            centered = not stick_state.has_calibration() or stick_state.is_center()
+            stick_state.set_calibration(self._get_stick_calibration(side))
+            if centered:
+                stick_state.set_center()
+
+    def _get_stick_calibration(self, side):
+        """
+        :param side: 'l' or 'r'
+        :returns user calibration of the stick if available, otherwise factory calibration, None without flash memory
+        """
+        layout = self.get_flash_layout()
+        if layout is None:
+            return None
+        values = layout[f'user_{side}_stick_calibration']
+        if values is None:
+            values = layout[f'factory_{side}_stick_calibration']
+        return _StickCalibration(*values)
+
+    def set_nfc(self, nfc_content, store=None):
+        """
+        :param nfc_content: tag dump bytes, None to remove the tag
+        :param store: callable(content) persisting tag writes of the console, must not block.
+                      Tag writes are only kept in memory if None.
+        """
         self._nfc_content = nfc_content
+        self._nfc_store = store
 
     def get_nfc(self):
         return self._nfc_content
 
+    def set_ir_source(self, source):
+        """
+        Sets the frames of the emulated IR camera.
+        :param source: joycontrol.ir_camera.FrameSource or anything it accepts, None to remove the frames
+        """
+        self._ir_source = source
+
+    def get_ir_source(self):
+        return self._ir_source
+
+    def write_nfc(self, nfc_content):
+        """
+        Replaces the content of the current tag after the console wrote to it.
+        """
+        self._nfc_content = nfc_content
+        if self._nfc_store is not None:
+            self._nfc_store(nfc_content)
+
+    def get_report_rate(self):
+        return self._protocol.get_report_rate()
+
+    def set_report_rate(self, rate):
+        """
+        Changes the rate the controller state is send with in full input report mode.
+        :param rate: joycontrol.scheduler.ReportRate
+        """
+        self._protocol.set_report_rate(rate)
+
     async def send(self):
         """
         Invokes protocol.send_controller_state(). Returns after the controller state was send.
@@ -65,6 +123,69 @@ class ControllerState:
         """
         await self._protocol.send_controller_state()
 
+    def get_frame(self):
+        """
+        :returns index of the next input report, see ControllerProtocol.get_frame
+        """
+        return self._protocol.get_frame()
+
+    async def wait_frames(self, frames=1):
+        """
+        Waits until the given number of input reports were send.
+        Raises NotConnected exception if the connection was lost.
+        """
+        if frames <= 0:
+            return
+        await self._protocol.wait_for_frame(self._protocol.get_frame() + frames - 1)
+
+    async def press(self, buttons, frames=1):
+        """
+        Pushes buttons for exactly the given number of input reports and releases them afterwards.
+        Returns after the input report releasing the buttons was send.
+
+        :param buttons: button name, iterable of button names or mask, see ButtonState.get_mask
+        :param frames: number of input reports containing the pushed buttons
+        """
+        if frames < 1:
+            raise ValueError('Buttons must be pushed for at least one frame.')
+        if isinstance(buttons, str):
+            buttons = (buttons,)
+        mask = self.button_state.get_mask(*buttons) if not isinstance(buttons, int) else buttons
+
+        start = self._protocol.get_frame()
+        self._protocol.schedule_frame_action(start, functools.partial(self.button_state.press_many, mask))
+        self._protocol.schedule_frame_action(start + frames, functools.partial(self.button_state.release_many, mask))
+        self._protocol.wake_for_frame()
+        await self._protocol.wait_for_frame(start + frames)
+
+    async def play(self, timeline):
+        """
+        Plays a compiled macro, see joycontrol.macro. The timeline is merged with the other input sources by the
+        input mixer, its sticks take priority.
+        Returns after the input report of the last timeline frame was send.
+        """
+        await self._protocol.play_timeline(timeline)
+
+    async def run_script(self, program, name='script'):
+        """
+        Runs a compiled macro script in its own input layer, see joycontrol.macro_vm and joycontrol.input_mixer.
+        :param name: name of the script, a running script of the same name is stopped
+        :returns number of frames produced by the script
+        """
+        return await self._protocol.run_script(program, name=name)
+
+    def stop_script(self, name=None):
+        """
+        Stops a running macro script, all scripts if name is None.
+        """
+        self._protocol.stop_script(name)
+
+    def get_input_mixer(self):
+        """
+        :returns InputMixer merging the controller state with other input sources, see joycontrol.input_mixer
+        """
+        return self._protocol.get_input_mixer()
+
     async def connect(self):
         """
         Waits until the switch is paired with the controller and accepts button commands
@@ -72,6 +193,34 @@ class ControllerState:
         await self._protocol.sig_set_player_lights.wait()
 
 
+def _create_button_bits(controller: Controller):
+    """
+    :returns dictionary of (byte, bitmask) of every button available to the controller
+    """
+    bits = {}
+    # byte 1
+    if controller in (Controller.PRO_CONTROLLER, Controller.JOYCON_R):
+        bits.update(y=(0, 0x01), x=(0, 0x02), b=(0, 0x04), a=(0, 0x08), r=(0, 0x40), zr=(0, 0x80))
+        if controller == Controller.JOYCON_R:
+            bits.update(sr=(0, 0x10), sl=(0, 0x20))
+
+    # byte 2
+    bits.update(plus=(1, 0x02))
+    if controller in (Controller.PRO_CONTROLLER, Controller.JOYCON_R):
+        bits.update(r_stick=(1, 0x04), home=(1, 0x10))
+    if controller in (Controller.PRO_CONTROLLER, Controller.JOYCON_L):
+        bits.update(l_stick=(1, 0x08), capture=(1, 0x20))
+    if controller == Controller.PRO_CONTROLLER:
+        bits.update(minus=(1, 0x01))
+
+    # byte 3
+    if controller in (Controller.PRO_CONTROLLER, Controller.JOYCON_L):
+        bits.update(down=(2, 0x01), up=(2, 0x02), right=(2, 0x04), left=(2, 0x08), l=(2, 0x40), zl=(2, 0x80))
+        if controller == Controller.JOYCON_L:
+            bits.update(sr=(2, 0x10), sl=(2, 0x20))
+    return bits
+
+
 class ButtonState:
     """
     Utility class to set buttons in the input report
@@ -81,110 +230,131 @@ class ButtonState:
     2       Minus 	Plus 	R Stick L Stick Home 	Capture
     3       Down 	Up 	    Right 	Left 	SR 	    SL 	    L 	    ZL
 
-    Example for generated methods: home button (byte_2, 4)
+    All buttons are stored in one 24 bit integer, byte 1 in the lowest bits. Buttons map to masks of this integer,
+    see get_mask, so any number of buttons can be set at once.
 
-    def home(self, pushed=True):
-        if pushed != utils.get_bit(self.byte_2, 4):
-            self.byte_2 = utils.flip_bit(self.byte_2, 4)
-
-    def home_is_set(self):
-        return get_bit(self.byte_2, 4)
+    For backwards compatibility every button can also be set and queried by name, e.g. home button:
+        button_state.home(pushed=True)
+        button_state.home_is_set()
     """
+    # (byte, bitmask) of the available buttons by controller
+    BUTTON_BITS = {controller: _create_button_bits(controller) for controller in Controller}
+    # 24 bit masks of the available buttons by controller
+    BUTTON_MASKS = {controller: {button: mask << (8 * byte) for button, (byte, mask) in bits.items()}
+                    for controller, bits in BUTTON_BITS.items()}
+
     def __init__(self, controller: Controller):
         self.controller = controller
+        self._masks = ButtonState.BUTTON_MASKS[controller]
+        # mask of all available buttons
+        self._available_mask = sum(self._masks.values())
+
+        self._state = 0
+
+    def __getattr__(self, name):
+        # only called if regular attribute lookup fails, generates the previous per button methods
+        masks = self.__dict__.get('_masks', {})
+        if name in masks:
+            return functools.partial(self.set_button, name)
+        if name.endswith('_is_set') and name[:-len('_is_set')] in masks:
+            return functools.partial(self.get_button, name[:-len('_is_set')])
+        raise AttributeError(f'{type(self).__name__!r} object has no attribute {name!r}')
+
+    def _get_button_mask(self, button):
+        mask = self._masks.get(button)
+        if mask is None:
+            raise ValueError(f'Given button "{button}" is not available to {self.controller.device_name()}.')
+        return mask
 
-        # 3 bytes
-        self._byte_1 = 0
-        self._byte_2 = 0
-        self._byte_3 = 0
-
-        # generating methods for each button
-        def button_method_factory(byte, bit):
-            def setter(pushed=True):
-                _byte = getattr(self, byte)
-
-                if pushed != utils.get_bit(_byte, bit):
-                    setattr(self, byte, utils.flip_bit(_byte, bit))
-
-            def getter():
-                return utils.get_bit(getattr(self, byte), bit)
-            return setter, getter
-
-        if self.controller == Controller.PRO_CONTROLLER:
-            self._available_buttons = {'y', 'x', 'b', 'a', 'r', 'zr',
-                                       'minus', 'plus', 'r_stick', 'l_stick', 'home', 'capture',
-                                       'down', 'up', 'right', 'left', 'l', 'zl'}
-        elif self.controller == Controller.JOYCON_R:
-            self._available_buttons = {'y', 'x', 'b', 'a', 'sr', 'sl', 'r', 'zr',
-                                       'plus', 'r_stick', 'home'}
-        elif self.controller == Controller.JOYCON_L:
-            self._available_buttons = {'plus', 'l_stick', 'capture',
-                                       'down', 'up', 'right', 'left', 'sr', 'sl', 'l', 'zl'}
-
-        # byte 1
-        if self.controller == Controller.PRO_CONTROLLER or self.controller == Controller.JOYCON_R:
-            self.y, self.y_is_set = button_method_factory('_byte_1', 0)
-            self.x, self.x_is_set = button_method_factory('_byte_1', 1)
-            self.b, self.b_is_set = button_method_factory('_byte_1', 2)
-            self.a, self.a_is_set = button_method_factory('_byte_1', 3)
-
-            if self.controller == Controller.JOYCON_R:
-                self.sr, self.sr_is_set = button_method_factory('_byte_1', 4)
-                self.sl, self.sl_is_set = button_method_factory('_byte_1', 5)
-
-            self.r, self.r_is_set = button_method_factory('_byte_1', 6)
-            self.zr, self.zr_is_set = button_method_factory('_byte_1', 7)
-
-        # byte 2
-        self.minus, self.minus_is_set = button_method_factory('_byte_2', 0)
-        self.plus, self.plus_is_set = button_method_factory('_byte_2', 1)
-        self.r_stick, self.r_stick_is_set = button_method_factory('_byte_2', 2)
-        self.l_stick, self.l_stick_is_set = button_method_factory('_byte_2', 3)
-        if self.controller == Controller.JOYCON_R or self.controller == Controller.PRO_CONTROLLER:
-            self.home, self.home_is_set = button_method_factory('_byte_2', 4)
-        if self.controller == Controller.JOYCON_L or self.controller == Controller.PRO_CONTROLLER:
-            self.capture, self.capture_is_set = button_method_factory('_byte_2', 5)
-
-        # byte 3
-        if self.controller == Controller.PRO_CONTROLLER or self.controller == Controller.JOYCON_L:
-            self.down, self.down_is_set = button_method_factory('_byte_3', 0)
-            self.up, self.up_is_set = button_method_factory('_byte_3', 1)
-            self.right, self.right_is_set = button_method_factory('_byte_3', 2)
-            self.left, self.left_is_set = button_method_factory('_byte_3', 3)
-
-            if self.controller == Controller.JOYCON_L:
-                self.sr, self.sr_is_set = button_method_factory('_byte_3', 4)
-                self.sl, self.sl_is_set = button_method_factory('_byte_3', 5)
-
-            self.l, self.l_is_set = button_method_factory('_byte_3', 6)
-            self.zl, self.zl_is_set = button_method_factory('_byte_3', 7)
+    def get_mask(self, *buttons):
+        """
+        :param buttons: button names
+        :returns mask of the given buttons, see set_buttons
+        """
+        mask = 0
+        for button in buttons:
+            mask |= self._get_button_mask(button)
+        return mask
+
+    def _to_mask(self, buttons):
+        if isinstance(buttons, int):
+            if buttons & ~self._available_mask:
+                raise ValueError(f'Mask 0x{buttons:06x} contains buttons not available to '
+                                 f'{self.controller.device_name()}.')
+            return buttons
+        if isinstance(buttons, str):
+            buttons = (buttons,)
+        return self.get_mask(*buttons)
 
     def set_button(self, button, pushed=True):
-        if button not in self._available_buttons:
-            raise ValueError(f'Given button "{button}" is not available to {self.controller.device_name()}.')
-        getattr(self, button)(pushed=pushed)
+        mask = self._masks.get(button)
+        if mask is None:
+            mask = self._get_button_mask(button)
+        if pushed:
+            self._state |= mask
+        else:
+            self._state &= ~mask
 
     def get_button(self, button):
-        if button not in self._available_buttons:
-            raise ValueError(f'Given button "{button}" is not available to {self.controller.device_name()}.')
-        return getattr(self, f'{button}_is_set')()
+        return self._state & self._get_button_mask(button) != 0
+
+    def set_buttons(self, mask):
+        """
+        Replaces the state of all buttons.
+        :param mask: mask of the pushed buttons, see get_mask
+        """
+        self._state = self._to_mask(mask)
+
+    def get_buttons(self):
+        """
+        :returns mask of the pushed buttons
+        """
+        return self._state
+
+    def press_many(self, buttons):
+        """
+        Pushes several buttons at once.
+        :param buttons: button name, iterable of button names or a mask, see get_mask
+        """
+        self._state |= self._to_mask(buttons)
+
+    def release_many(self, buttons):
+        """
+        Releases several buttons at once.
+        :param buttons: button name, iterable of button names or a mask, see get_mask
+        """
+        self._state &= ~self._to_mask(buttons)
+
+    def apply_diff(self, old, new):
+        """
+        Applies the changes between two button masks, buttons which are equal in both masks are not modified.
+        E.g. to apply the state of a macro frame without overriding buttons pushed by other sources.
+        :param old: previous mask
+        :param new: new mask
+        :returns the resulting mask of the pushed buttons
+        """
+        old, new = self._to_mask(old), self._to_mask(new)
+        changed = old ^ new
+        self._state = (self._state & ~changed) | (new & changed)
+        return self._state
 
     def get_available_buttons(self):
         """
         :returns set of valid buttons
         """
-        return set(self._available_buttons)
+        return set(self._masks)
+
+    def __bytes__(self):
+        return self._state.to_bytes(3, 'little')
 
     def __iter__(self):
         """
         :returns iterator over the button bytes
         """
-        yield self._byte_1
-        yield self._byte_2
-        yield self._byte_3
+        return iter(bytes(self))
 
     def clear(self):
-        self._byte_1 = self._byte_2 = self._byte_3 = 0
+        self._state = 0
 
 
 async def button_push(controller_state, *buttons, sec=0.1):
@@ -228,29 +398,13 @@ class _StickCalibration:
 class LeftStickCalibration(_StickCalibration):
     @staticmethod
     def from_bytes(_9bytes):
-        h_max_above_center = (_9bytes[1] << 8) & 0xF00 | _9bytes[0]
-        v_max_above_center = (_9bytes[2] << 4) | (_9bytes[1] >> 4)
-        h_center =           (_9bytes[4] << 8) & 0xF00 | _9bytes[3]
-        v_center =           (_9bytes[5] << 4) | (_9bytes[4] >> 4)
-        h_max_below_center = (_9bytes[7] << 8) & 0xF00 | _9bytes[6]
-        v_max_below_center = (_9bytes[8] << 4) | (_9bytes[7] >> 4)
-
-        return _StickCalibration(h_center, v_center, h_max_above_center, v_max_above_center,
-                                 h_max_below_center, v_max_below_center)
+        return _StickCalibration(*decode_l_stick_calibration(_9bytes))
 
 
 class RightStickCalibration(_StickCalibration):
     @staticmethod
     def from_bytes(_9bytes):
-        h_center =           (_9bytes[1] << 8) & 0xF00 | _9bytes[0]
-        v_center =           (_9bytes[2] << 4) | (_9bytes[1] >> 4)
-        h_max_below_center = (_9bytes[4] << 8) & 0xF00 | _9bytes[3]
-        v_max_below_center = (_9bytes[5] << 4) | (_9bytes[4] >> 4)
-        h_max_above_center = (_9bytes[7] << 8) & 0xF00 | _9bytes[6]
-        v_max_above_center = (_9bytes[8] << 4) | (_9bytes[7] >> 4)
-
-        return _StickCalibration(h_center, v_center, h_max_above_center, v_max_above_center,
-                                 h_max_below_center, v_max_below_center)
+        return _StickCalibration(*decode_r_stick_calibration(_9bytes))
 
 
 class StickState:
@@ -332,6 +486,15 @@ class StickState:
     def set_calibration(self, calibration):
         self._calibration = calibration
 
+    def copy(self):
+        """
+        :returns new stick state with the same position and calibration
+        """
+        return StickState(h=self._h_stick, v=self._v_stick, calibration=self._calibration)
+
+    def has_calibration(self):
+        return self._calibration is not None
+
     def get_calibration(self):
         if self._calibration is None:
             raise ValueError('No calibration data available.')
@@ -0,0 +1,179 @@
+import collections
+import hashlib
+import logging
+import struct
+
+logger = logging.getLogger(__name__)
+
+"""
+Decoder of the SPI flash memory regions holding serial number, colors, stick and IMU parameters and calibration.
+https://github.com/dekuNukem/Nintendo_Switch_Reverse_Engineering/blob/master/spi_flash_notes.md
+
+Decoded values only consist of ints, strings, lists and dicts.
+"""
+
+# Magic bytes marking available user calibration
+USER_CALIBRATION_MAGIC = b'\xB2\xA1'
+
+# Maximum number of decoded images kept in memory
+CACHE_SIZE = 64
+
+
+def decode_serial(data):
+    """
+    :returns serial number string, None if the controller has none (all bytes 0xFF)
+    """
+    if all(byte == 0xFF for byte in data):
+        return None
+    return bytes(data).rstrip(b'\x00\xFF').decode('ascii', errors='replace')
+
+
+def decode_colors(data):
+    """
+    :returns dictionary of [r, g, b] colors
+    """
+    return {
+        'body': list(data[0:3]),
+        'buttons': list(data[3:6]),
+        'left_grip': list(data[6:9]),
+        'right_grip': list(data[9:12]),
+    }
+
+
+def decode_l_stick_calibration(data):
+    """
+    :returns h_center, v_center, h_max_above_center, v_max_above_center, h_max_below_center, v_max_below_center
+    """
+    h_max_above_center = (data[1] << 8) & 0xF00 | data[0]
+    v_max_above_center = (data[2] << 4) | (data[1] >> 4)
+    h_center = (data[4] << 8) & 0xF00 | data[3]
+    v_center = (data[5] << 4) | (data[4] >> 4)
+    h_max_below_center = (data[7] << 8) & 0xF00 | data[6]
+    v_max_below_center = (data[8] << 4) | (data[7] >> 4)
+    return [h_center, v_center, h_max_above_center, v_max_above_center, h_max_below_center, v_max_below_center]
+
+
+def decode_r_stick_calibration(data):
+    """
+    :returns h_center, v_center, h_max_above_center, v_max_above_center, h_max_below_center, v_max_below_center
+    """
+    h_center = (data[1] << 8) & 0xF00 | data[0]
+    v_center = (data[2] << 4) | (data[1] >> 4)
+    h_max_below_center = (data[4] << 8) & 0xF00 | data[3]
+    v_max_below_center = (data[5] << 4) | (data[4] >> 4)
+    h_max_above_center = (data[7] << 8) & 0xF00 | data[6]
+    v_max_above_center = (data[8] << 4) | (data[7] >> 4)
+    return [h_center, v_center, h_max_above_center, v_max_above_center, h_max_below_center, v_max_below_center]
+
+
+def decode_stick_parameters(data):
+    """
+    :returns dictionary of the dead zone and range ratio of a stick
+    """
+    return {
+        'dead_zone': (data[4] << 8) & 0xF00 | data[3],
+        'range_ratio': (data[5] << 4) | (data[4] >> 4),
+    }
+
+
+def decode_imu_calibration(data):
+    """
+    :returns dictionary of [x, y, z] accelerometer and gyroscope origins and sensitivities
+    """
+    values = struct.unpack('<12h', bytes(data))
+    return {
+        'acc_origin': list(values[0:3]),
+        'acc_sensitivity': list(values[3:6]),
+        'gyro_origin': list(values[6:9]),
+        'gyro_sensitivity': list(values[9:12]),
+    }
+
+
+def decode_imu_horizontal_offsets(data):
+    """
+    :returns [x, y, z] accelerometer offsets of a horizontally lying controller
+    """
+    return list(struct.unpack('<3h', bytes(data)))
+
+
+FlashRegion = collections.namedtuple('FlashRegion', ['name', 'offset', 'size', 'decoder', 'magic_offset'])
+FlashRegion.__doc__ = """
+Region of the flash memory.
+magic_offset: offset of USER_CALIBRATION_MAGIC marking the region as available, None if it is always available
+"""
+
+REGIONS = (
+    FlashRegion('serial', 0x6000, 0x10, decode_serial, None),
+    FlashRegion('factory_imu_calibration', 0x6020, 0x18, decode_imu_calibration, None),
+    FlashRegion('factory_l_stick_calibration', 0x603D, 0x09, decode_l_stick_calibration, None),
+    FlashRegion('factory_r_stick_calibration', 0x6046, 0x09, decode_r_stick_calibration, None),
+    FlashRegion('colors', 0x6050, 0x0D, decode_colors, None),
+    FlashRegion('imu_horizontal_offsets', 0x6080, 0x06, decode_imu_horizontal_offsets, None),
+    FlashRegion('l_stick_parameters', 0x6086, 0x12, decode_stick_parameters, None),
+    FlashRegion('r_stick_parameters', 0x6098, 0x12, decode_stick_parameters, None),
+    FlashRegion('user_l_stick_calibration', 0x8012, 0x09, decode_l_stick_calibration, 0x8010),
+    FlashRegion('user_r_stick_calibration', 0x801D, 0x09, decode_r_stick_calibration, 0x801B),
+    FlashRegion('user_imu_calibration', 0x8028, 0x18, decode_imu_calibration, 0x8026),
+)
+
+# decoded layouts by image hash
+_memo = collections.OrderedDict()
+
+
+def _read_regions(flash):
+    """
+    :returns bytes of all regions and their magic markers
+    """
+    chunks = []
+    for region in REGIONS:
+        if region.magic_offset is not None:
+            chunks.append(flash[region.magic_offset:region.magic_offset + len(USER_CALIBRATION_MAGIC)])
+        chunks.append(flash[region.offset:region.offset + region.size])
+    return chunks
+
+
+def get_image_hash(flash):
+    """
+    :param flash: FlashMemory or other object supporting slicing
+    :returns hash of all bytes the decoded layout depends on
+    """
+    image_hash = hashlib.blake2b(digest_size=16)
+    for chunk in _read_regions(flash):
+        image_hash.update(bytes(chunk))
+    return image_hash.hexdigest()
+
+
+def _decode(flash):
+    layout = {}
+    for region in REGIONS:
+        if region.magic_offset is not None:
+            magic = flash[region.magic_offset:region.magic_offset + len(USER_CALIBRATION_MAGIC)]
+            if bytes(magic) != USER_CALIBRATION_MAGIC:
+                layout[region.name] = None
+                continue
+        layout[region.name] = region.decoder(flash[region.offset:region.offset + region.size])
+    return layout
+
+
+def decode_flash(flash):
+    """
+    Decodes all regions of the flash memory.
+
+    Results are memoized by the hash of the decoded bytes, controllers with the same flash content share the decoded
+    values. The returned dictionary is shared and must not be modified.
+
+    :param flash: FlashMemory or other object supporting slicing
+    :returns dictionary of decoded values by region name, None for unavailable user calibration
+    """
+    image_hash = get_image_hash(flash)
+
+    layout = _memo.get(image_hash)
+    if layout is not None:
+        _memo.move_to_end(image_hash)
+        return layout
+
+    layout = _decode(flash)
+    _memo[image_hash] = layout
+    while len(_memo) > CACHE_SIZE:
+        _memo.popitem(last=False)
+    return layout
@@ -0,0 +1,335 @@
+import itertools
+import logging
+
+from joycontrol.controller_state import ControllerState
+
+logger = logging.getLogger(__name__)
+
+"""
+Merges the input of several concurrent sources (keyboard, macro scripts, timelines, ...) into the controller status of
+every input report.
+
+Each source writes into its own InputLayer. Once per input report the InputMixer composes the status:
+- buttons of all layers are ORed, a layer can mask out buttons of the layers below it
+- sticks are taken from the layer with the highest priority controlling the stick, or from the layer which moved the
+  stick last (see STICK_LAST_WRITER)
+The button and stick states of the ControllerState form the base layer below all other layers.
+"""
+
+# stick modes of the mixer
+STICK_PRIORITY = 'priority'
+STICK_LAST_WRITER = 'last_writer'
+STICK_MODES = (STICK_PRIORITY, STICK_LAST_WRITER)
+
+# priorities of the layers created by joycontrol, higher priorities are above lower ones
+PRIORITY_KEYBOARD = 10
+PRIORITY_SCRIPT = 20
+PRIORITY_TIMELINE = 30
+
+# button and stick status bytes written by the mixer, see InputReport.set_controller_status
+STATUS_SIZE = 9
+
+_STICK_SIDES = {'l': 0, 'r': 1}
+
+# increases for every stick movement of any layer, orders the movements for STICK_LAST_WRITER
+_stick_writes = itertools.count(1)
+
+
+def _get_stick_side(side):
+    try:
+        return _STICK_SIDES[side]
+    except KeyError:
+        raise ValueError(f'Unknown stick "{side}", must be "l" or "r".') from None
+
+
+class InputLayer:
+    """
+    Buttons and sticks set by one input source.
+
+    Buttons pushed using press are contained in at least one input report, even if they are released before the
+    next report is send. Layers are not thread safe, sources running in other threads (e.g. keyboard callbacks) should
+    change them using loop.call_soon_threadsafe.
+    """
+
+    def __init__(self, name, priority=0, controller_state: ControllerState = None):
+        """
+        :param name: name of the source
+        :param priority: position of the layer in the mixer, higher priorities are above lower ones
+        :param controller_state: provides the button names and stick calibration, if None only masks and raw stick
+                                 values can be used
+        """
+        self.name = name
+        self.priority = priority
+        self._controller_state = controller_state
+
+        self._buttons = 0
+        # buttons pushed since the last composition
+        self._latched = 0
+        # buttons of lower layers which are masked out
+        self._mask = 0
+
+        # stick positions by side (0 = left, 1 = right), only used if the layer controls the stick
+        self._stick_h = [0, 0]
+        self._stick_v = [0, 0]
+        self._stick_set = [False, False]
+        # stick write counter of the last movement, see STICK_LAST_WRITER
+        self._stick_serial = [0, 0]
+
+    def _to_mask(self, buttons):
+        if isinstance(buttons, int):
+            return buttons
+        if isinstance(buttons, str):
+            buttons = (buttons,)
+        if self._controller_state is None:
+            raise ValueError('Button names require a controller state, use masks.')
+        return self._controller_state.button_state.get_mask(*buttons)
+
+    def press(self, buttons):
+        """
+        Pushes buttons until they are released.
+        :param buttons: button name, iterable of button names or mask, see ButtonState.get_mask
+        """
+        mask = self._to_mask(buttons)
+        self._buttons |= mask
+        self._latched |= mask
+
+    def release(self, buttons=None):
+        """
+        Releases buttons, all if None.
+        """
+        if buttons is None:
+            self._buttons = 0
+        else:
+            self._buttons &= ~self._to_mask(buttons)
+
+    def set_buttons(self, mask):
+        """
+        Replaces the pushed buttons, without latching them, see press.
+        """
+        self._buttons = mask
+
+    def get_buttons(self):
+        return self._buttons
+
+    def set_mask(self, buttons):
+        """
+        Masks out buttons of the layers below this layer, including the base layer. 0 to disable masking.
+        """
+        self._mask = self._to_mask(buttons)
+
+    def get_mask(self):
+        return self._mask
+
+    def _set_stick(self, side, h, v):
+        if not self._stick_set[side] or self._stick_h[side] != h or self._stick_v[side] != v:
+            self._stick_h[side] = h
+            self._stick_v[side] = v
+            self._stick_set[side] = True
+            self._stick_serial[side] = next(_stick_writes)
+
+    def set_stick(self, side, h, v):
+        """
+        Takes control of a stick.
+        :param side: 'l' or 'r'
+        :param h: raw horizontal value
+        :param v: raw vertical value
+        """
+        for val in (h, v):
+            if not 0 <= val < 0x1000:
+                raise ValueError(f'Stick values must be in [0,{0x1000})')
+        self._set_stick(_get_stick_side(side), h, v)
+
+    def move_stick(self, side, direction):
+        """
+        Takes control of a stick and moves it to a direction.
+        :param side: 'l' or 'r'
+        :param direction: center, up, down, left or right, using the calibration of the controller state stick
+        """
+        if self._controller_state is None:
+            raise ValueError('Stick directions require a controller state.')
+        stick = getattr(self._controller_state, f'{side}_stick_state', None)
+        if stick is None:
+            raise ValueError(f'{self._controller_state.get_controller().device_name()} has no {side} stick.')
+        if direction not in ('center', 'up', 'down', 'left', 'right'):
+            raise ValueError(f'Unknown stick direction "{direction}".')
+        position = stick.copy()
+        getattr(position, f'set_{direction}')()
+        self._set_stick(_get_stick_side(side), position.get_h(), position.get_v())
+
+    def release_stick(self, side=None):
+        """
+        Gives up control of a stick, both if None.
+        """
+        if side is None:
+            self._stick_set[0] = self._stick_set[1] = False
+        else:
+            self._stick_set[_get_stick_side(side)] = False
+
+    def get_stick(self, side):
+        """
+        :returns (horizontal, vertical) position of the stick, None if the layer does not control it
+        """
+        index = _get_stick_side(side)
+        if not self._stick_set[index]:
+            return None
+        return self._stick_h[index], self._stick_v[index]
+
+    def set_status(self, status, offset=0):
+        """
+        Sets buttons and both sticks from controller status bytes, e.g. a timeline row.
+        :param status: buffer containing 9 status bytes at offset, see InputReport.set_controller_status
+        """
+        self._buttons = status[offset] | (status[offset + 1] << 8) | (status[offset + 2] << 16)
+        for side in (0, 1):
+            stick_offset = offset + 3 + 3 * side
+            self._set_stick(side,
+                            status[stick_offset] | ((status[stick_offset + 1] & 0xF) << 8),
+                            (status[stick_offset + 1] >> 4) | (status[stick_offset + 2] << 4))
+
+    def clear(self):
+        """
+        Releases all buttons and sticks and disables masking.
+        """
+        self._buttons = self._latched = self._mask = 0
+        self._stick_set[0] = self._stick_set[1] = False
+
+    def __repr__(self):
+        return f'<InputLayer {self.name!r} priority {self.priority}>'
+
+
+class InputMixer:
+    """
+    Composes the controller status of the input reports from the layers of all input sources, see compose.
+    """
+
+    def __init__(self, controller_state: ControllerState, stick_mode=STICK_PRIORITY):
+        """
+        :param controller_state: base layer below all other layers
+        :param stick_mode: STICK_PRIORITY or STICK_LAST_WRITER
+        """
+        self._controller_state = controller_state
+        self.set_stick_mode(stick_mode)
+
+        # layers sorted by descending priority, layers with equal priority in order of their addition
+        self._layers = []
+
+        self.status = bytearray(STATUS_SIZE)
+
+        # last positions of the base layer sticks and their write counter, to detect movements for STICK_LAST_WRITER
+        self._base_h = [0, 0]
+        self._base_v = [0, 0]
+        self._base_serial = [0, 0]
+        for side, stick_state in enumerate((controller_state.l_stick_state, controller_state.r_stick_state)):
+            if stick_state is not None:
+                self._base_h[side] = stick_state.get_h()
+                self._base_v[side] = stick_state.get_v()
+
+    def set_stick_mode(self, stick_mode):
+        """
+        :param stick_mode: STICK_PRIORITY: sticks are controlled by the layer with the highest priority controlling
+                           the stick, the base layer only if no other layer does.
+                           STICK_LAST_WRITER: sticks are controlled by the layer which moved them last.
+        """
+        if stick_mode not in STICK_MODES:
+            raise ValueError(f'Unknown stick mode "{stick_mode}", must be one of {STICK_MODES}.')
+        self._stick_mode = stick_mode
+
+    def get_stick_mode(self):
+        return self._stick_mode
+
+    def create_layer(self, name, priority=0):
+        """
+        Creates and adds a layer.
+        """
+        layer = InputLayer(name, priority=priority, controller_state=self._controller_state)
+        self.add_layer(layer)
+        return layer
+
+    def add_layer(self, layer: InputLayer):
+        if layer in self._layers:
+            raise ValueError(f'{layer} is already added.')
+        index = 0
+        while index < len(self._layers) and self._layers[index].priority >= layer.priority:
+            index += 1
+        self._layers.insert(index, layer)
+
+    def remove_layer(self, layer: InputLayer):
+        """
+        Removes a layer, its buttons and sticks are released with the next input report.
+        """
+        if layer in self._layers:
+            self._layers.remove(layer)
+
+    def get_layer(self, name):
+        """
+        :returns first layer of the given name, None if there is none
+        """
+        for layer in self._layers:
+            if layer.name == name:
+                return layer
+        return None
+
+    def get_layers(self):
+        """
+        :returns list of the layers, sorted by descending priority
+        """
+        return list(self._layers)
+
+    def _compose_stick(self, side, stick_state, layer, offset):
+        status = self.status
+        if stick_state is None:
+            status[offset] = status[offset + 1] = status[offset + 2] = 0
+            return
+
+        h = stick_state.get_h()
+        v = stick_state.get_v()
+        # movements of the base layer are tracked in both modes, so changing the mode does not count as a movement
+        if h != self._base_h[side] or v != self._base_v[side]:
+            self._base_h[side] = h
+            self._base_v[side] = v
+            self._base_serial[side] = next(_stick_writes)
+        if self._stick_mode == STICK_LAST_WRITER:
+            if layer is not None and layer._stick_serial[side] > self._base_serial[side]:
+                h = layer._stick_h[side]
+                v = layer._stick_v[side]
+        elif layer is not None:
+            h = layer._stick_h[side]
+            v = layer._stick_v[side]
+
+        status[offset] = h & 0xFF
+        status[offset + 1] = (h >> 8) | ((v & 0xF) << 4)
+        status[offset + 2] = v >> 4
+
+    def compose(self):
+        """
+        Composes the controller status of the next input report and clears the latched buttons of all layers.
+        Only the preallocated status bytes are updated, no lists or bytes objects are created per report.
+        :returns status bytes, updated in place
+        """
+        last_writer = self._stick_mode == STICK_LAST_WRITER
+        buttons = 0
+        masked = 0
+        l_layer = r_layer = None
+        for layer in self._layers:
+            buttons |= (layer._buttons | layer._latched) & ~masked
+            layer._latched = 0
+            masked |= layer._mask
+
+            stick_set = layer._stick_set
+            if stick_set[0] and (l_layer is None or
+                                 last_writer and layer._stick_serial[0] > l_layer._stick_serial[0]):
+                l_layer = layer
+            if stick_set[1] and (r_layer is None or
+                                 last_writer and layer._stick_serial[1] > r_layer._stick_serial[1]):
+                r_layer = layer
+
+        controller_state = self._controller_state
+        buttons |= controller_state.button_state.get_buttons() & ~masked
+
+        status = self.status
+        status[0] = buttons & 0xFF
+        status[1] = (buttons >> 8) & 0xFF
+        status[2] = buttons >> 16
+        self._compose_stick(0, controller_state.l_stick_state, l_layer, 3)
+        self._compose_stick(1, controller_state.r_stick_state, r_layer, 6)
+        return status
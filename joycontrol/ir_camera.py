@@ -0,0 +1,393 @@
+import collections
+import enum
+import itertools
+import logging
+import os
+
+from joycontrol.utils import CRC8_TABLE
+
+logger = logging.getLogger(__name__)
+
+"""
+IR camera emulation of the IR/NFC MCU.
+
+Grayscale frames are taken from image files, NumPy arrays or any iterable of frames. Every frame is downscaled and
+quantised to the resolution requested by the console and split into 300 byte fragments, one fragment is send per
+0x31 input report. Fragment encoding is vectorised using NumPy, so a frame is encoded in about a millisecond.
+
+Fragment layout (MCU data of a 0x31 input report): 0x03, 2 unknown bytes, fragment number, 6 unknown bytes,
+300 bytes image data, 2 unknown bytes, CRC-8.
+
+The console acknowledges fragments with 0x11 output reports (MCU sub command 0x03), data: 0x00,
+0x01 if a fragment is requested again, number of the requested fragment, number of the acknowledged fragment.
+"""
+
+# size of the MCU data in 0x31 input reports
+MCU_FRAME_SIZE = 313
+
+# image bytes per fragment
+IR_FRAGMENT_DATA_SIZE = 300
+IR_FRAGMENT_DATA_OFFSET = 10
+
+# first byte of MCU data containing an image fragment
+IR_FRAGMENT_REPORT_ID = 0x03
+
+# IR mode of the set IR mode MCU command transferring images
+IR_MODE_IMAGE_TRANSFER = 0x07
+
+# Fragments send ahead of the last acknowledged one
+IR_ACK_WINDOW = 16
+# Ticks to wait for an acknowledgement before going back to the first unacknowledged fragment
+IR_ACK_TIMEOUT = 8
+
+# luminance weights of RGB frames
+_LUMINANCE = (0.299, 0.587, 0.114)
+
+
+def _import_numpy():
+    try:
+        import numpy
+    except ImportError as err:
+        raise ImportError('IR camera emulation requires NumPy, '
+                          'install it using "pip install joycontrol[ir_camera]".') from err
+    return numpy
+
+
+def _import_pil_image():
+    try:
+        from PIL import Image
+    except ImportError as err:
+        raise ImportError('Reading IR camera frames from image files requires Pillow, install it using '
+                          '"pip install joycontrol[ir_camera]".') from err
+    return Image
+
+
+class IrResolution(enum.Enum):
+    """
+    IR camera resolutions as (width, height).
+    """
+    R320x240 = (320, 240)
+    R160x120 = (160, 120)
+    R80x60 = (80, 60)
+    R40x30 = (40, 30)
+
+    def get_width(self):
+        return self.value[0]
+
+    def get_height(self):
+        return self.value[1]
+
+    def get_fragments(self):
+        """
+        :returns number of fragments of a frame
+        """
+        return self.value[0] * self.value[1] // IR_FRAGMENT_DATA_SIZE
+
+    @staticmethod
+    def from_fragments(fragments):
+        """
+        :param fragments: number of fragments of a frame, as requested by the set IR mode MCU command
+        """
+        for resolution in IrResolution:
+            if resolution.get_fragments() == fragments:
+                return resolution
+        raise ValueError(f'No IR camera resolution consists of {fragments} fragments.')
+
+    @staticmethod
+    def from_arg(arg):
+        for resolution in IrResolution:
+            if arg in (resolution.name, resolution.name[1:]):
+                return resolution
+        raise ValueError(f'Unknown IR camera resolution "{arg}".')
+
+
+def load_image(path):
+    """
+    :returns grayscale NumPy array of an image file
+    """
+    np = _import_numpy()
+    Image = _import_pil_image()
+    with Image.open(path) as image:
+        return np.asarray(image.convert('L'))
+
+
+def to_grayscale(frame):
+    """
+    Converts a frame to a 2D array of 8 bit gray values.
+
+    :param frame: NumPy array, nested list or PIL image. Arrays may be grayscale (height, width) or RGB(A)
+                  (height, width, channels). Float values are expected in [0, 1], integers in the range of their type.
+    """
+    np = _import_numpy()
+    if hasattr(frame, 'convert') and not isinstance(frame, np.ndarray):
+        # PIL image
+        frame = frame.convert('L')
+    frame = np.asarray(frame)
+
+    if frame.ndim == 3:
+        weights = np.array(_LUMINANCE[:min(3, frame.shape[2])])
+        frame = frame[:, :, :len(weights)] @ (weights / weights.sum())
+    elif frame.ndim != 2:
+        raise ValueError(f'Frame of shape {frame.shape} is neither grayscale nor RGB.')
+
+    if frame.dtype == np.uint8:
+        return frame
+    if frame.dtype == np.bool_:
+        return frame.astype(np.uint8) * 255
+    if np.issubdtype(frame.dtype, np.integer):
+        frame = frame * (255 / np.iinfo(frame.dtype).max)
+    else:
+        frame = frame * 255
+    return np.clip(np.rint(frame), 0, 255).astype(np.uint8)
+
+
+def downscale(frame, resolution: IrResolution):
+    """
+    Scales a grayscale frame to the given resolution. Frames are downscaled by averaging the covered source
+    pixels and upscaled by repeating pixels.
+
+    :returns uint8 array of shape (height, width)
+    """
+    np = _import_numpy()
+    height, width = frame.shape
+    target_width, target_height = resolution.value
+    if (width, height) == (target_width, target_height):
+        return frame
+
+    if height % target_height == 0 and width % target_width == 0:
+        # integer factors, average blocks
+        factor_y, factor_x = height // target_height, width // target_width
+        sums = np.zeros((target_height, target_width), dtype=np.uint32)
+        for y in range(factor_y):
+            for x in range(factor_x):
+                sums += frame[y::factor_y, x::factor_x]
+        count = factor_y * factor_x
+        return ((sums + count // 2) // count).astype(np.uint8)
+
+    rows = (np.arange(target_height) * height) // target_height
+    columns = (np.arange(target_width) * width) // target_width
+    if height < target_height or width < target_width:
+        return frame[rows][:, columns]
+
+    sums = np.add.reduceat(np.add.reduceat(frame.astype(np.uint32), rows, axis=0), columns, axis=1)
+    counts = np.diff(np.append(rows, height))[:, None] * np.diff(np.append(columns, width))[None, :]
+    return ((sums + counts // 2) // counts).astype(np.uint8)
+
+
+# CRC-8 contribution tables by message length, see _get_crc8_position_table
+_crc8_position_tables = {}
+
+
+def _get_crc8_position_table(np, length):
+    """
+    CRC-8 with initial value 0 is linear: the checksum of a message is the XOR of the checksums of every single byte
+    at its position with all other bytes zero.
+
+    :returns array of shape (length, 256), the checksum of each byte value at each position
+    """
+    table = _crc8_position_tables.get(length)
+    if table is None:
+        crc_table = np.frombuffer(CRC8_TABLE, dtype=np.uint8)
+        table = np.empty((length, 256), dtype=np.uint8)
+        # the last byte is followed by no zeros, every zero byte after a position applies the table once more
+        table[-1] = crc_table
+        for position in range(length - 2, -1, -1):
+            table[position] = crc_table[table[position + 1]]
+        _crc8_position_tables[length] = table
+    return table
+
+
+def crc8_rows(rows):
+    """
+    Vectorised CRC-8 (see joycontrol.utils.crc8) of every row of a 2D uint8 array.
+    :returns uint8 array of checksums
+    """
+    np = _import_numpy()
+    length = rows.shape[1]
+    table = _get_crc8_position_table(np, length)
+    return np.bitwise_xor.reduce(table[np.arange(length), rows], axis=1)
+
+
+def encode_fragments(frame, resolution: IrResolution):
+    """
+    Encodes a grayscale frame into the MCU data of fragment reports.
+
+    :param frame: 2D uint8 array, see to_grayscale
+    :returns list of MCU data bytes, one per fragment
+    """
+    np = _import_numpy()
+    image = downscale(frame, resolution)
+    fragments = resolution.get_fragments()
+
+    data = np.zeros((fragments, MCU_FRAME_SIZE), dtype=np.uint8)
+    data[:, 0] = IR_FRAGMENT_REPORT_ID
+    data[:, 3] = np.arange(fragments)
+    data[:, IR_FRAGMENT_DATA_OFFSET:IR_FRAGMENT_DATA_OFFSET + IR_FRAGMENT_DATA_SIZE] = \
+        image.reshape(fragments, IR_FRAGMENT_DATA_SIZE)
+    data[:, -1] = crc8_rows(data[:, :-1])
+    return [row.tobytes() for row in data]
+
+
+class FrameSource:
+    """
+    Endless stream of grayscale frames.
+    """
+
+    def __init__(self, frames):
+        """
+        :param frames: one of
+            - path of an image file or of a directory of image files (requires Pillow)
+            - 2D NumPy array or PIL image, a static frame
+            - any other iterable of frames, e.g. a list, a generator or a 3D array (frame, height, width).
+              Lists are repeated, the last frame of exhausted iterators is repeated.
+        """
+        np = _import_numpy()
+        if isinstance(frames, (str, os.PathLike)):
+            if os.path.isdir(frames):
+                paths = sorted(os.path.join(frames, name) for name in os.listdir(frames) if not name.startswith('.'))
+            else:
+                paths = [frames]
+            frames = [load_image(path) for path in paths]
+            if not frames:
+                raise ValueError('No IR camera frames found.')
+        elif (isinstance(frames, np.ndarray) and frames.ndim == 2) or hasattr(frames, 'convert'):
+            frames = [frames]
+
+        if isinstance(frames, (list, tuple)):
+            # convert once, the same frame objects are returned on every cycle
+            self._frames = itertools.cycle([to_grayscale(frame) for frame in frames])
+        else:
+            self._frames = iter(frames)
+        self._last = None
+
+    def next_frame(self):
+        """
+        :returns next grayscale frame, see to_grayscale
+        """
+        try:
+            frame = next(self._frames)
+        except StopIteration:
+            if self._last is None:
+                raise ValueError('IR camera frame source is empty.')
+            return self._last
+        if frame is not self._last:
+            frame = to_grayscale(frame)
+        self._last = frame
+        return frame
+
+
+class IrCamera:
+    """
+    Streams frames of a FrameSource as fragments, one per 0x31 input report, and handles acknowledgements and
+    retransmission requests of the console.
+
+    Fragments are send ahead of the last acknowledged fragment up to the window size. If no acknowledgement arrives
+    for the ack timeout, sending continues after the last acknowledged fragment.
+    """
+
+    def __init__(self, window=IR_ACK_WINDOW, ack_timeout=IR_ACK_TIMEOUT):
+        """
+        :param window: fragments send ahead of the last acknowledged fragment
+        :param ack_timeout: ticks without acknowledgement until unacknowledged fragments are send again
+        """
+        self._window = window
+        self._ack_timeout = ack_timeout
+
+        self._source_arg = None
+        self._source = None
+        self._resolution = None
+
+        # fragments of the current frame and the frame they were encoded from
+        self._fragments = None
+        self._frame = None
+        self._position = 0
+        self._acked = -1
+        self._requested = collections.deque()
+        self._ticks_without_ack = 0
+        self._last_fragment = None
+
+        self.frames = 0
+        self.fragments_sent = 0
+        self.retransmissions = 0
+
+    def set_source(self, source):
+        """
+        :param source: FrameSource, anything FrameSource accepts or None to stop streaming
+        """
+        if source is self._source_arg:
+            return
+        self._source_arg = source
+        if source is None or isinstance(source, FrameSource):
+            self._source = source
+        else:
+            self._source = FrameSource(source)
+        self._fragments = None
+
+    def start(self, resolution: IrResolution):
+        """
+        Starts streaming, e.g. after the console set the image transfer IR mode.
+        """
+        logger.info(f'IR camera streaming {resolution.name[1:]}')
+        self._resolution = resolution
+        self._fragments = None
+
+    def stop(self):
+        self._resolution = None
+        self._fragments = None
+
+    def get_resolution(self):
+        return self._resolution
+
+    def acknowledge(self, fragment, requested=None):
+        """
+        :param fragment: number of the acknowledged fragment, fragments are acknowledged in order
+        :param requested: number of a fragment requested again, None if none is requested
+        """
+        if self._fragments is None:
+            return
+        if requested is not None and requested < self._position and requested not in self._requested:
+            self._requested.append(requested)
+        if self._acked < fragment < len(self._fragments):
+            self._acked = fragment
+            self._ticks_without_ack = 0
+
+    def _next_frame(self):
+        frame = self._source.next_frame()
+        if frame is not self._frame or self._fragments is None:
+            self._fragments = encode_fragments(frame, self._resolution)
+            self._frame = frame
+        self._position = 0
+        self._acked = -1
+        self._requested.clear()
+        self._ticks_without_ack = 0
+        self.frames += 1
+
+    def get_fragment(self):
+        """
+        :returns MCU data bytes of the fragment to send in the next 0x31 input report, None if not streaming.
+                 The same object is returned if the previous fragment is repeated.
+        """
+        if self._resolution is None or self._source is None:
+            return None
+
+        if self._fragments is None or self._acked == len(self._fragments) - 1:
+            self._next_frame()
+
+        if self._requested:
+            index = self._requested.popleft()
+            self.retransmissions += 1
+        elif self._position < len(self._fragments) and self._position - self._acked <= self._window:
+            index = self._position
+            self._position += 1
+        else:
+            # waiting for acknowledgements
+            self._ticks_without_ack += 1
+            if self._ticks_without_ack > self._ack_timeout:
+                self.retransmissions += self._position - self._acked - 1
+                self._position = self._acked + 1
+                self._ticks_without_ack = 0
+            return self._last_fragment
+
+        self.fragments_sent += 1
+        self._last_fragment = self._fragments[index]
+        return self._last_fragment
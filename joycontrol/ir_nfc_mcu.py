@@ -1,9 +1,26 @@
 import logging
 from enum import Enum
-from crc8 import crc8
+
+from joycontrol.nfc_library import get_uid
+from joycontrol.utils import crc8
 
 logger = logging.getLogger(__name__)
 
+# size of the IR/NFC MCU data in 0x31 input reports, the last byte is the CRC-8 of the others
+MCU_FRAME_SIZE = 313
+
+# Maximum number of cached frames, exceeded when switching between many NFC tags
+FRAME_CACHE_SIZE = 32
+
+# packet flag of the last packet of a MCU command split into several output reports
+MCU_PACKET_LAST = 0x08
+
+# bytes of a NTAG page
+NTAG_PAGE_SIZE = 4
+
+# header of NTAG write commands: unknown (1), UID length (1), UID (7), unknown (11), followed by the number of chunks
+NTAG_WRITE_HEADER_SIZE = 20
+
 
 class Action(Enum):
     NON = 0
@@ -13,6 +30,8 @@ class Action(Enum):
     READ_TAG = 4
     READ_TAG_2 = 5
     READ_FINISHED = 6
+    WRITE_TAG = 7
+    WRITE_FINISHED = 8
 
 
 class McuState(Enum):
@@ -23,27 +42,75 @@ class McuState(Enum):
     BUSY = 4
 
 
-def copyarray(dest, offset, src):
-    for i in range(len(src)):
-        dest[offset + i] = src[i]
+# actions whose frames contain NFC tag data
+_NFC_ACTIONS = (Action.START_TAG_POLLING, Action.READ_TAG, Action.READ_TAG_2, Action.READ_FINISHED,
+                Action.WRITE_TAG, Action.WRITE_FINISHED)
+
+# actions which advance to another action after their frame was sent once
+_NEXT_ACTION = {
+    Action.READ_TAG: Action.READ_TAG_2,
+    Action.READ_TAG_2: Action.READ_FINISHED,
+}
+
+
+def apply_ntag_write(content, package):
+    """
+    Applies a NTAG write command to a tag dump.
+
+    Command layout: header (see NTAG_WRITE_HEADER_SIZE), number of chunks, chunks of page (1), size (1) and data.
+
+    :param content: current tag dump
+    :param package: data of all packets of the write command
+    :returns new tag dump bytes
+    :raises ValueError: if the command is malformed, addresses another tag or exceeds the tag
+    """
+    if len(package) < NTAG_WRITE_HEADER_SIZE + 1:
+        raise ValueError(f'NTAG write command of {len(package)} bytes is too short')
+
+    uid = bytes(package[2:2 + package[1]])
+    if uid != get_uid(content):
+        raise ValueError(f'NTAG write command addresses tag {uid.hex()}, not {get_uid(content).hex()}')
+
+    tag = bytearray(content)
+    offset = NTAG_WRITE_HEADER_SIZE + 1
+    for _ in range(package[NTAG_WRITE_HEADER_SIZE]):
+        if offset + 2 > len(package):
+            raise ValueError('NTAG write command is truncated')
+        page, size = package[offset], package[offset + 1]
+        data = package[offset + 2:offset + 2 + size]
+        start = page * NTAG_PAGE_SIZE
+        if len(data) != size:
+            raise ValueError('NTAG write command is truncated')
+        if start + size > len(tag):
+            raise ValueError(f'NTAG write of {size} bytes to page {page} exceeds the tag')
+        tag[start:start + size] = data
+        offset += 2 + size
+
+    return bytes(tag)
 
 
 class IrNfcMcu:
     """
-    TODO: cleanup
+    Emulates the IR/NFC MCU data of 0x31 input reports.
+
+    Frames are immutable, CRC-stamped bytes cached by (action, state, NFC content). They are only rebuilt if the
+    action, state or NFC content changes, so __bytes__ returns the same object as long as nothing changed.
     """
 
     def __init__(self):
         self._fw_major = [0, 3]
         self._fw_minor = [0, 5]
 
-        self._bytes = [0] * 313
-
         self._action = Action.NON
         self._state = McuState.NOT_INITIALIZED
 
         self._nfc_content = None
 
+        self._frames = {}
+        # key of the current frame, None if the frame needs to be looked up again
+        self._frame_key = None
+        self._frame = bytes(MCU_FRAME_SIZE)
+
     def get_fw_major(self):
         return self._fw_major
 
@@ -51,13 +118,17 @@ class IrNfcMcu:
         return self._fw_minor
 
     def set_action(self, v):
-        self._action = v
+        if v != self._action:
+            self._action = v
+            self._frame_key = None
 
     def get_action(self):
         return self._action
 
     def set_state(self, v):
-        self._state = v
+        if v != self._state:
+            self._state = v
+            self._frame_key = None
 
     def get_state(self):
         return self._state
@@ -71,85 +142,110 @@ class IrNfcMcu:
             return 1
         elif self.get_state() == McuState.STAND_BY:
             return 1
+        elif self.get_state() == McuState.IRC:
+            return 5
         else:
             return 0
 
-    def update_status(self):
-        self._bytes[0] = 1
-        self._bytes[1] = 0
-        self._bytes[2] = 0
-        self._bytes[3] = self._fw_major[0]
-        self._bytes[4] = self._fw_major[1]
-        self._bytes[5] = self._fw_minor[0]
-        self._bytes[6] = self._fw_minor[1]
-        self._bytes[7] = self._get_state_byte()
-
-    def update_nfc_report(self):
-        self._bytes = [0] * 313
-        if self.get_action() == Action.REQUEST_STATUS:
-            self.update_status()
-        elif self.get_action() == Action.NON:
-            self._bytes[0] = 0xff
-        elif self.get_action() == Action.START_TAG_DISCOVERY:
-            self._bytes[0] = 0x2a
-            self._bytes[1] = 0
-            self._bytes[2] = 5
-            self._bytes[3] = 0
-            self._bytes[4] = 0
-            self._bytes[5] = 9
-            self._bytes[6] = 0x31
-            self._bytes[7] = 0
-        elif self.get_action() == Action.START_TAG_POLLING:
-            self._bytes[0] = 0x2a
-            self._bytes[1] = 0
-            self._bytes[2] = 5
-            self._bytes[3] = 0
-            self._bytes[4] = 0
+    def _build_status(self, frame):
+        frame[0:8] = bytes((1, 0, 0, *self._fw_major, *self._fw_minor, self._get_state_byte()))
+
+    def _build_frame(self, action):
+        """
+        :returns new CRC-stamped frame of the given action
+        """
+        frame = bytearray(MCU_FRAME_SIZE)
+        content = self._nfc_content
+        if content is None and action in _NFC_ACTIONS:
+            # the tag was removed, e.g. during a read, report that no tag is detected
+            action = Action.START_TAG_POLLING
+        # tag UID, 7 bytes without the check byte, fixed width so frame offsets do not change
+        uid = (content[0:3] + content[4:8]).ljust(7, b'\x00') if content is not None else None
+
+        if action == Action.REQUEST_STATUS:
+            self._build_status(frame)
+        elif action == Action.NON:
+            frame[0] = 0xff
+        elif action == Action.START_TAG_DISCOVERY:
+            frame[0:8] = b'\x2a\x00\x05\x00\x00\x09\x31\x00'
+        elif action in (Action.START_TAG_POLLING, Action.WRITE_TAG):
+            # the tag stays detected while write packets are received
+            frame[0:5] = b'\x2a\x00\x05\x00\x00'
             if self._nfc_content is not None:
-                data = [0x09, 0x31, 0x09, 0x00, 0x00, 0x00, 0x01, 0x01, 0x02, 0x00, 0x07]
-                copyarray(self._bytes, 5, data)
-                copyarray(self._bytes, 5 + len(data), self._nfc_content[0:3])
-                copyarray(self._bytes, 5 + len(data) + 3, self._nfc_content[4:8])
+                data = bytes((0x09, 0x31, 0x09, 0x00, 0x00, 0x00, 0x01, 0x01, 0x02, 0x00, 0x07))
+                frame[5:5 + len(data)] = data
+                frame[16:23] = uid
             else:
                 logger.info('nfc content is none')
-                self._bytes[5] = 9
-                self._bytes[6] = 0x31
-                self._bytes[7] = 0
-        elif self.get_action() in (Action.READ_TAG, Action.READ_TAG_2):
-            self._bytes[0] = 0x3a
-            self._bytes[1] = 0
-            self._bytes[2] = 7
-            if self.get_action() == Action.READ_TAG:
-                data1 = bytes.fromhex('010001310200000001020007')
-                copyarray(self._bytes, 3, data1)
-                copyarray(self._bytes, 3 + len(data1), self._nfc_content[0:3])
-                copyarray(self._bytes, 3 + len(data1) + 3, self._nfc_content[4:8])
-                data2 = bytes.fromhex('000000007DFDF0793651ABD7466E39C191BABEB856CEEDF1CE44CC75EAFB27094D087AE803003B3C7778860000')
-                copyarray(self._bytes, 3 + len(data1) + 3 + 4, data2)
-                copyarray(self._bytes, 3 + len(data1) + 3 + 4 + len(data2), self._nfc_content[0:245])
-                self.set_action(Action.READ_TAG_2)
-            else:
-                data = bytes.fromhex('02000927')
-                copyarray(self._bytes, 3, data)
-                copyarray(self._bytes, 3 + len(data), self._nfc_content[245:540])
-                self.set_action(Action.READ_FINISHED)
-        elif self.get_action() == Action.READ_FINISHED:
-            self._bytes[0] = 0x2a
-            self._bytes[1] = 0
-            self._bytes[2] = 5
-            self._bytes[3] = 0
-            self._bytes[4] = 0
-            data = bytes.fromhex('0931040000000101020007')
-            copyarray(self._bytes, 5, data)
-            copyarray(self._bytes, 5 + len(data), self._nfc_content[0:3])
-            copyarray(self._bytes, 5 + len(data) + 3, self._nfc_content[4:8])
-
-        crc = crc8()
-        crc.update(bytes(self._bytes[:-1]))
-        self._bytes[-1] = ord(crc.digest())
+                frame[5:8] = b'\x09\x31\x00'
+        elif action == Action.READ_TAG:
+            frame[0:3] = b'\x3a\x00\x07'
+            data1 = bytes.fromhex('010001310200000001020007')
+            frame[3:3 + len(data1)] = data1
+            frame[15:22] = uid
+            data2 = bytes.fromhex('000000007DFDF0793651ABD7466E39C191BABEB856CEEDF1CE44CC75EAFB27094D087AE803003B3C7778860000')
+            frame[22:22 + len(data2)] = data2
+            tag = content[0:245]
+            frame[22 + len(data2):22 + len(data2) + len(tag)] = tag
+        elif action == Action.READ_TAG_2:
+            frame[0:7] = b'\x3a\x00\x07\x02\x00\x09\x27'
+            tag = content[245:540]
+            frame[7:7 + len(tag)] = tag
+        elif action in (Action.READ_FINISHED, Action.WRITE_FINISHED):
+            frame[0:5] = b'\x2a\x00\x05\x00\x00'
+            # NFC state 0x04: read finished, 0x05: write finished
+            nfc_state = 0x04 if action == Action.READ_FINISHED else 0x05
+            data = bytes((0x09, 0x31, nfc_state, 0x00, 0x00, 0x00, 0x01, 0x01, 0x02, 0x00, 0x07))
+            frame[5:5 + len(data)] = data
+            frame[16:23] = uid
+
+        frame[-1] = crc8(memoryview(frame)[:-1])
+        return bytes(frame)
+
+    def _get_frame(self, action):
+        key = (action,
+               self._state if action == Action.REQUEST_STATUS else None,
+               self._nfc_content if action in _NFC_ACTIONS else None)
+        frame = self._frames.get(key)
+        if frame is None:
+            if len(self._frames) >= FRAME_CACHE_SIZE:
+                self._frames.clear()
+            frame = self._frames[key] = self._build_frame(action)
+        return key, frame
+
+    def update_status(self):
+        """
+        Sets the current frame to the MCU status.
+        """
+        _, self._frame = self._get_frame(Action.REQUEST_STATUS)
+        # the status does not necessarily belong to the current action, look it up again on the next update
+        self._frame_key = None
+
+    def update_nfc_report(self):
+        """
+        Updates the current frame to the current action. Reading a tag takes two frames, the action advances after
+        each of them.
+        """
+        if self._frame_key is not None:
+            return
+
+        action = self._action
+        self._frame_key, self._frame = self._get_frame(action)
+        if action in _NEXT_ACTION:
+            self.set_action(_NEXT_ACTION[action])
 
     def set_nfc(self, nfc_content):
+        if nfc_content is self._nfc_content:
+            return
+        if nfc_content is not None and not isinstance(nfc_content, bytes):
+            nfc_content = bytes(nfc_content)
+            if nfc_content == self._nfc_content:
+                return
+
+        # frames are keyed by the content, the hash of bytes objects is only calculated once
         self._nfc_content = nfc_content
+        if self._action in _NFC_ACTIONS:
+            self._frame_key = None
 
     def __bytes__(self):
-        return bytes(self._bytes)
+        return self._frame
@@ -0,0 +1,74 @@
+import asyncio
+import logging
+import socket
+
+from joycontrol.capture import CaptureWriter
+from joycontrol.transport import L2CAP_Transport
+
+logger = logging.getLogger(__name__)
+
+# Made up Bluetooth addresses of the emulated controller and the simulated console
+CONTROLLER_ADDRESS = '7C:BB:8A:00:00:01'
+CONSOLE_ADDRESS = '98:B6:E9:00:00:01'
+
+
+class LoopbackTransport(L2CAP_Transport):
+    """
+    L2CAP_Transport over local sockets (unix socket pairs) instead of Bluetooth L2CAP sockets.
+
+    Reports keep their boundaries (SOCK_SEQPACKET), so the controller side behaves exactly as with a real connection.
+    The Bluetooth addresses reported by get_extra_info are made up.
+    """
+    def __init__(self, loop, protocol, itr_sock, ctr_sock, read_buffer_size, address=CONTROLLER_ADDRESS,
+                 peer_address=CONSOLE_ADDRESS, itr_psm=19, capture: CaptureWriter = None) -> None:
+        """
+        :param address: Bluetooth address of the emulated controller
+        :param peer_address: Bluetooth address of the console
+        :param itr_psm: hid interrupt channel port reported by get_extra_info
+        """
+        super().__init__(loop, protocol, itr_sock, ctr_sock, read_buffer_size, capture=capture)
+
+        self._extra_info['sockname'] = (address, itr_psm)
+        self._extra_info['peername'] = (peer_address, itr_psm)
+
+
+def create_socket_pairs():
+    """
+    :returns controller side (interrupt, control) and console side (interrupt, control) sockets, all non blocking
+    """
+    itr_sock, console_itr = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    ctl_sock, console_ctl = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    for sock in (itr_sock, console_itr, ctl_sock, console_ctl):
+        sock.setblocking(False)
+    return (itr_sock, ctl_sock), (console_itr, console_ctl)
+
+
+async def create_loopback_server(protocol_factory, address=CONTROLLER_ADDRESS, console_address=CONSOLE_ADDRESS,
+                                 capture_file=None):
+    """
+    Counterpart of joycontrol.server.create_hid_server without Bluetooth: The controller is connected to local sockets,
+    the console side of the connection can be driven by a joycontrol.simulated_console.SimulatedConsole.
+
+    Unlike the Switch, the simulated console starts the handshake on its own, so no empty input reports are send.
+
+    :param protocol_factory: Factory function returning a ControllerProtocol instance
+    :param address: Bluetooth address of the emulated controller
+    :param console_address: Bluetooth address of the console
+    :param capture_file: opened file to log incoming and outgoing messages
+    :returns transport for input reports, protocol which handles incoming output reports and the console side
+             (interrupt, control) sockets
+    """
+    protocol = protocol_factory()
+
+    (itr_sock, ctl_sock), console_socks = create_socket_pairs()
+
+    capture = None
+    if capture_file is not None:
+        capture = CaptureWriter(capture_file, controller=protocol.controller, address=address)
+    transport = LoopbackTransport(asyncio.get_event_loop(), protocol, itr_sock, ctl_sock, 50, address=address,
+                                  peer_address=console_address, capture=capture)
+    protocol.connection_made(transport)
+
+    logger.info(f'Loopback connection established with {console_address}')
+
+    return transport, protocol, console_socks
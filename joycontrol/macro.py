@@ -0,0 +1,263 @@
+import collections
+import logging
+
+from joycontrol.controller_state import ControllerState, ButtonState
+
+logger = logging.getLogger(__name__)
+
+"""
+Compiler of macros (sequences of button presses, holds, stick moves and waits) to per frame state timelines.
+
+A timeline holds the 9 status bytes (3 button bytes, 3 bytes per stick) of every input report of the macro, so
+playback only copies one row per report, see ControllerProtocol.play_timeline.
+"""
+
+# button and stick status bytes per frame
+TIMELINE_ROW_SIZE = 9
+
+# stick directions which can be set using the stick calibration
+STICK_DIRECTIONS = ('center', 'up', 'down', 'left', 'right')
+
+_NO_STICK = bytes(3)
+
+
+def _import_numpy():
+    try:
+        import numpy
+    except ImportError as err:
+        raise ImportError('Timeline arrays require NumPy, install it using "pip install joycontrol[analysis]".') \
+            from err
+    return numpy
+
+
+class Timeline:
+    """
+    Immutable button and stick status bytes of consecutive input reports, one row of TIMELINE_ROW_SIZE bytes per
+    frame.
+    """
+
+    def __init__(self, data=b''):
+        """
+        :param data: concatenated rows
+        """
+        data = bytes(data)
+        if len(data) % TIMELINE_ROW_SIZE != 0:
+            raise ValueError(f'Timeline data size {len(data)} is not a multiple of {TIMELINE_ROW_SIZE}.')
+        self._data = data
+
+    def get_data(self):
+        """
+        :returns concatenated rows, row i is data[i * TIMELINE_ROW_SIZE:(i + 1) * TIMELINE_ROW_SIZE]
+        """
+        return self._data
+
+    def get_row(self, frame):
+        """
+        :returns status bytes of the frame
+        """
+        if not 0 <= frame < len(self):
+            raise IndexError(f'Frame {frame} is not in the timeline of {len(self)} frames.')
+        return self._data[frame * TIMELINE_ROW_SIZE:(frame + 1) * TIMELINE_ROW_SIZE]
+
+    def get_buttons(self, frame):
+        """
+        :returns mask of the pushed buttons in the frame, see ButtonState.get_mask
+        """
+        return int.from_bytes(self.get_row(frame)[0:3], 'little')
+
+    def as_array(self):
+        """
+        :returns read only NumPy uint8 array of shape (frames, TIMELINE_ROW_SIZE)
+        """
+        np = _import_numpy()
+        return np.frombuffer(self._data, dtype=np.uint8).reshape(-1, TIMELINE_ROW_SIZE)
+
+    @staticmethod
+    def from_array(array):
+        """
+        :param array: uint8 array-like of shape (frames, TIMELINE_ROW_SIZE)
+        """
+        np = _import_numpy()
+        array = np.asarray(array)
+        if array.ndim != 2 or array.shape[1] != TIMELINE_ROW_SIZE:
+            raise ValueError(f'Timeline array shape {array.shape} is not (frames, {TIMELINE_ROW_SIZE}).')
+        return Timeline(array.astype(np.uint8, copy=False).tobytes())
+
+    def __len__(self):
+        return len(self._data) // TIMELINE_ROW_SIZE
+
+    def __add__(self, other):
+        if not isinstance(other, Timeline):
+            return NotImplemented
+        return Timeline(self._data + other._data)
+
+    def __mul__(self, count):
+        """
+        :returns timeline repeating this timeline count times
+        """
+        if not isinstance(count, int):
+            return NotImplemented
+        return Timeline(self._data * max(count, 0))
+
+    def __eq__(self, other):
+        return isinstance(other, Timeline) and self._data == other._data
+
+    def __hash__(self):
+        return hash(self._data)
+
+    def __repr__(self):
+        return f'<Timeline of {len(self)} frames>'
+
+
+MacroStep = collections.namedtuple('MacroStep', ['kind', 'args'])
+MacroStep.__doc__ = """
+Step of a macro.
+kind: 'hold', 'release', 'stick' or 'wait'
+"""
+
+
+class Macro:
+    """
+    Builder of a macro description. All methods return the macro, so calls can be chained:
+
+        macro = Macro().press('a', frames=3).wait(10).stick('l', 'up').wait(30).stick('l', 'center')
+        timeline = macro.compile(controller_state)
+
+    Holds, releases and stick moves change the state of the following frames, only waits advance time.
+    """
+
+    def __init__(self, steps=()):
+        self._steps = [MacroStep(*step) for step in steps]
+
+    def get_steps(self):
+        return list(self._steps)
+
+    def hold(self, *buttons):
+        """
+        Pushes buttons until they are released.
+        :param buttons: button names or masks, see ButtonState.get_mask
+        """
+        self._steps.append(MacroStep('hold', buttons))
+        return self
+
+    def release(self, *buttons):
+        """
+        Releases buttons. Releases all buttons if none are given.
+        """
+        self._steps.append(MacroStep('release', buttons))
+        return self
+
+    def press(self, buttons, frames=1):
+        """
+        Pushes buttons for the given number of frames and releases them afterwards.
+        Two presses of the same button need a wait between them, otherwise the console sees one long press.
+        :param buttons: button name, iterable of button names or mask
+        """
+        if frames < 1:
+            raise ValueError('Buttons must be pushed for at least one frame.')
+        if isinstance(buttons, (str, int)):
+            buttons = (buttons,)
+        return self.hold(*buttons).wait(frames).release(*buttons)
+
+    def stick(self, side, position):
+        """
+        Moves a stick.
+        :param side: 'l' or 'r'
+        :param position: one of STICK_DIRECTIONS (requires stick calibration) or (horizontal, vertical) tuple of
+                         raw 12 bit values
+        """
+        if side not in ('l', 'r'):
+            raise ValueError(f'Unknown stick "{side}", must be "l" or "r".')
+        if isinstance(position, str):
+            if position not in STICK_DIRECTIONS:
+                raise ValueError(f'Unknown stick direction "{position}", must be one of {STICK_DIRECTIONS}.')
+        else:
+            position = tuple(position)
+            if len(position) != 2:
+                raise ValueError('Stick position must be a direction or a (horizontal, vertical) tuple.')
+        self._steps.append(MacroStep('stick', (side, position)))
+        return self
+
+    def wait(self, frames):
+        """
+        Keeps the current state for the given number of frames.
+        """
+        if frames < 0:
+            raise ValueError('Frames must not be negative.')
+        self._steps.append(MacroStep('wait', (frames,)))
+        return self
+
+    def extend(self, macro):
+        """
+        Appends the steps of another macro.
+        """
+        self._steps.extend(macro.get_steps())
+        return self
+
+    def compile(self, controller_state: ControllerState):
+        """
+        Compiles the macro to a timeline.
+
+        The timeline starts with all buttons released and the sticks at their current positions of the controller
+        state. State changes after the last wait are contained in one final frame.
+
+        :param controller_state: state of the controller playing the timeline, provides the available buttons and
+                                 the stick calibration
+        :returns Timeline
+        """
+        button_state = ButtonState(controller_state.get_controller())
+        sticks = {}
+        for side, stick in (('l', controller_state.l_stick_state), ('r', controller_state.r_stick_state)):
+            sticks[side] = None if stick is None else stick.copy()
+
+        def get_row():
+            return bytes(button_state) + \
+                   (bytes(sticks['l']) if sticks['l'] is not None else _NO_STICK) + \
+                   (bytes(sticks['r']) if sticks['r'] is not None else _NO_STICK)
+
+        chunks = []
+        # True if the state changed after the last wait
+        changed = False
+        for step in self._steps:
+            if step.kind == 'wait':
+                frames, = step.args
+                if frames > 0:
+                    chunks.append(get_row() * frames)
+                    changed = False
+                continue
+
+            if step.kind == 'hold':
+                button_state.press_many(self._to_mask(button_state, step.args))
+            elif step.kind == 'release':
+                if step.args:
+                    button_state.release_many(self._to_mask(button_state, step.args))
+                else:
+                    button_state.clear()
+            elif step.kind == 'stick':
+                side, position = step.args
+                stick = sticks[side]
+                if stick is None:
+                    raise ValueError(f'{controller_state.get_controller().device_name()} has no {side} stick.')
+                if isinstance(position, str):
+                    getattr(stick, f'set_{position}')()
+                else:
+                    stick.set_h(position[0])
+                    stick.set_v(position[1])
+            else:
+                raise ValueError(f'Unknown macro step "{step.kind}".')
+            changed = True
+
+        if changed:
+            chunks.append(get_row())
+
+        return Timeline(b''.join(chunks))
+
+    @staticmethod
+    def _to_mask(button_state, buttons):
+        mask = 0
+        for button in buttons:
+            mask |= button_state._to_mask(button if isinstance(button, int) else (button,))
+        return mask
+
+    def __len__(self):
+        return len(self._steps)
@@ -0,0 +1,575 @@
+import enum
+import logging
+import time
+
+from joycontrol.controller_state import ControllerState, ButtonState
+from joycontrol.input_mixer import InputLayer
+from joycontrol.macro import STICK_DIRECTIONS
+
+logger = logging.getLogger(__name__)
+
+"""
+Macro scripts compiled to bytecode, executed by a VM which is stepped once per input report.
+
+Script syntax, one statement per line, "#" starts a comment:
+
+    press <buttons> [<duration>]        push buttons for the duration (default 1 frame) and release them
+    hold <buttons>                      push buttons until they are released
+    release [<buttons>]                 release buttons, all if none are given
+    wait <duration>                     keep the state for the duration
+    stick <l|r> <position>              move a stick
+    ramp <l|r> <position> <duration>    move a stick linearly over the duration, runs while the script continues
+    wait_until <condition>              wait until the condition is true
+    repeat <count> ... end              repeat the statements count times
+    loop ... end                        repeat the statements until the script is stopped
+    while <condition> ... end
+    if <condition> ... [else ...] end
+    stop                                end the script
+
+<buttons>:   comma separated button names, e.g. "a,b"
+<duration>:  number of frames (input reports), or time with a "s" or "ms" suffix. Timed durations end with the first
+             input report at or after the time, independent of the report rate. Consecutive timed durations are
+             measured from the end of the previous one, so late reports do not add up.
+<position>:  center, up, down, left, right (using the stick calibration) or raw "<horizontal> <vertical>" values
+<condition>: [not] lights [<value>]   player lights set by the console (optionally equal to the raw lights byte)
+             [not] rumble             console sends a non zero rumble amplitude
+
+Example, mashing A until the console rumbles:
+
+    wait_until lights
+    while not rumble
+        press a 3
+        wait 100ms
+    end
+"""
+
+# Maximum number of instructions executed for one frame, protects the report loop against loops without waits
+MAX_INSTRUCTIONS_PER_FRAME = 10000
+
+
+class Op(enum.IntEnum):
+    """
+    Instructions and their operands.
+    """
+    # end the script
+    END = 0
+    # buttons |= mask
+    HOLD = 1
+    # buttons &= ~mask
+    RELEASE = 2
+    # side, horizontal, vertical
+    STICK = 3
+    # side, horizontal, vertical, frames
+    RAMP = 4
+    # frames
+    WAIT = 5
+    # condition, argument, negate - waits until the condition holds
+    WAIT_UNTIL = 6
+    # target
+    JUMP = 7
+    # condition, argument, negate, target - jumps if the condition does not hold
+    JUMP_UNLESS = 8
+    # counter, count
+    SET_COUNTER = 9
+    # counter, target - jumps if the counter is zero, decrements it otherwise
+    COUNT_DOWN = 10
+    # microseconds, at least one frame
+    WAIT_TIME = 11
+    # side, horizontal, vertical, microseconds
+    RAMP_TIME = 12
+
+
+# number of operands by instruction
+OPERANDS = {
+    Op.END: 0,
+    Op.HOLD: 1,
+    Op.RELEASE: 1,
+    Op.STICK: 3,
+    Op.RAMP: 4,
+    Op.WAIT: 1,
+    Op.WAIT_UNTIL: 3,
+    Op.JUMP: 1,
+    Op.JUMP_UNLESS: 4,
+    Op.SET_COUNTER: 2,
+    Op.COUNT_DOWN: 2,
+    Op.WAIT_TIME: 1,
+    Op.RAMP_TIME: 4,
+}
+
+
+class Condition(enum.IntEnum):
+    # player lights are set, argument: raw lights byte or -1 for any
+    LIGHTS = 0
+    # console sends a non zero rumble amplitude
+    RUMBLE = 1
+
+
+_STICK_SIDES = {'l': 0, 'r': 1}
+
+# plain int instruction values, compared in the VM loop
+_END, _HOLD, _RELEASE, _STICK, _RAMP, _WAIT, _WAIT_UNTIL, _JUMP, _JUMP_UNLESS, _SET_COUNTER, _COUNT_DOWN, \
+    _WAIT_TIME, _RAMP_TIME = (op.value for op in Op)
+_LIGHTS = Condition.LIGHTS.value
+
+
+class Program:
+    """
+    Compiled script: flat list of instructions followed by their operands.
+    """
+
+    def __init__(self, code, counters=0, source=None):
+        """
+        :param code: list of ints
+        :param counters: number of loop counters used by the code
+        :param source: script source, for debugging
+        """
+        self.code = list(code)
+        self.counters = counters
+        self.source = source
+
+    def disassemble(self):
+        """
+        :returns list of (address, instruction, operands) tuples
+        """
+        result = []
+        address = 0
+        while address < len(self.code):
+            op = Op(self.code[address])
+            size = OPERANDS[op]
+            result.append((address, op, tuple(self.code[address + 1:address + 1 + size])))
+            address += 1 + size
+        return result
+
+    def __len__(self):
+        return len(self.code)
+
+
+class _Compiler:
+    def __init__(self, controller_state: ControllerState):
+        self._button_state = ButtonState(controller_state.get_controller())
+        self._sticks = {'l': controller_state.l_stick_state, 'r': controller_state.r_stick_state}
+        self._device_name = controller_state.get_controller().device_name()
+
+        self.code = []
+        self.counters = 0
+        # stack of (statement, line number, data) of the open blocks
+        self._blocks = []
+        self._line = 0
+
+    def _error(self, message):
+        return ValueError(f'Line {self._line}: {message}')
+
+    def _emit(self, op, *operands):
+        """
+        :returns address of the instruction
+        """
+        address = len(self.code)
+        self.code.append(int(op))
+        self.code.extend(int(operand) for operand in operands)
+        return address
+
+    def _parse_int(self, token):
+        try:
+            return int(token, 0)
+        except ValueError:
+            raise self._error(f'"{token}" is not a number.') from None
+
+    def _parse_duration(self, token):
+        """
+        :returns duration and True if it is timed (microseconds), False if it is a number of frames
+        """
+        try:
+            if token.endswith('ms'):
+                duration, timed = round(float(token[:-2]) * 1000), True
+            elif token.endswith('s'):
+                duration, timed = round(float(token[:-1]) * 1000000), True
+            else:
+                duration, timed = int(token, 0), False
+        except ValueError:
+            raise self._error(f'"{token}" is not a duration.') from None
+        if duration < 0:
+            raise self._error('Durations must not be negative.')
+        return duration, timed
+
+    def _emit_wait(self, duration, timed):
+        self._emit(Op.WAIT_TIME if timed and duration else Op.WAIT, duration)
+
+    def _parse_buttons(self, token):
+        try:
+            return self._button_state.get_mask(*token.split(','))
+        except ValueError as err:
+            raise self._error(err) from None
+
+    def _parse_stick(self, args):
+        """
+        :returns side, horizontal, vertical and the remaining arguments
+        """
+        if not args or args[0] not in _STICK_SIDES:
+            raise self._error('Stick must be "l" or "r".')
+        stick = self._sticks[args[0]]
+        if stick is None:
+            raise self._error(f'{self._device_name} has no {args[0]} stick.')
+        if len(args) >= 2 and args[1] in STICK_DIRECTIONS:
+            position = stick.copy()
+            try:
+                getattr(position, f'set_{args[1]}')()
+            except ValueError as err:
+                raise self._error(err) from None
+            return _STICK_SIDES[args[0]], position.get_h(), position.get_v(), args[2:]
+        if len(args) >= 3:
+            h, v = self._parse_int(args[1]), self._parse_int(args[2])
+            if not (0 <= h < 0x1000 and 0 <= v < 0x1000):
+                raise self._error(f'Stick values must be in [0,{0x1000})')
+            return _STICK_SIDES[args[0]], h, v, args[3:]
+        raise self._error(f'Stick position must be one of {STICK_DIRECTIONS} or "<horizontal> <vertical>".')
+
+    def _parse_condition(self, args):
+        """
+        :returns condition, argument, negate
+        """
+        negate = 0
+        if args and args[0] == 'not':
+            negate = 1
+            args = args[1:]
+        if args and args[0] == 'lights' and len(args) <= 2:
+            return Condition.LIGHTS, self._parse_int(args[1]) if len(args) == 2 else -1, negate
+        if args == ['rumble']:
+            return Condition.RUMBLE, 0, negate
+        raise self._error(f'Unknown condition "{" ".join(args)}".')
+
+    @staticmethod
+    def _check_args(args, minimum, maximum):
+        return minimum <= len(args) <= maximum
+
+    def statement(self, statement, args):
+        if statement == 'press':
+            if not self._check_args(args, 1, 2):
+                raise self._error('Usage: press <buttons> [<duration>]')
+            mask = self._parse_buttons(args[0])
+            duration, timed = self._parse_duration(args[1]) if len(args) == 2 else (1, False)
+            if duration < 1:
+                raise self._error('Buttons must be pushed for at least one frame.')
+            self._emit(Op.HOLD, mask)
+            self._emit_wait(duration, timed)
+            self._emit(Op.RELEASE, mask)
+        elif statement == 'hold':
+            if not self._check_args(args, 1, 1):
+                raise self._error('Usage: hold <buttons>')
+            self._emit(Op.HOLD, self._parse_buttons(args[0]))
+        elif statement == 'release':
+            if not self._check_args(args, 0, 1):
+                raise self._error('Usage: release [<buttons>]')
+            self._emit(Op.RELEASE, self._parse_buttons(args[0]) if args else 0xFFFFFF)
+        elif statement == 'wait':
+            if not self._check_args(args, 1, 1):
+                raise self._error('Usage: wait <duration>')
+            self._emit_wait(*self._parse_duration(args[0]))
+        elif statement == 'stick':
+            side, h, v, rest = self._parse_stick(args)
+            if rest:
+                raise self._error('Usage: stick <l|r> <position>')
+            self._emit(Op.STICK, side, h, v)
+        elif statement == 'ramp':
+            side, h, v, rest = self._parse_stick(args)
+            if len(rest) != 1:
+                raise self._error('Usage: ramp <l|r> <position> <duration>')
+            duration, timed = self._parse_duration(rest[0])
+            self._emit(Op.RAMP_TIME if timed and duration else Op.RAMP, side, h, v, duration)
+        elif statement == 'wait_until':
+            self._emit(Op.WAIT_UNTIL, *self._parse_condition(args))
+        elif statement == 'stop':
+            self._emit(Op.END)
+        elif statement == 'repeat':
+            if not self._check_args(args, 1, 1):
+                raise self._error('Usage: repeat <count>')
+            count = self._parse_int(args[0])
+            if count < 0:
+                raise self._error('Repeat count must not be negative.')
+            counter = self.counters
+            self.counters += 1
+            self._emit(Op.SET_COUNTER, counter, count)
+            start = self._emit(Op.COUNT_DOWN, counter, -1)
+            self._blocks.append(('repeat', self._line, (start, start + 2)))
+        elif statement == 'loop':
+            if args:
+                raise self._error('Usage: loop')
+            self._blocks.append(('loop', self._line, (len(self.code), None)))
+        elif statement == 'while':
+            start = len(self.code)
+            jump = self._emit(Op.JUMP_UNLESS, *self._parse_condition(args), -1)
+            self._blocks.append(('while', self._line, (start, jump + 4)))
+        elif statement == 'if':
+            jump = self._emit(Op.JUMP_UNLESS, *self._parse_condition(args), -1)
+            self._blocks.append(('if', self._line, (jump + 4,)))
+        elif statement == 'else':
+            if args or not self._blocks or self._blocks[-1][0] != 'if':
+                raise self._error('"else" without "if".')
+            _, line, (target_address,) = self._blocks.pop()
+            jump = self._emit(Op.JUMP, -1)
+            self.code[target_address] = len(self.code)
+            self._blocks.append(('else', line, (jump + 1,)))
+        elif statement == 'end':
+            if args or not self._blocks:
+                raise self._error('"end" without block.')
+            self._end_block(*self._blocks.pop())
+        else:
+            raise self._error(f'Unknown statement "{statement}".')
+
+    def _end_block(self, block, line, data):
+        if block in ('repeat', 'loop', 'while'):
+            start, target_address = data
+            self._emit(Op.JUMP, start)
+            if target_address is not None:
+                self.code[target_address] = len(self.code)
+        else:
+            # if or else
+            target_address, = data
+            self.code[target_address] = len(self.code)
+
+    def compile(self, source):
+        for self._line, line in enumerate(source.splitlines(), start=1):
+            tokens = line.split('#', 1)[0].split()
+            if tokens:
+                self.statement(tokens[0].lower(), tokens[1:])
+        if self._blocks:
+            block, line, _ = self._blocks[-1]
+            raise ValueError(f'Line {line}: "{block}" without "end".')
+        self._emit(Op.END)
+        return Program(self.code, counters=self.counters, source=source)
+
+
+def compile_script(source, controller_state: ControllerState):
+    """
+    Compiles a macro script, see the module documentation for the syntax.
+
+    :param source: script text
+    :param controller_state: state of the controller running the script, provides the available buttons and the
+                             stick calibration
+    :returns Program
+    """
+    return _Compiler(controller_state).compile(source)
+
+
+def is_rumble_active(rumble_data):
+    """
+    :param rumble_data: 8 rumble bytes of an output report, 4 per Joy-Con
+    :returns True if the high or low frequency amplitude of any side is not zero.
+             The amplitude bits of idle data (00 01 40 40) and all zero data are zero.
+    """
+    for side in (0, 4):
+        if rumble_data[side + 1] & 0xFE or (rumble_data[side + 3] & 0x7F) > 0x40 or \
+                rumble_data[side + 2] & 0x80:
+            return True
+    return False
+
+
+class MacroVM:
+    """
+    Executes a program once per input report, see step.
+
+    Buttons and sticks are written to an input layer, see joycontrol.input_mixer. Sticks are only controlled by the
+    layer after the program moved them.
+    """
+
+    def __init__(self, program: Program, controller_state: ControllerState, events, layer: InputLayer = None,
+                 clock=time.monotonic):
+        """
+        :param program: compiled script
+        :param controller_state: stick positions before the program moves them
+        :param events: console events used by conditions, an object providing get_player_lights() (None if not set)
+                       and is_rumbling(), e.g. the ControllerProtocol
+        :param layer: layer to write to, defaults to a new layer which is not added to a mixer
+        :param clock: callable returning the time in seconds used by timed durations, e.g. loop.time
+        """
+        self._code = program.code
+        self._events = events
+        self._clock = clock
+        self._controller_state = controller_state
+        self._layer = layer if layer is not None else InputLayer('script', controller_state=controller_state)
+
+        self._pc = 0
+        # remaining frames of the current wait
+        self._wait = 0
+        # end of the current or last timed wait, None if the program waited otherwise since then
+        self._deadline = None
+        self._timed_wait = False
+        # [start h, start v, target h, target v, elapsed, duration, start time] of the active stick ramps.
+        # Frame ramps have no start time and count elapsed frames, timed ramps count microseconds.
+        self._ramps = [None, None]
+        self._counters = [0] * program.counters
+        # True if the state changed after the last send frame
+        self._changed = False
+        self._finished = False
+
+        # statistics
+        self.frames = 0
+        self.instructions = 0
+
+    def get_layer(self):
+        return self._layer
+
+    def _get_stick(self, side):
+        """
+        :returns current position of the stick, (0, 0) if the controller has no such stick
+        """
+        layer = self._layer
+        if layer._stick_set[side]:
+            return layer._stick_h[side], layer._stick_v[side]
+        stick = self._controller_state.l_stick_state if side == 0 else self._controller_state.r_stick_state
+        if stick is None:
+            return 0, 0
+        return stick.get_h(), stick.get_v()
+
+    def _check(self, condition, argument, negate):
+        if condition == _LIGHTS:
+            lights = self._events.get_player_lights()
+            result = lights is not None and (argument < 0 or lights == argument)
+        else:
+            result = self._events.is_rumbling()
+        return result != bool(negate)
+
+    def _update_ramps(self):
+        for side in (0, 1):
+            ramp = self._ramps[side]
+            if ramp is not None:
+                start_h, start_v, target_h, target_v, elapsed, duration, start_time = ramp
+                if start_time is None:
+                    elapsed += 1
+                else:
+                    elapsed = min(round((self._clock() - start_time) * 1000000), duration)
+                ramp[4] = elapsed
+                self._layer._set_stick(side,
+                                       start_h + (target_h - start_h) * elapsed // duration,
+                                       start_v + (target_v - start_v) * elapsed // duration)
+                if elapsed >= duration:
+                    self._ramps[side] = None
+
+    def stop(self):
+        """
+        Ends the program, the next step returns False.
+        """
+        self._finished = True
+
+    def is_finished(self):
+        return self._finished
+
+    def step(self):
+        """
+        Runs the program until it waits, so the layer contains the state of the next frame.
+        :returns False if the program ended and no frame was produced
+        """
+        if self._finished:
+            return False
+
+        if self._wait > 0:
+            self._wait -= 1
+            if self._ramps[0] is not None or self._ramps[1] is not None:
+                self._update_ramps()
+            self.frames += 1
+            return True
+        if self._timed_wait:
+            if self._clock() < self._deadline:
+                if self._ramps[0] is not None or self._ramps[1] is not None:
+                    self._update_ramps()
+                self.frames += 1
+                return True
+            self._timed_wait = False
+
+        code = self._code
+        pc = self._pc
+        executed = 0
+        while True:
+            executed += 1
+            if executed > MAX_INSTRUCTIONS_PER_FRAME:
+                logger.error(f'Macro executed {MAX_INSTRUCTIONS_PER_FRAME} instructions without waiting, stopping it')
+                self._finished = True
+                return False
+
+            op = code[pc]
+            if op == _WAIT:
+                frames = code[pc + 1]
+                pc += 2
+                if frames > 0:
+                    self._wait = frames - 1
+                    self._deadline = None
+                    break
+            elif op == _WAIT_TIME:
+                # continue from the end of the previous timed wait, so lateness does not add up
+                start = self._deadline if self._deadline is not None else self._clock()
+                self._deadline = start + code[pc + 1] / 1000000
+                self._timed_wait = True
+                pc += 2
+                break
+            elif op == _HOLD:
+                self._layer._buttons |= code[pc + 1]
+                self._changed = True
+                pc += 2
+            elif op == _RELEASE:
+                self._layer._buttons &= ~code[pc + 1]
+                self._changed = True
+                pc += 2
+            elif op == _JUMP:
+                pc = code[pc + 1]
+            elif op == _COUNT_DOWN:
+                counter = code[pc + 1]
+                if self._counters[counter] == 0:
+                    pc = code[pc + 2]
+                else:
+                    self._counters[counter] -= 1
+                    pc += 3
+            elif op == _SET_COUNTER:
+                self._counters[code[pc + 1]] = code[pc + 2]
+                pc += 3
+            elif op == _JUMP_UNLESS:
+                if self._check(code[pc + 1], code[pc + 2], code[pc + 3]):
+                    pc += 5
+                else:
+                    pc = code[pc + 4]
+            elif op == _WAIT_UNTIL:
+                if self._check(code[pc + 1], code[pc + 2], code[pc + 3]):
+                    pc += 4
+                else:
+                    self._deadline = None
+                    break
+            elif op == _STICK:
+                side = code[pc + 1]
+                self._layer._set_stick(side, code[pc + 2], code[pc + 3])
+                self._ramps[side] = None
+                self._changed = True
+                pc += 4
+            elif op == _RAMP:
+                side = code[pc + 1]
+                frames = code[pc + 4]
+                if frames > 0:
+                    h, v = self._get_stick(side)
+                    self._ramps[side] = [h, v, code[pc + 2], code[pc + 3], 0, frames, None]
+                else:
+                    self._layer._set_stick(side, code[pc + 2], code[pc + 3])
+                    self._ramps[side] = None
+                    self._changed = True
+                pc += 5
+            elif op == _RAMP_TIME:
+                side = code[pc + 1]
+                h, v = self._get_stick(side)
+                self._ramps[side] = [h, v, code[pc + 2], code[pc + 3], 0, code[pc + 4], self._clock()]
+                pc += 5
+            elif op == _END:
+                self._finished = True
+                self._pc = pc
+                self.instructions += executed
+                if self._changed:
+                    # send state changes after the last wait in one final frame
+                    self._changed = False
+                    self.frames += 1
+                    return True
+                return False
+            else:
+                raise ValueError(f'Unknown instruction {op} at {pc}.')
+
+        self._pc = pc
+        self.instructions += executed
+        if self._ramps[0] is not None or self._ramps[1] is not None:
+            self._update_ramps()
+        self._changed = False
+        self.frames += 1
+        return True
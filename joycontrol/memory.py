@@ -1,51 +1,246 @@
+import collections
+import logging
+import mmap
+import os
+import struct
+import threading
+import zlib
+from contextlib import suppress
+
+logger = logging.getLogger(__name__)
+
+# Size of the SPI flash memory of the controllers
+FLASH_SIZE = 0x80000
+# Size of the pages copied into the overlay on the first write
+FLASH_PAGE_SIZE = 0x1000
+
+# Size of the sectors erased by the sector erase sub command
+FLASH_SECTOR_SIZE = 0x1000
+
+# Journal file format: magic, version, then records of operation (u8), offset (u32), size (u32),
+# data (write records only) and the crc32 of all previous record bytes
+_JOURNAL_MAGIC = b'JCFJ'
+_JOURNAL_VERSION = 1
+_JOURNAL_HEADER = struct.Struct('<4sB')
+_JOURNAL_RECORD = struct.Struct('<BII')
+_JOURNAL_CRC = struct.Struct('<I')
+_JOURNAL_WRITE = 1
+_JOURNAL_ERASE = 2
+
+# Blank images by size, shared by all memories created without data
+_blank_images = {}
+
+
+def _get_blank_image(size):
+    # Blank data is all 0xFF
+    if size not in _blank_images:
+        _blank_images[size] = b'\xFF' * size
+    return _blank_images[size]
+
 
 class FlashMemory:
-    def __init__(self, spi_flash_memory_data=None, default_stick_cal=False, size=0x80000):
+    """
+    SPI flash memory of a controller.
+
+    The contents are a read-only base image (bytes or a read-only mmap of a dump file) and a sparse overlay of pages
+    modified by writes. The base image is never copied, so memories created from the same bytes object or file mapping
+    share it.
+    """
+    def __init__(self, spi_flash_memory_data=None, default_stick_cal=False, size=FLASH_SIZE):
         """
         :param spi_flash_memory_data: data from a memory dump (can be created using dump_spi_flash.py).
+                                      bytes and mmap objects are used without copying.
         :param default_stick_cal: If True, override stick calibration bytes with factory default
         :param size of the memory dump, should be constant
         """
         if spi_flash_memory_data is None:
-            spi_flash_memory_data = [0xFF] * size  # Blank data is all 0xFF
+            spi_flash_memory_data = _get_blank_image(size)
             default_stick_cal = True
 
         if len(spi_flash_memory_data) != size:
             raise ValueError(f'Given data size {len(spi_flash_memory_data)} does not match size {size}.')
-        if isinstance(spi_flash_memory_data, bytes):
-            spi_flash_memory_data = list(spi_flash_memory_data)
+        if not isinstance(spi_flash_memory_data, (bytes, mmap.mmap)):
+            spi_flash_memory_data = bytes(spi_flash_memory_data)
+
+        self._base = spi_flash_memory_data
+        self._size = size
+        # modified pages by page index
+        self._pages = {}
+
+        # incremented by every write, allows caches of the contents to detect changes
+        self._generation = 0
+
+        # optional journal persisting writes
+        self._journal = None
 
         # set default controller stick calibration
         if default_stick_cal:
             # L-stick factory calibration
-            spi_flash_memory_data[0x603D:0x6046] = [0x00, 0x07, 0x70, 0x00, 0x08, 0x80, 0x00, 0x07, 0x70]
+            self.write(0x603D, bytes((0x00, 0x07, 0x70, 0x00, 0x08, 0x80, 0x00, 0x07, 0x70)))
             # R-stick factory calibration
-            spi_flash_memory_data[0x6046:0x604F] = [0x00, 0x08, 0x80, 0x00, 0x07, 0x70, 0x00, 0x07, 0x70]
+            self.write(0x6046, bytes((0x00, 0x08, 0x80, 0x00, 0x07, 0x70, 0x00, 0x07, 0x70)))
+
+    @staticmethod
+    def from_file(path, default_stick_cal=False, size=FLASH_SIZE):
+        """
+        Maps a memory dump file read-only. The mapping is shared with other processes using the same file.
 
-        self.data = spi_flash_memory_data
+        :param path: path of the memory dump
+        """
+        with open(path, 'rb') as dump:
+            # the mapping stays valid after closing the file
+            image = mmap.mmap(dump.fileno(), 0, access=mmap.ACCESS_READ)
+        return FlashMemory(image, default_stick_cal=default_stick_cal, size=size)
+
+    def copy(self):
+        """
+        :returns memory sharing the base image of this one, with a copy of the modified pages
+        """
+        memory = FlashMemory(self._base, size=self._size)
+        memory._pages = {index: bytearray(page) for index, page in self._pages.items()}
+        return memory
 
     def __getitem__(self, item):
-        return self.data[item]
+        """
+        :param item: byte index or slice
+        :returns byte value or bytes of the slice
+        """
+        if isinstance(item, slice):
+            start, stop, step = item.indices(self._size)
+            if step != 1:
+                return bytes(self)[item]
+            return self._read(start, stop)
+
+        if item < 0:
+            item += self._size
+        if not 0 <= item < self._size:
+            raise IndexError('Flash memory index out of range')
+        page = self._pages.get(item // FLASH_PAGE_SIZE)
+        if page is not None:
+            return page[item % FLASH_PAGE_SIZE]
+        return self._base[item]
+
+    def _read(self, start, stop):
+        if stop <= start:
+            return b''
+
+        first_page = start // FLASH_PAGE_SIZE
+        last_page = (stop - 1) // FLASH_PAGE_SIZE
+        if not any(index in self._pages for index in range(first_page, last_page + 1)):
+            return self._base[start:stop]
+
+        chunks = []
+        for index in range(first_page, last_page + 1):
+            page_start = index * FLASH_PAGE_SIZE
+            chunk_start = max(start, page_start)
+            chunk_stop = min(stop, page_start + FLASH_PAGE_SIZE)
+            page = self._pages.get(index)
+            if page is not None:
+                chunks.append(bytes(page[chunk_start - page_start:chunk_stop - page_start]))
+            else:
+                chunks.append(self._base[chunk_start:chunk_stop])
+        return b''.join(chunks)
+
+    def __len__(self):
+        return self._size
+
+    def __bytes__(self):
+        return self._read(0, self._size)
+
+    def write(self, offset, data):
+        """
+        Overwrites flash memory contents. Modified pages are copied from the base image into the overlay on the
+        first write. If a journal is attached, the write is also appended to the journal without blocking.
+        Modify the memory only using this function or erase, caches depend on it.
+
+        :param offset: start byte of the write
+        :param data: bytes to write
+        """
+        self._write(offset, data)
+        if self._journal is not None and self._journal.append(_JOURNAL_WRITE, offset, data):
+            self._journal.compact(self._get_pages())
+
+    def erase(self, offset, size=FLASH_SECTOR_SIZE):
+        """
+        Sets flash memory contents to 0xFF, like erasing flash sectors does.
+
+        :param offset: start byte of the erased range
+        :param size: size of the erased range
+        """
+        self._write(offset, b'\xFF' * size)
+        if self._journal is not None and self._journal.append(_JOURNAL_ERASE, offset, size=size):
+            self._journal.compact(self._get_pages())
+
+    def _write(self, offset, data):
+        if offset < 0 or offset + len(data) > self._size:
+            raise ValueError(f'Write of {len(data)} bytes at offset {hex(offset)} exceeds the memory size.')
+
+        position = 0
+        while position < len(data):
+            index, page_offset = divmod(offset + position, FLASH_PAGE_SIZE)
+            page = self._pages.get(index)
+            if page is None:
+                page_start = index * FLASH_PAGE_SIZE
+                page = self._pages[index] = bytearray(self._base[page_start:page_start + FLASH_PAGE_SIZE])
+            chunk = min(len(data) - position, FLASH_PAGE_SIZE - page_offset)
+            page[page_offset:page_offset + chunk] = data[position:position + chunk]
+            position += chunk
+
+        self._generation += 1
+
+    def _get_pages(self):
+        """
+        :returns (offset, data) tuples of all modified pages
+        """
+        return [(index * FLASH_PAGE_SIZE, bytes(page)) for index, page in sorted(self._pages.items())]
+
+    def attach_journal(self, journal):
+        """
+        Replays the writes recorded in the journal and appends all further writes to it.
+
+        :param journal: FlashJournal
+        """
+        for operation, offset, data in journal.replay():
+            if operation == _JOURNAL_WRITE:
+                self._write(offset, data)
+            else:
+                self._write(offset, b'\xFF' * data)
+        self._journal = journal
+
+    def get_journal(self):
+        return self._journal
+
+    def get_generation(self):
+        """
+        :returns number of writes since the memory was created
+        """
+        return self._generation
+
+    def get_overlay_size(self):
+        """
+        :returns number of bytes held by modified pages
+        """
+        return len(self._pages) * FLASH_PAGE_SIZE
 
     def get_factory_l_stick_calibration(self):
         """
         :returns 9 left stick factory calibration bytes
         """
-        return self.data[0x603D:0x6046]
+        return self[0x603D:0x6046]
 
     def get_factory_r_stick_calibration(self):
         """
         :returns 9 right stick factory calibration bytes
         """
-        return self.data[0x6046:0x604F]
+        return self[0x6046:0x604F]
 
     def get_user_l_stick_calibration(self):
         """
         :returns 9 left stick user calibration bytes if the data is available, otherwise None
         """
         # check if calibration data is available:
-        if self.data[0x8010] == 0xB2 and self.data[0x8011] == 0xA1:
-            return self.data[0x8012:0x801B]
+        if self[0x8010] == 0xB2 and self[0x8011] == 0xA1:
+            return self[0x8012:0x801B]
         else:
             return None
 
@@ -54,7 +249,218 @@ class FlashMemory:
         :returns 9 right stick user calibration bytes if the data is available, otherwise None
         """
         # check if calibration data is available:
-        if self.data[0x801B] == 0xB2 and self.data[0x801C] == 0xA1:
-            return self.data[0x801D:0x8026]
+        if self[0x801B] == 0xB2 and self[0x801C] == 0xA1:
+            return self[0x801D:0x8026]
         else:
             return None
+
+
+class FlashJournal:
+    """
+    Append-only journal of flash memory writes, so that e.g. calibration written by the console survives restarts.
+
+    Appending only queues the record in memory. A background thread writes queued records to the file and fsyncs it.
+    If the journal grew too large, it is compacted: the file is replaced by one write record per modified page.
+    A record torn by a crash is detected by its checksum and discarded on replay.
+    """
+    def __init__(self, path, flush_interval=1.0, compact_size=0x10000):
+        """
+        :param path: journal file path, created if it does not exist
+        :param flush_interval: time in seconds between two writes of queued records
+        :param compact_size: journal size in bytes triggering a compaction, at least twice the size after the
+                             last compaction
+        """
+        self._path = path
+        self._flush_interval = flush_interval
+        self._compact_size = compact_size
+
+        self._size = 0
+        # size of the journal after the last compaction
+        self._compacted_size = 0
+        self._pending = collections.deque()
+        self._compacting = False
+        self._wakeup = threading.Event()
+        self._closed = False
+
+        # journal file, None after a failed write until it is reopened
+        self._file = None
+        # size of the records written to the file
+        self._file_size = 0
+        self._thread = None
+
+    def replay(self):
+        """
+        Reads the journal and opens it for appending. Must be called once before appending.
+
+        :returns list of (operation, offset, data) tuples, data is the size of erase operations
+        """
+        if self._thread is not None:
+            raise ValueError('Journal was already replayed.')
+
+        records = []
+        valid_size = 0
+        try:
+            with open(self._path, 'rb') as journal:
+                data = journal.read()
+        except FileNotFoundError:
+            data = b''
+
+        if data:
+            magic, version = _JOURNAL_HEADER.unpack_from(data) if len(data) >= _JOURNAL_HEADER.size else (None, None)
+            if magic != _JOURNAL_MAGIC or version != _JOURNAL_VERSION:
+                raise ValueError(f'{self._path} is not a flash journal.')
+            offset = valid_size = _JOURNAL_HEADER.size
+            while offset + _JOURNAL_RECORD.size <= len(data):
+                operation, flash_offset, size = _JOURNAL_RECORD.unpack_from(data, offset)
+                data_size = size if operation == _JOURNAL_WRITE else 0
+                end = offset + _JOURNAL_RECORD.size + data_size
+                if end + _JOURNAL_CRC.size > len(data) or \
+                        _JOURNAL_CRC.unpack_from(data, end)[0] != zlib.crc32(data[offset:end]):
+                    logger.warning(f'Discarding torn flash journal record at {offset}.')
+                    break
+                if operation == _JOURNAL_WRITE:
+                    records.append((operation, flash_offset, data[end - data_size:end]))
+                else:
+                    records.append((operation, flash_offset, size))
+                offset = valid_size = end + _JOURNAL_CRC.size
+
+        self._file = open(self._path, 'r+b' if data else 'wb')
+        if data:
+            # drop a torn record at the end
+            self._file.truncate(valid_size)
+            self._file.seek(valid_size)
+        else:
+            self._file.write(_JOURNAL_HEADER.pack(_JOURNAL_MAGIC, _JOURNAL_VERSION))
+            self._file.flush()
+            valid_size = _JOURNAL_HEADER.size
+        self._size = self._file_size = valid_size
+
+        logger.info(f'Replayed {len(records)} flash journal records from {self._path}.')
+
+        self._thread = threading.Thread(target=self._run, name='FlashJournal', daemon=True)
+        self._thread.start()
+        return records
+
+    @staticmethod
+    def _pack(operation, offset, data=b'', size=None):
+        record = _JOURNAL_RECORD.pack(operation, offset, len(data) if size is None else size) + bytes(data)
+        return record + _JOURNAL_CRC.pack(zlib.crc32(record))
+
+    def append(self, operation, offset, data=b'', size=None):
+        """
+        Queues a record. Never blocks.
+
+        :returns True if the journal should be compacted
+        """
+        if self._thread is None or self._closed:
+            raise ValueError('Journal is not open.')
+        record = self._pack(operation, offset, data, size)
+        self._pending.append(record)
+        self._size += len(record)
+        return not self._compacting and self._size >= max(self._compact_size, 2 * self._compacted_size)
+
+    def compact(self, pages):
+        """
+        Queues a compaction. Records queued earlier are replaced, records queued later are kept.
+
+        :param pages: (offset, data) tuples of all modified pages
+        """
+        self._compacting = True
+        self._pending.append(pages)
+        self._size = self._compacted_size = _JOURNAL_HEADER.size + sum(
+            _JOURNAL_RECORD.size + len(data) + _JOURNAL_CRC.size for _, data in pages)
+        self._wakeup.set()
+
+    def _run(self):
+        while not self._closed:
+            self._wakeup.wait(self._flush_interval)
+            self._wakeup.clear()
+            self._flush()
+        self._flush()
+        if self._pending:
+            logger.error(f'Closing flash journal with {len(self._pending)} unwritten records.')
+        if self._file is not None:
+            self._file.close()
+
+    def _flush(self):
+        pending = self._pending
+        if not pending:
+            return
+
+        records = []
+        # compaction currently written
+        pages = None
+        try:
+            while pending:
+                item = pending.popleft()
+                if isinstance(item, list):
+                    pages = item
+                    self._write(records)
+                    records = []
+                    self._rewrite(pages)
+                    pages = None
+                else:
+                    records.append(item)
+            self._write(records)
+        except OSError as err:
+            # retry the unwritten records and the compaction with the next flush, in their original order
+            if pages is not None:
+                pending.appendleft(pages)
+            pending.extendleft(reversed(records))
+            logger.error(f'Failed to write flash journal, retrying with the next flush - {err}')
+
+    def _close_file(self):
+        with suppress(OSError):
+            self._file.close()
+        self._file = None
+
+    def _write(self, records):
+        if not records:
+            return
+        if self._file is None:
+            # reopen after a failed write, dropping partially written records
+            self._file = open(self._path, 'r+b')
+            self._file.truncate(self._file_size)
+            self._file.seek(self._file_size)
+
+        data = b''.join(records)
+        try:
+            self._file.write(data)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        except OSError:
+            # unwritten data might remain in the buffer, it is discarded by closing the file
+            self._close_file()
+            raise
+        self._file_size += len(data)
+
+    def _rewrite(self, pages):
+        try:
+            temp_path = self._path + '.tmp'
+            journal = _JOURNAL_HEADER.pack(_JOURNAL_MAGIC, _JOURNAL_VERSION) + \
+                b''.join(self._pack(_JOURNAL_WRITE, offset, data) for offset, data in pages)
+            with open(temp_path, 'wb') as compacted:
+                compacted.write(journal)
+                compacted.flush()
+                os.fsync(compacted.fileno())
+            os.replace(temp_path, self._path)
+
+            if self._file is not None:
+                self._close_file()
+            self._file_size = len(journal)
+            self._file = open(self._path, 'r+b')
+            self._file.seek(self._file_size)
+        finally:
+            self._compacting = False
+        logger.info(f'Compacted flash journal to {len(pages)} pages.')
+
+    def close(self):
+        """
+        Writes all queued records and closes the journal file.
+        """
+        if self._closed or self._thread is None:
+            self._closed = True
+            return
+        self._closed = True
+        self._wakeup.set()
+        self._thread.join()
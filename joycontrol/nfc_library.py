@@ -0,0 +1,332 @@
+import asyncio
+import collections
+import hashlib
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+"""
+Library of NFC tag (amiibo) dumps in a directory.
+
+The index (UID, amiibo id, hash, size and modification time of every dump) is stored in the directory, entries are
+only recreated for dumps which changed. All valid dumps are preloaded, so swapping tags does not require any disk I/O.
+"""
+
+# Size of a NTAG215 dump
+NFC_TAG_SIZE = 540
+
+# Incremented whenever the index format changes
+INDEX_VERSION = 1
+
+# Name of the index file in the library directory
+INDEX_FILE_NAME = '.joycontrol_nfc_index.json'
+
+# Seconds to wait for further tag writes before dumps are written to disk
+WRITE_DELAY = 1.0
+
+NfcTag = collections.namedtuple('NfcTag', ['name', 'uid', 'amiibo_id', 'hash', 'size', 'mtime_ns'])
+NfcTag.__doc__ = """
+Index entry of a dump.
+name: path of the dump relative to the library directory
+uid: hex string of the 7 byte tag UID
+amiibo_id: hex string of the 8 byte amiibo character id
+"""
+
+
+def validate_nfc_content(content):
+    """
+    :raises ValueError: if the content is not a NTAG215 dump
+    """
+    if len(content) != NFC_TAG_SIZE:
+        raise ValueError(f'NFC dump size {len(content)} does not match tag size {NFC_TAG_SIZE}.')
+
+
+def read_nfc_dump(path):
+    """
+    Reads and validates a dump.
+    :param path: path to the dump file
+    :returns dump content bytes
+    """
+    with open(path, 'rb') as nfc_file:
+        content = nfc_file.read(NFC_TAG_SIZE + 1)
+    try:
+        validate_nfc_content(content)
+    except ValueError as err:
+        raise ValueError(f'{path}: {err}') from None
+    return content
+
+
+def get_uid(content):
+    """
+    :returns 7 byte UID of the tag, the first UID page also holds a check byte which is skipped
+    """
+    return content[0:3] + content[4:8]
+
+
+def get_amiibo_id(content):
+    """
+    :returns 8 byte amiibo character id (character, variant, figure type, model number and series)
+    """
+    return content[84:92]
+
+
+def _create_tag(name, content, stat):
+    return NfcTag(name=name,
+                  uid=get_uid(content).hex(),
+                  amiibo_id=get_amiibo_id(content).hex(),
+                  hash=hashlib.blake2b(content, digest_size=16).hexdigest(),
+                  size=stat.st_size,
+                  mtime_ns=stat.st_mtime_ns)
+
+
+def write_nfc_dump(path, content):
+    """
+    Atomically replaces a dump file.
+    """
+    validate_nfc_content(content)
+    temp_path = f'{path}.{os.getpid()}.tmp'
+    with open(temp_path, 'wb') as nfc_file:
+        nfc_file.write(content)
+    os.replace(temp_path, path)
+
+
+class DeferredNfcWriter:
+    """
+    Writes tag contents to dump files off the event loop.
+
+    A console writes a tag with several commands in quick succession. Writes are collected until no further write
+    arrived for the write delay, only the last content of every dump is written, in an executor.
+    """
+
+    def __init__(self, delay=WRITE_DELAY, loop=None):
+        """
+        :param delay: seconds to wait for further writes
+        """
+        self._delay = delay
+        self._loop = loop or asyncio.get_event_loop()
+
+        # contents to write by path
+        self._pending = {}
+        self._timer = None
+        # future of the running executor job
+        self._flushing = None
+
+        self.written_dumps = 0
+
+    def schedule(self, path, content):
+        """
+        Schedules writing of a dump, replacing a previously scheduled content of the same path.
+        Must be called from the event loop.
+        """
+        self._pending[path] = content
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = self._loop.call_later(self._delay, self._start_flush)
+
+    def _write(self, pending):
+        for path, content in pending.items():
+            try:
+                write_nfc_dump(path, content)
+                self.written_dumps += 1
+                logger.info(f'Wrote NFC dump {path}')
+            except (OSError, ValueError) as err:
+                logger.error(f'Failed to write NFC dump {path} - {err}')
+
+    def _start_flush(self):
+        self._timer = None
+        if not self._pending:
+            return
+        if self._flushing is not None and not self._flushing.done():
+            # try again after the running job finished
+            self._timer = self._loop.call_later(self._delay, self._start_flush)
+            return
+
+        pending, self._pending = self._pending, {}
+        self._flushing = self._loop.run_in_executor(None, self._write, pending)
+
+    def has_pending(self):
+        """
+        :returns True if writes are pending or running
+        """
+        return bool(self._pending) or (self._flushing is not None and not self._flushing.done())
+
+    async def flush(self):
+        """
+        Writes all pending dumps now and waits until they are written.
+        """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._flushing is not None:
+            await self._flushing
+        self._start_flush()
+        if self._flushing is not None:
+            await self._flushing
+
+
+class NfcLibrary:
+    """
+    Index of the NFC dumps in a directory (including sub directories) and their preloaded content.
+    """
+
+    def __init__(self, directory, index_path=None, writer: DeferredNfcWriter = None):
+        """
+        :param directory: library directory
+        :param index_path: path of the persistent index (JSON), defaults to a file in the library directory
+        :param writer: writer of tag updates, updates are only kept in memory if None
+        """
+        self._directory = directory
+        self._writer = writer
+        self._index_path = index_path if index_path is not None else os.path.join(directory, INDEX_FILE_NAME)
+
+        # tags and contents by name
+        self._tags = {}
+        self._contents = {}
+        # sorted tag names
+        self._names = []
+        # position of the last selected tag when rotating through the library
+        self._position = -1
+
+    def get_directory(self):
+        return self._directory
+
+    def _load_index(self):
+        try:
+            with open(self._index_path) as index_file:
+                index = json.load(index_file)
+            if index.get('version') != INDEX_VERSION:
+                return {}
+            return {name: NfcTag(name, **entry) for name, entry in index['tags'].items()}
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError, KeyError, TypeError, AttributeError) as err:
+            logger.warning(f'Ignoring NFC library index {self._index_path} - {err}')
+            return {}
+
+    def _store_index(self):
+        tags = {name: {field: value for field, value in tag._asdict().items() if field != 'name'}
+                for name, tag in self._tags.items()}
+        try:
+            temp_path = f'{self._index_path}.{os.getpid()}.tmp'
+            with open(temp_path, 'w') as index_file:
+                json.dump({'version': INDEX_VERSION, 'tags': tags}, index_file)
+            os.replace(temp_path, self._index_path)
+        except OSError as err:
+            logger.warning(f'Failed to write NFC library index {self._index_path} - {err}')
+
+    def _find_files(self):
+        for root, dirs, files in os.walk(self._directory):
+            dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+            for file_name in sorted(files):
+                if not file_name.startswith('.'):
+                    path = os.path.join(root, file_name)
+                    yield os.path.relpath(path, self._directory), path
+
+    def load(self):
+        """
+        Indexes the library directory and preloads all valid dumps. Blocking, see load_async.
+
+        Index entries are reused if size and modification time of a dump did not change.
+        Files which are not NTAG215 dumps are skipped.
+        """
+        index = self._load_index()
+        tags = {}
+        contents = {}
+        changed = False
+
+        for name, path in self._find_files():
+            try:
+                stat = os.stat(path)
+                if stat.st_size != NFC_TAG_SIZE:
+                    logger.debug(f'Skipping {path} - size {stat.st_size} does not match tag size {NFC_TAG_SIZE}')
+                    continue
+                content = read_nfc_dump(path)
+            except (OSError, ValueError) as err:
+                logger.warning(f'Skipping {path} - {err}')
+                continue
+
+            tag = index.get(name)
+            if tag is None or tag.size != stat.st_size or tag.mtime_ns != stat.st_mtime_ns:
+                tag = _create_tag(name, content, stat)
+                changed = True
+            tags[name] = tag
+            contents[name] = content
+
+        self._tags = tags
+        self._contents = contents
+        self._names = list(tags.keys())
+        self._position = -1
+
+        if changed or tags.keys() != index.keys():
+            self._store_index()
+        logger.info(f'Loaded {len(tags)} NFC dumps from {self._directory}')
+
+    async def load_async(self, loop=None):
+        """
+        Runs load in an executor.
+        """
+        loop = loop or asyncio.get_event_loop()
+        await loop.run_in_executor(None, self.load)
+
+    def get_tags(self):
+        """
+        :returns list of all indexed tags, sorted by name
+        """
+        return [self._tags[name] for name in self._names]
+
+    def get_tag(self, name):
+        return self._tags[name]
+
+    def get_content(self, name):
+        """
+        :param name: name of the dump relative to the library directory
+        :returns preloaded dump content
+        """
+        return self._contents[name]
+
+    def update(self, name, content):
+        """
+        Replaces the preloaded content of a tag, e.g. after the console wrote to it.
+        The dump file is written by the writer of the library, its index entry is recreated on the next load.
+        """
+        validate_nfc_content(content)
+        if name not in self._tags:
+            raise ValueError(f'Unknown NFC dump {name}')
+
+        self._contents[name] = content
+        if self._writer is not None:
+            self._writer.schedule(os.path.join(self._directory, name), content)
+
+    def find(self, key):
+        """
+        Finds a tag by name, name without file extension, UID or amiibo id.
+        :returns the first matching tag, None if no tag matches
+        """
+        if key in self._tags:
+            return self._tags[key]
+        key_lower = key.lower()
+        for tag in self._tags.values():
+            if key_lower in (os.path.splitext(tag.name)[0].lower(), tag.uid, tag.amiibo_id):
+                return tag
+        return None
+
+    def next(self):
+        """
+        Rotates through the library.
+        :returns the tag following the previously selected one
+        """
+        if not self._names:
+            raise ValueError(f'NFC library {self._directory} is empty.')
+        self._position = (self._position + 1) % len(self._names)
+        return self._tags[self._names[self._position]]
+
+    def select(self, name):
+        """
+        Sets the rotation position to the given tag.
+        """
+        self._position = self._names.index(name)
+
+    def __len__(self):
+        return len(self._tags)
@@ -1,6 +1,6 @@
 import asyncio
+import collections
 import logging
-import time
 from asyncio import BaseTransport, BaseProtocol
 from contextlib import suppress
 from typing import Optional, Union, Tuple, Text
@@ -8,61 +8,274 @@ from typing import Optional, Union, Tuple, Text
 from joycontrol import utils
 from joycontrol.controller import Controller
 from joycontrol.controller_state import ControllerState
-from joycontrol.memory import FlashMemory
+from joycontrol.memory import FlashMemory, FLASH_SECTOR_SIZE
 from joycontrol.report import OutputReport, SubCommand, InputReport, OutputReportID
+from joycontrol.scheduler import TickScheduler, ReportRate, HandshakePacer
 from joycontrol.transport import NotConnectedError
-from joycontrol.ir_nfc_mcu import IrNfcMcu, McuState, Action
-from crc8 import crc8
+from joycontrol.ir_camera import IrCamera, IrResolution, IR_MODE_IMAGE_TRANSFER
+from joycontrol.input_mixer import InputMixer, PRIORITY_SCRIPT, PRIORITY_TIMELINE
+from joycontrol.macro import Timeline, TIMELINE_ROW_SIZE
+from joycontrol.macro_vm import MacroVM, Program, is_rumble_active
+from joycontrol.ir_nfc_mcu import IrNfcMcu, McuState, Action, MCU_PACKET_LAST, apply_ntag_write
 
 logger = logging.getLogger(__name__)
 
+# Minimum time between two input reports if a state change is pushed immediately in low latency mode
+LOW_LATENCY_MIN_SPACING = 0.004
+
+# Maximum number of cached SPI flash read replies
+SPI_REPLY_CACHE_SIZE = 32
+
+# (offset, size) of the SPI flash regions read by the Switch on every connect: serial number, factory IMU calibration,
+# factory stick calibration, colors, sensor and stick parameters, user stick and IMU calibration
+SPI_PREWARM_REGIONS = (
+    (0x6000, 0x10),
+    (0x6020, 0x18),
+    (0x603D, 0x19),
+    (0x6050, 0x0D),
+    (0x6080, 0x18),
+    (0x6098, 0x12),
+    (0x8010, 0x18),
+    (0x8028, 0x18),
+)
+
+
+def _create_sub_command_reply(ack=None, sub_command_id=None):
+    """
+    Creates a 0x21 input report which can be used as template for sub command replies.
+    """
+    input_report = InputReport()
+    input_report.set_input_report_id(0x21)
+    input_report.set_misc()
+    if ack is not None:
+        input_report.set_ack(ack)
+    if sub_command_id is not None:
+        input_report.reply_to_subcommand_id(sub_command_id)
+    return input_report
+
+
+def _create_reply_templates(controller):
+    """
+    :returns dictionary of prepared replies to sub commands whose reply never changes, by sub command id
+    """
+    templates = {}
+    for sub_command in (SubCommand.SET_SHIPMENT_STATE, SubCommand.SET_INPUT_REPORT_MODE,
+                        SubCommand.ENABLE_6AXIS_SENSOR, SubCommand.ENABLE_VIBRATION,
+                        SubCommand.SET_NFC_IR_MCU_STATE, SubCommand.SET_PLAYER_LIGHTS):
+        templates[sub_command.value] = _create_sub_command_reply(0x80, sub_command)
+
+    reply = _create_sub_command_reply(0x83, SubCommand.TRIGGER_BUTTONS_ELAPSED_TIME)
+    # Hack: We assume this command is only used during pairing - Set values so the Switch assigns a player number
+    if controller == Controller.PRO_CONTROLLER:
+        reply.sub_0x04_trigger_buttons_elapsed_time(L_ms=3000, R_ms=3000)
+        templates[SubCommand.TRIGGER_BUTTONS_ELAPSED_TIME.value] = reply
+    elif controller in (Controller.JOYCON_L, Controller.JOYCON_R):
+        # TODO: What do we do if we want to pair a combined JoyCon?
+        reply.sub_0x04_trigger_buttons_elapsed_time(SL_ms=3000, SR_ms=3000)
+        templates[SubCommand.TRIGGER_BUTTONS_ELAPSED_TIME.value] = reply
+
+    return templates
+
+
+class SpiFlashReplyCache:
+    """
+    LRU cache of ready to send 0x21 replies to SPI flash reads by (offset, size).
+
+    The cache is cleared if the flash memory was written since the replies were created.
+    """
+    def __init__(self, spi_flash: FlashMemory = None, max_size=SPI_REPLY_CACHE_SIZE):
+        """
+        :param spi_flash: flash memory to read, if None all reads reply zeros
+        :param max_size: maximum number of cached replies
+        """
+        self._spi_flash = spi_flash
+        self._max_size = max_size
+        self._replies = collections.OrderedDict()
+        self._generation = self._get_flash_generation()
+
+        # statistics
+        self.hits = 0
+        self.misses = 0
+
+    def _get_flash_generation(self):
+        return self._spi_flash.get_generation() if self._spi_flash is not None else 0
+
+    def _create_reply(self, offset, size):
+        reply = _create_sub_command_reply(0x90)
+        if self._spi_flash is not None:
+            data = self._spi_flash[offset:offset + size]
+        else:
+            data = bytes(size)
+        reply.sub_0x10_spi_flash_read(offset, size, data)
+        return reply
+
+    def get(self, offset, size) -> InputReport:
+        """
+        :returns prepared reply to a read of size bytes at offset. Must not be modified.
+        """
+        generation = self._get_flash_generation()
+        if generation != self._generation:
+            # flash contents changed
+            self._replies.clear()
+            self._generation = generation
+
+        key = (offset, size)
+        reply = self._replies.get(key)
+        if reply is not None:
+            self.hits += 1
+            self._replies.move_to_end(key)
+            return reply
+
+        self.misses += 1
+        reply = self._create_reply(offset, size)
+        self._replies[key] = reply
+        if len(self._replies) > self._max_size:
+            self._replies.popitem(last=False)
+        return reply
+
+    def get_request(self, sub_command_data) -> InputReport:
+        """
+        :param sub_command_data: data of a SPI flash read sub command: offset (4 bytes, little endian) and size
+        :returns prepared reply to the read, see get
+        """
+        return self.get(int.from_bytes(sub_command_data[0:4], 'little'), sub_command_data[4])
+
+    def prewarm(self, regions=SPI_PREWARM_REGIONS):
+        """
+        Creates the replies for the given (offset, size) regions.
+        """
+        for offset, size in regions:
+            self.get(offset, size)
+        # prewarming is not a miss
+        self.misses -= len(regions)
+
 
-def controller_protocol_factory(controller: Controller, spi_flash=None):
+def controller_protocol_factory(controller: Controller, spi_flash=None, report_rate=ReportRate.NORMAL,
+                                low_latency=False):
     if isinstance(spi_flash, bytes):
         spi_flash = FlashMemory(spi_flash_memory_data=spi_flash)
 
     def create_controller_protocol():
-        return ControllerProtocol(controller, spi_flash=spi_flash)
+        return ControllerProtocol(controller, spi_flash=spi_flash, report_rate=report_rate,
+                                  low_latency=low_latency)
 
     return create_controller_protocol
 
 
 class ControllerProtocol(BaseProtocol):
-    def __init__(self, controller: Controller, spi_flash: FlashMemory = None):
+    def __init__(self, controller: Controller, spi_flash: FlashMemory = None,
+                 report_rate: ReportRate = ReportRate.NORMAL, low_latency=False):
+        """
+        :param controller: controller type to emulate
+        :param spi_flash: flash memory of the emulated controller
+        :param report_rate: input report rate in full input report mode
+        :param low_latency: If True, controller state changes are send immediately in full input report mode
+                            instead of with the next scheduled input report
+        """
         self.controller = controller
         self.spi_flash = spi_flash
 
         self.transport = None
 
+        # paces input reports in full input report mode
+        self._report_scheduler = TickScheduler(report_rate)
+        self._low_latency = low_latency
+        # paces input reports after sub command replies in full input report mode, pauses at least one report period
+        self._handshake_pacer = HandshakePacer(scheduler=self._report_scheduler)
+
+        # time of connection_made and seconds from connection_made to the player lights sub command
+        self._connection_time = None
+        self._time_to_player_lights = None
+
         # Increases for each input report send, should overflow at 0x100
         self._input_report_timer = 0x00
+        # Number of input reports containing the controller state, the index of the next one. Never overflows.
+        self._frame = 0
+        # callables applied to the controller state before the input report of a frame, by frame
+        self._frame_actions = {}
+        # futures resolved after the input report of a frame was send, by frame
+        self._frame_waiters = {}
+        # last frame whose input report was send
+        self._sent_frame = -1
+        # concatenated status bytes of the played timeline and its first and end frame, see play_timeline
+        self._timeline_data = b''
+        self._timeline_start = self._timeline_end = 0
+        # running macro scripts and the futures resolved when they ended by name, see run_script
+        self._scripts = {}
 
         self._data_received = asyncio.Event()
 
         self._controller_state = ControllerState(self, controller, spi_flash=spi_flash)
         self._controller_state_sender = None
 
+        # composes the controller status of the input reports from the controller state and the layers of all
+        # other input sources
+        self._input_mixer = InputMixer(self._controller_state)
+        self._timeline_layer = self._input_mixer.create_layer('timeline', priority=PRIORITY_TIMELINE)
+
         self._mcu = IrNfcMcu()
+        self._ir_camera = IrCamera()
+        # data of the received packets of a NTAG write command and the expected id of the next packet
+        self._ntag_write_data = bytearray()
+        self._ntag_write_packet_id = 0
 
         # None = Just answer to sub commands
         self._input_report_mode = None
 
         # This event gets triggered once the Switch assigns a player number to the controller and accepts user inputs
         self.sig_set_player_lights = asyncio.Event()
+        # raw player lights byte of the last set player lights command, None if not set
+        self._player_lights = None
+        # True if the rumble data of the last output report has a non zero amplitude
+        self._rumbling = False
+
+        # Sub command replies are assembled in this reusable input report, either by setting the fields of the
+        # 0x21 base report or by copying a prepared reply.
+        self._reply_report = InputReport()
+        self._reply_base = _create_sub_command_reply()
+        self._reply_templates = _create_reply_templates(controller)
+        self._spi_reply_cache = SpiFlashReplyCache(spi_flash)
+        self._spi_reply_cache.prewarm()
+
+        # Output report handlers by raw output report id. Handlers return True if a reply was send.
+        self._output_report_handlers = {
+            OutputReportID.SUB_COMMAND.value: self._reply_to_sub_command,
+            OutputReportID.RUMBLE_ONLY.value: self._reply_to_rumble,
+            OutputReportID.REQUEST_IR_NFC_MCU.value: self._reply_to_ir_nfc_mcu,
+        }
+
+        # Sub command handlers by raw sub command id
+        self._sub_command_handlers = {
+            SubCommand.REQUEST_DEVICE_INFO.value: self._command_request_device_info,
+            SubCommand.SET_SHIPMENT_STATE.value: self._command_set_shipment_state,
+            SubCommand.SPI_FLASH_READ.value: self._command_spi_flash_read,
+            SubCommand.SPI_FLASH_WRITE.value: self._command_spi_flash_write,
+            SubCommand.SPI_SECTOR_ERASE.value: self._command_spi_sector_erase,
+            SubCommand.SET_INPUT_REPORT_MODE.value: self._command_set_input_report_mode,
+            SubCommand.TRIGGER_BUTTONS_ELAPSED_TIME.value: self._command_trigger_buttons_elapsed_time,
+            SubCommand.ENABLE_6AXIS_SENSOR.value: self._command_enable_6axis_sensor,
+            SubCommand.ENABLE_VIBRATION.value: self._command_enable_vibration,
+            SubCommand.SET_NFC_IR_MCU_CONFIG.value: self._command_set_nfc_ir_mcu_config,
+            SubCommand.SET_NFC_IR_MCU_STATE.value: self._command_set_nfc_ir_mcu_state,
+            SubCommand.SET_PLAYER_LIGHTS.value: self._command_set_player_lights,
+        }
 
     async def send_controller_state(self):
         """
         Waits for the controller state to be send.
 
+        In low latency mode, the next input report of the full input report mode is send immediately
+        (keeping LOW_LATENCY_MIN_SPACING to the previous report) instead of waiting for the next scheduled one.
+
         Raises NotConnected exception if the transport is not connected or the connection was lost.
         """
-        # TODO: Call write directly if in continuously sending input report mode
-
         if self.transport is None:
             raise NotConnectedError('Transport not registered.')
 
         self._controller_state.sig_is_send.clear()
 
+        self.wake_for_frame()
+
         # wrap into a future to be able to set an exception in case of a disconnect
         self._controller_state_sender = asyncio.ensure_future(self._controller_state.sig_is_send.wait())
         await self._controller_state_sender
@@ -78,17 +291,28 @@ class ControllerProtocol(BaseProtocol):
         if self.transport is None:
             raise NotConnectedError('Transport not registered.')
 
+        frame = self._frame
+        self._frame += 1
+        # apply actions scheduled for this frame, e.g. releasing buttons after a timed press
+        actions = self._frame_actions.pop(frame, None)
+        if actions is not None:
+            for action in actions:
+                action()
+
+        # advance the timeline and the macro scripts
+        if self._timeline_end:
+            if frame >= self._timeline_end:
+                self.stop_timeline()
+            elif frame >= self._timeline_start:
+                self._timeline_layer.set_status(self._timeline_data,
+                                                (frame - self._timeline_start) * TIMELINE_ROW_SIZE)
+        if self._scripts:
+            finished = [name for name, (vm, _) in self._scripts.items() if not vm.step()]
+            for name in finished:
+                self._finish_script(name)
+
         # set button and stick data of input report
-        input_report.set_button_status(self._controller_state.button_state)
-        if self._controller_state.l_stick_state is None:
-            l_stick = [0x00, 0x00, 0x00]
-        else:
-            l_stick = self._controller_state.l_stick_state
-        if self._controller_state.r_stick_state is None:
-            r_stick = [0x00, 0x00, 0x00]
-        else:
-            r_stick = self._controller_state.r_stick_state
-        input_report.set_stick_status(l_stick, r_stick)
+        input_report.set_controller_status(self._input_mixer.compose())
 
         # set timer byte of input report
         input_report.set_timer(self._input_report_timer)
@@ -98,9 +322,199 @@ class ControllerProtocol(BaseProtocol):
 
         self._controller_state.sig_is_send.set()
 
+        self._sent_frame = max(self._sent_frame, frame)
+        waiters = self._frame_waiters.pop(frame, None)
+        if waiters is not None:
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.set_result(frame)
+
+    def get_frame(self):
+        """
+        :returns index of the next input report containing the controller state. Every input report send
+                 (0x21 replies and 0x30/0x31 full reports) is one frame.
+        """
+        return self._frame
+
+    def schedule_frame_action(self, frame, action):
+        """
+        Schedules a change of the controller state. The change is applied right before the input report of the
+        frame is created, so it is contained in exactly this and the following input reports.
+        Actions of past frames are applied immediately.
+
+        :param frame: frame index, see get_frame
+        :param action: callable without arguments
+        """
+        if frame < self._frame:
+            action()
+        else:
+            self._frame_actions.setdefault(frame, []).append(action)
+
+    def wait_for_frame(self, frame):
+        """
+        :param frame: frame index, see get_frame
+        :returns future resolved with the frame index after the input report of the frame was send.
+                 Raises NotConnected exception if the connection is lost before.
+        """
+        waiter = asyncio.get_event_loop().create_future()
+        if frame <= self._sent_frame:
+            waiter.set_result(frame)
+        elif self.transport is None:
+            waiter.set_exception(NotConnectedError('Transport not registered.'))
+        else:
+            self._frame_waiters.setdefault(frame, []).append(waiter)
+        return waiter
+
+    def play_timeline(self, timeline: Timeline, start=None):
+        """
+        Plays a compiled macro: the timeline layer of the input mixer contains the button and stick status of the
+        respective timeline row in each frame, the sticks of the timeline take priority over all other layers.
+        Replaces a timeline which is still playing.
+
+        :param timeline: Timeline, see joycontrol.macro
+        :param start: frame of the first row, defaults to the next frame
+        :returns future resolved after the input report of the last row was send, see wait_for_frame
+        """
+        if len(timeline) == 0:
+            raise ValueError('Timeline is empty.')
+        if start is None or start < self._frame:
+            start = self._frame
+        self._timeline_data = timeline.get_data()
+        self._timeline_start = start
+        self._timeline_end = start + len(timeline)
+        self.wake_for_frame()
+        return self.wait_for_frame(self._timeline_end - 1)
+
+    def stop_timeline(self):
+        """
+        Stops playing the timeline, its buttons and sticks are released with the next input report.
+        """
+        self._timeline_data = b''
+        self._timeline_start = self._timeline_end = 0
+        self._timeline_layer.clear()
+
+    def is_playing_timeline(self):
+        return self._timeline_start <= self._frame < self._timeline_end
+
+    def run_script(self, program: Program, name='script', priority=PRIORITY_SCRIPT):
+        """
+        Runs a compiled macro script, see joycontrol.macro_vm. The script is stepped once per input report and writes
+        to its own layer of the input mixer, so several scripts of different names can run at the same time.
+        Stops a script of the same name which is still running.
+
+        :param name: name of the script and its layer
+        :param priority: priority of the layer, see joycontrol.input_mixer
+        :returns future resolved with the number of frames produced by the script after it ended
+        """
+        if name in self._scripts:
+            self._finish_script(name)
+        layer = self._input_mixer.create_layer(name, priority=priority)
+        loop = asyncio.get_event_loop()
+        done = loop.create_future()
+        self._scripts[name] = (MacroVM(program, self._controller_state, self, layer=layer, clock=loop.time), done)
+        if self.transport is None:
+            self._finish_script(name, NotConnectedError('Transport not registered.'))
+        self.wake_for_frame()
+        return done
+
+    def stop_script(self, name=None):
+        """
+        Stops a running macro script, its buttons and sticks are released with the next input report.
+        :param name: name of the script, None to stop all scripts
+        """
+        for script_name, (vm, _) in self._scripts.items():
+            if name is None or script_name == name:
+                vm.stop()
+
+    def is_running_script(self, name=None):
+        """
+        :param name: name of the script, None for any script
+        """
+        return bool(self._scripts) if name is None else name in self._scripts
+
+    def _finish_script(self, name, exc=None):
+        vm, done = self._scripts.pop(name)
+        self._input_mixer.remove_layer(vm.get_layer())
+        if not done.done():
+            if exc is not None:
+                done.set_exception(exc)
+            else:
+                done.set_result(vm.frames)
+
+    def get_input_mixer(self) -> InputMixer:
+        return self._input_mixer
+
+    def get_player_lights(self):
+        """
+        :returns raw player lights byte set by the console, None if not set yet
+        """
+        return self._player_lights
+
+    def is_rumbling(self):
+        """
+        :returns True if the last output report contained rumble data with a non zero amplitude
+        """
+        return self._rumbling
+
+    def wake_for_frame(self):
+        """
+        In low latency mode, sends the next input report of the full input report mode immediately.
+        """
+        if self._low_latency and self._input_report_mode is not None:
+            self._report_scheduler.wake(min_spacing=LOW_LATENCY_MIN_SPACING)
+
+    def _get_reply(self, sub_command_id=None) -> InputReport:
+        """
+        :param sub_command_id: id of a sub command with a constant reply, None to get an empty 0x21 input report
+        :returns the reusable reply input report filled with the prepared reply
+        """
+        if sub_command_id is None:
+            self._reply_report.copy_from(self._reply_base)
+        else:
+            self._reply_report.copy_from(self._reply_templates[sub_command_id])
+        return self._reply_report
+
     def get_controller_state(self) -> ControllerState:
         return self._controller_state
 
+    def get_report_rate(self) -> ReportRate:
+        return self._report_scheduler.get_rate()
+
+    def set_report_rate(self, rate: ReportRate):
+        """
+        Changes the input report rate of the full input report mode, also while it is running.
+        """
+        logger.info(f'Setting input report rate to {rate}.')
+        self._report_scheduler.set_rate(rate)
+
+    def is_low_latency(self):
+        return self._low_latency
+
+    def set_low_latency(self, enabled):
+        """
+        :param enabled: If True, controller state changes are send immediately in full input report mode
+        """
+        self._low_latency = enabled
+
+    def get_report_scheduler(self) -> TickScheduler:
+        """
+        :returns scheduler pacing the input reports in full input report mode, provides lateness statistics
+        """
+        return self._report_scheduler
+
+    def get_handshake_pacer(self) -> HandshakePacer:
+        return self._handshake_pacer
+
+    def get_ir_camera(self) -> IrCamera:
+        return self._ir_camera
+
+    def get_time_to_player_lights(self):
+        """
+        :returns seconds from establishing the connection to the Switch setting the player lights,
+                 None if the player lights were not set yet
+        """
+        return self._time_to_player_lights
+
     async def wait_for_output_report(self):
         """
         Waits until an output report from the Switch is received.
@@ -111,6 +525,9 @@ class ControllerProtocol(BaseProtocol):
     def connection_made(self, transport: BaseTransport) -> None:
         logger.debug('Connection established.')
         self.transport = transport
+        self._connection_time = asyncio.get_event_loop().time()
+        self._time_to_player_lights = None
+        self._player_lights = None
 
     def connection_lost(self, exc: Optional[Exception] = None) -> None:
         if self.transport is not None:
@@ -121,6 +538,15 @@ class ControllerProtocol(BaseProtocol):
             if self._controller_state_sender is not None:
                 self._controller_state_sender.set_exception(NotConnectedError)
 
+            frame_waiters, self._frame_waiters = self._frame_waiters, {}
+            for waiters in frame_waiters.values():
+                for waiter in waiters:
+                    if not waiter.done():
+                        waiter.set_exception(NotConnectedError('Connection lost.'))
+
+            for name in list(self._scripts):
+                self._finish_script(name, NotConnectedError('Connection lost.'))
+
     def error_received(self, exc: Exception) -> None:
         # TODO?
         raise NotImplementedError()
@@ -134,10 +560,10 @@ class ControllerProtocol(BaseProtocol):
         if self.transport.is_reading():
             raise ValueError('Transport must be paused in full input report mode')
 
-        # send state at 66Hz
-        send_delay = 0.015
-        await asyncio.sleep(send_delay)
-        last_send_time = time.time()
+        scheduler = self._report_scheduler
+        scheduler.reset_stats()
+        scheduler.start()
+        await scheduler.wait_next()
 
         input_report = InputReport()
         input_report.set_vibrator_input()
@@ -145,64 +571,56 @@ class ControllerProtocol(BaseProtocol):
         if self._input_report_mode is None:
             raise ValueError('Input report mode is not set.')
         input_report.set_input_report_id(self._input_report_mode)
+        # MCU frame currently contained in the input report
+        mcu_frame = None
 
-        reader = asyncio.ensure_future(self.transport.read())
+        reader = asyncio.ensure_future(self.transport.read_into())
 
         try:
             while True:
                 reply_send = False
                 if reader.done():
                     data = await reader
+                    self._handshake_pacer.output_report_received()
 
-                    reader = asyncio.ensure_future(self.transport.read())
+                    reader = asyncio.ensure_future(self.transport.read_into())
 
                     try:
-                        report = OutputReport(list(data))
-                        output_report_id = report.get_output_report_id()
-
-                        if output_report_id == OutputReportID.RUMBLE_ONLY:
-                            # TODO
-                            pass
-                        elif output_report_id == OutputReportID.SUB_COMMAND:
-                            reply_send = await self._reply_to_sub_command(report)
-                        elif output_report_id == OutputReportID.REQUEST_IR_NFC_MCU:
-                            # TODO: This does not reply anything
-                            # reply_send = await self._reply_to_ir_nfc_mcu(report)
-                            await self._reply_to_ir_nfc_mcu(report)
+                        report = OutputReport(data)
+                        self._rumbling = is_rumble_active(report.get_rumble_data())
+                        handler = self._output_report_handlers.get(report.data[1])
+
+                        if handler is not None:
+                            reply_send = await handler(report)
                         else:
-                            logger.warning(f'Report unknown output report "{output_report_id}" - IGNORE')
+                            logger.warning(f'Report unknown output report "0x{report.data[1]:02x}" - IGNORE')
                     except ValueError as v_err:
                         logger.warning(f'Report parsing error "{v_err}" - IGNORE')
                     except NotImplementedError as err:
                         logger.warning(err)
 
                 if reply_send:
-                    # Hack: Adding a delay here to avoid flooding during pairing
-                    await asyncio.sleep(0.3)
+                    # Avoid flooding the console with input reports while it sends sub commands (e.g. during pairing),
+                    # pause until the next request arrives or the console is likely done.
+                    early = await self._handshake_pacer.wait_after_reply(reader)
+                    # the pause is intended, start a new schedule instead of counting the ticks as missed
+                    scheduler.start()
+                    if early:
+                        # handle the next request right away
+                        continue
                 else:
                     # write 0x30 input report.
                     # TODO: set some sensor data
                     input_report.set_6axis_data()
 
-                    # set nfc data
+                    # set IR camera or nfc data
                     if input_report.get_input_report_id() == 0x31:
-                        self._mcu.set_nfc(self._controller_state.get_nfc())
-                        self._mcu.update_nfc_report()
-                        input_report.set_ir_nfc_data(bytes(self._mcu))
+                        mcu_frame = self._set_mcu_data(input_report, mcu_frame)
 
                     await self.write(input_report)
 
-                # calculate delay
-                current_time = time.time()
-                time_delta = time.time() - last_send_time
-                sleep_time = send_delay - time_delta
-                last_send_time = current_time
-
-                if sleep_time < 0:
-                    # logger.warning(f'Code is running {abs(sleep_time)} s too slow!')
-                    sleep_time = 0
-
-                await asyncio.sleep(sleep_time)
+                # wait for the deadline of the next tick
+                await scheduler.wait_next()
 
         except NotConnectedError as err:
             # Stop 0x30 input report mode if disconnected.
@@ -215,27 +633,44 @@ class ControllerProtocol(BaseProtocol):
                 if reader.cancel():
                     await reader
 
+    def _set_mcu_data(self, input_report: InputReport, mcu_frame):
+        """
+        Sets the IR camera or NFC data of a 0x31 input report.
+        :param mcu_frame: MCU frame currently contained in the input report
+        :returns MCU frame contained in the input report
+        """
+        frame = None
+        if self._mcu.get_state() == McuState.IRC:
+            self._ir_camera.set_source(self._controller_state.get_ir_source())
+            frame = self._ir_camera.get_fragment()
+        if frame is None:
+            self._mcu.set_nfc(self._controller_state.get_nfc())
+            self._mcu.update_nfc_report()
+            frame = bytes(self._mcu)
+        # frames are immutable and cached, only copy them if they changed
+        if frame is not mcu_frame:
+            input_report.set_ir_nfc_data(frame)
+        return frame
+
     async def report_received(self, data: Union[bytes, Text], addr: Tuple[str, int]) -> None:
         self._data_received.set()
+        self._handshake_pacer.output_report_received()
 
         try:
-            report = OutputReport(list(data))
+            report = OutputReport(data)
         except ValueError as v_err:
             logger.warning(f'Report parsing error "{v_err}" - IGNORE')
             return
 
-        try:
-            output_report_id = report.get_output_report_id()
-        except NotImplementedError as err:
-            logger.warning(err)
-            return
-
-        if output_report_id == OutputReportID.SUB_COMMAND:
+        self._rumbling = is_rumble_active(report.get_rumble_data())
+        if report.data[1] == OutputReportID.SUB_COMMAND.value:
             await self._reply_to_sub_command(report)
-        # elif output_report_id == OutputReportID.RUMBLE_ONLY:
-        #    pass
         else:
-            logger.warning(f'Output report {output_report_id} not implemented - ignoring')
+            logger.warning(f'Output report 0x{report.data[1]:02x} not implemented - ignoring')
+
+    async def _reply_to_rumble(self, report):
+        # TODO
+        return False
 
     async def _reply_to_ir_nfc_mcu(self, report):
         """
@@ -247,7 +682,18 @@ class ControllerProtocol(BaseProtocol):
 
         # logging.info(f'received output report - Request MCU sub command {sub_command}')
 
-        if self._mcu.get_action() in (Action.READ_TAG, Action.READ_TAG_2, Action.READ_FINISHED):
+        # IR camera fragment acknowledgement
+        if sub_command == 0x03:
+            if self._mcu.get_state() == McuState.IRC:
+                requested = sub_command_data[2] if sub_command_data[1] == 0x01 else None
+                self._ir_camera.acknowledge(sub_command_data[3], requested=requested)
+            return
+
+        action = self._mcu.get_action()
+        if action in (Action.READ_TAG, Action.READ_TAG_2):
+            return
+        # a read tag can only be written
+        if action == Action.READ_FINISHED and not (sub_command == 0x02 and sub_command_data[0] == 0x08):
             return
 
         # Request mcu state
@@ -276,70 +722,70 @@ class ControllerProtocol(BaseProtocol):
                 self._mcu.set_action(Action.NON)
             elif sub_command_data[0] == 0x06:
                 self._mcu.set_action(Action.READ_TAG)
+            # 8: write NTAG
+            elif sub_command_data[0] == 0x08:
+                self._receive_ntag_write(sub_command_data)
             else:
-                logging.info(f'Unknown sub_command_data arg {sub_command_data}')
+                logging.info(f'Unknown sub_command_data arg {bytes(sub_command_data).hex()}')
         else:
             logging.info(f'Unknown MCU sub command {sub_command}')
 
-    async def _reply_to_sub_command(self, report):
-        # classify sub command
-        try:
-            sub_command = report.get_sub_command()
-        except NotImplementedError as err:
-            logger.warning(err)
-            return False
-
-        if sub_command is None:
-            raise ValueError('Received output report does not contain a sub command')
-
-        logging.info(f'received output report - Sub command {sub_command}')
+    def _receive_ntag_write(self, sub_command_data):
+        """
+        Collects the packets of a NTAG write command and writes the tag after the last one.
+        Packet layout: command (0x08), packet id, unknown, packet flag, data length, data
+        """
+        packet_id, flag, length = sub_command_data[1], sub_command_data[3], sub_command_data[4]
+        if packet_id == 0:
+            self._ntag_write_data = bytearray()
+        elif packet_id != self._ntag_write_packet_id:
+            logger.warning(f'Expected NTAG write packet {self._ntag_write_packet_id}, got {packet_id} - IGNORE')
+            return
+        self._ntag_write_data += sub_command_data[5:5 + length]
+        self._ntag_write_packet_id = packet_id + 1
 
-        sub_command_data = report.get_sub_command_data()
-        assert sub_command_data is not None
+        if flag != MCU_PACKET_LAST:
+            self._mcu.set_action(Action.WRITE_TAG)
+            return
 
+        data, self._ntag_write_data = self._ntag_write_data, bytearray()
+        self._ntag_write_packet_id = 0
+        content = self._controller_state.get_nfc()
         try:
-            # answer to sub command
-            if sub_command == SubCommand.REQUEST_DEVICE_INFO:
-                await self._command_request_device_info(sub_command_data)
-
-            elif sub_command == SubCommand.SET_SHIPMENT_STATE:
-                await self._command_set_shipment_state(sub_command_data)
-
-            elif sub_command == SubCommand.SPI_FLASH_READ:
-                await self._command_spi_flash_read(sub_command_data)
-
-            elif sub_command == SubCommand.SET_INPUT_REPORT_MODE:
-                await self._command_set_input_report_mode(sub_command_data)
-
-            elif sub_command == SubCommand.TRIGGER_BUTTONS_ELAPSED_TIME:
-                await self._command_trigger_buttons_elapsed_time(sub_command_data)
+            if content is None:
+                raise ValueError('no NFC content is set')
+            content = apply_ntag_write(content, data)
+        except ValueError as err:
+            logger.warning(f'NTAG write failed - {err}')
+            self._mcu.set_action(Action.START_TAG_POLLING)
+            return
 
-            elif sub_command == SubCommand.ENABLE_6AXIS_SENSOR:
-                await self._command_enable_6axis_sensor(sub_command_data)
+        self._controller_state.write_nfc(content)
+        self._mcu.set_action(Action.WRITE_FINISHED)
 
-            elif sub_command == SubCommand.ENABLE_VIBRATION:
-                await self._command_enable_vibration(sub_command_data)
+    async def _reply_to_sub_command(self, report):
+        if len(report.data) < 12:
+            raise ValueError('Received output report does not contain a sub command')
 
-            elif sub_command == SubCommand.SET_NFC_IR_MCU_CONFIG:
-                await self._command_set_nfc_ir_mcu_config(sub_command_data)
+        # classify sub command
+        sub_command = report.data[11]
+        handler = self._sub_command_handlers.get(sub_command)
+        if handler is None:
+            logger.warning(f'Sub command 0x{sub_command:02x} not implemented - ignoring')
+            return False
 
-            elif sub_command == SubCommand.SET_NFC_IR_MCU_STATE:
-                await self._command_set_nfc_ir_mcu_state(sub_command_data)
+        logger.info(f'received output report - Sub command 0x{sub_command:02x}')
 
-            elif sub_command == SubCommand.SET_PLAYER_LIGHTS:
-                await self._command_set_player_lights(sub_command_data)
-            else:
-                logger.warning(f'Sub command 0x{sub_command.value:02x} not implemented - ignoring')
-                return False
+        try:
+            # answer to sub command
+            await handler(report.data[12:])
         except NotImplementedError as err:
-            logger.error(f'Failed to answer {sub_command} - {err}')
+            logger.error(f'Failed to answer sub command 0x{sub_command:02x} - {err}')
             return False
         return True
 
     async def _command_request_device_info(self, sub_command_data):
-        input_report = InputReport()
-        input_report.set_input_report_id(0x21)
-        input_report.set_misc()
+        input_report = self._get_reply()
 
         address = self.transport.get_extra_info('sockname')
         assert address is not None
@@ -351,42 +797,63 @@ class ControllerProtocol(BaseProtocol):
         await self.write(input_report)
 
     async def _command_set_shipment_state(self, sub_command_data):
-        input_report = InputReport()
-        input_report.set_input_report_id(0x21)
-        input_report.set_misc()
-
-        input_report.set_ack(0x80)
-        input_report.reply_to_subcommand_id(0x08)
-
-        await self.write(input_report)
+        await self.write(self._get_reply(SubCommand.SET_SHIPMENT_STATE.value))
 
     async def _command_spi_flash_read(self, sub_command_data):
         """
         Replies with 0x21 input report containing requested data from the flash memory.
         :param sub_command_data: input report sub command data bytes
         """
-        input_report = InputReport()
-        input_report.set_input_report_id(0x21)
-        input_report.set_misc()
+        # decoded outside of the coroutine, keeps its frame small while the reply is send
+        self._reply_report.copy_from(self._spi_reply_cache.get_request(sub_command_data))
+        await self.write(self._reply_report)
 
-        input_report.set_ack(0x90)
+    async def _command_spi_flash_write(self, sub_command_data):
+        """
+        Writes data to the flash memory, e.g. user calibration from the calibration menu.
+        The write is persisted in the background if a journal is attached to the flash memory.
+        :param sub_command_data: input report sub command data bytes
+        """
+        offset = int.from_bytes(sub_command_data[0:4], 'little')
+        size = sub_command_data[4]
 
-        # parse offset
-        offset = 0
-        digit = 1
-        for i in range(4):
-            offset += sub_command_data[i] * digit
-            digit *= 0x100
+        # 0x00 success, 0x01 write protected
+        status = 0x01
+        if self.spi_flash is not None and size <= 0x1D:
+            try:
+                self.spi_flash.write(offset, bytes(sub_command_data[5:5 + size]))
+                status = 0x00
+                # decodes the flash memory again, applies new user calibration to the sticks
+                self._controller_state.get_flash_layout()
+                logger.info(f'Wrote {size} bytes to flash memory at {hex(offset)}.')
+            except ValueError as err:
+                logger.warning(err)
+
+        input_report = self._get_reply()
+        input_report.set_ack(0x80)
+        input_report.sub_0x11_spi_flash_write(status)
+        await self.write(input_report)
 
-        size = sub_command_data[4]
+    async def _command_spi_sector_erase(self, sub_command_data):
+        """
+        Erases the 4 KiB flash memory sector containing the given offset.
+        :param sub_command_data: input report sub command data bytes
+        """
+        offset = int.from_bytes(sub_command_data[0:4], 'little')
 
+        status = 0x01
         if self.spi_flash is not None:
-            spi_flash_data = self.spi_flash[offset: offset + size]
-            input_report.sub_0x10_spi_flash_read(offset, size, spi_flash_data)
-        else:
-            spi_flash_data = size * [0x00]
-            input_report.sub_0x10_spi_flash_read(offset, size, spi_flash_data)
-
+            try:
+                self.spi_flash.erase(offset - offset % FLASH_SECTOR_SIZE)
+                status = 0x00
+                self._controller_state.get_flash_layout()
+                logger.info(f'Erased flash memory sector at {hex(offset)}.')
+            except ValueError as err:
+                logger.warning(err)
+
+        input_report = self._get_reply()
+        input_report.set_ack(0x80)
+        input_report.sub_0x12_spi_sector_erase(status)
         await self.write(input_report)
 
     async def _command_set_input_report_mode(self, sub_command_data):
@@ -419,114 +886,78 @@ class ControllerProtocol(BaseProtocol):
         )
 
         # Send acknowledgement
-        input_report = InputReport()
-        input_report.set_input_report_id(0x21)
-        input_report.set_misc()
-
-        input_report.set_ack(0x80)
-        input_report.reply_to_subcommand_id(0x03)
-
-        await self.write(input_report)
+        await self.write(self._get_reply(SubCommand.SET_INPUT_REPORT_MODE.value))
 
     async def _command_trigger_buttons_elapsed_time(self, sub_command_data):
-        input_report = InputReport()
-        input_report.set_input_report_id(0x21)
-        input_report.set_misc()
-
-        input_report.set_ack(0x83)
-        input_report.reply_to_subcommand_id(SubCommand.TRIGGER_BUTTONS_ELAPSED_TIME)
-        # Hack: We assume this command is only used during pairing - Set values so the Switch assigns a player number
-        if self.controller == Controller.PRO_CONTROLLER:
-            input_report.sub_0x04_trigger_buttons_elapsed_time(L_ms=3000, R_ms=3000)
-        elif self.controller in (Controller.JOYCON_L, Controller.JOYCON_R):
-            # TODO: What do we do if we want to pair a combined JoyCon?
-            input_report.sub_0x04_trigger_buttons_elapsed_time(SL_ms=3000, SR_ms=3000)
-        else:
+        if SubCommand.TRIGGER_BUTTONS_ELAPSED_TIME.value not in self._reply_templates:
             raise NotImplementedError(self.controller)
 
-        await self.write(input_report)
+        await self.write(self._get_reply(SubCommand.TRIGGER_BUTTONS_ELAPSED_TIME.value))
 
     async def _command_enable_6axis_sensor(self, sub_command_data):
-        input_report = InputReport()
-        input_report.set_input_report_id(0x21)
-        input_report.set_misc()
-
-        input_report.set_ack(0x80)
-        input_report.reply_to_subcommand_id(0x40)
-
-        await self.write(input_report)
+        await self.write(self._get_reply(SubCommand.ENABLE_6AXIS_SENSOR.value))
 
     async def _command_enable_vibration(self, sub_command_data):
-        input_report = InputReport()
-        input_report.set_input_report_id(0x21)
-        input_report.set_misc()
-
-        input_report.set_ack(0x80)
-        input_report.reply_to_subcommand_id(SubCommand.ENABLE_VIBRATION.value)
-
-        await self.write(input_report)
+        await self.write(self._get_reply(SubCommand.ENABLE_VIBRATION.value))
 
     async def _command_set_nfc_ir_mcu_config(self, sub_command_data):
-        input_report = InputReport()
-        input_report.set_input_report_id(0x21)
-        input_report.set_misc()
-
+        input_report = self._get_reply()
         input_report.set_ack(0xA0)
         input_report.reply_to_subcommand_id(SubCommand.SET_NFC_IR_MCU_CONFIG.value)
 
         self._mcu.update_status()
-        data = list(bytes(self._mcu)[0:34])
-        crc = crc8()
-        crc.update(bytes(data[:-1]))
-        checksum = crc.digest()
-        data[-1] = ord(checksum)
-    
-        for i in range(len(data)):
-            input_report.data[16+i] = data[i]
-        
+        data = bytearray(bytes(self._mcu)[0:34])
+        data[-1] = utils.crc8(data[:-1])
+        input_report.data[16:16 + len(data)] = data
+
+        # Set IR mode cmd: IR mode, index of the last fragment of a frame, MCU firmware version
+        if sub_command_data[0] == 0x23 and sub_command_data[1] == 0x01:
+            if sub_command_data[2] == IR_MODE_IMAGE_TRANSFER:
+                try:
+                    self._ir_camera.start(IrResolution.from_fragments(sub_command_data[3] + 1))
+                except ValueError as err:
+                    logger.warning(err)
+            else:
+                logger.info(f'IR mode {sub_command_data[2]} not implemented')
+                self._ir_camera.stop()
+        # Write IR registers cmd
+        elif sub_command_data[0] == 0x23 and sub_command_data[1] == 0x04:
+            logger.debug(f'IR register write {bytes(sub_command_data[2:]).hex()}')
         # Set MCU mode cmd
-        if sub_command_data[1] == 0:
+        elif sub_command_data[1] == 0:
             if sub_command_data[2] == 0:
                 self._mcu.set_state(McuState.STAND_BY)
             elif sub_command_data[2] == 4:
                 self._mcu.set_state(McuState.NFC)
+            elif sub_command_data[2] == 5:
+                self._mcu.set_state(McuState.IRC)
             else:
                 logger.info(f"unknown mcu state {sub_command_data[2]}")
         else:
-            logger.info(f"unknown mcu config command {sub_command_data}")
+            logger.info(f"unknown mcu config command {bytes(sub_command_data).hex()}")
 
         await self.write(input_report)
 
     async def _command_set_nfc_ir_mcu_state(self, sub_command_data):
-        input_report = InputReport()
-        input_report.set_input_report_id(0x21)
-        input_report.set_misc()
-
         if sub_command_data[0] == 0x01:
             # 0x01 = Resume
-            input_report.set_ack(0x80)
-            input_report.reply_to_subcommand_id(SubCommand.SET_NFC_IR_MCU_STATE.value)
             self._mcu.set_action(Action.NON)
             self._mcu.set_state(McuState.STAND_BY)
         elif sub_command_data[0] == 0x00:
             # 0x00 = Suspend
-            input_report.set_ack(0x80)
-            input_report.reply_to_subcommand_id(SubCommand.SET_NFC_IR_MCU_STATE.value)
             self._mcu.set_state(McuState.STAND_BY)
         else:
             raise NotImplementedError(f'Argument {sub_command_data[0]} of {SubCommand.SET_NFC_IR_MCU_STATE} '
                                       f'not implemented.')
 
-        await self.write(input_report)
+        await self.write(self._get_reply(SubCommand.SET_NFC_IR_MCU_STATE.value))
 
     async def _command_set_player_lights(self, sub_command_data):
-        input_report = InputReport()
-        input_report.set_input_report_id(0x21)
-        input_report.set_misc()
+        self._player_lights = sub_command_data[0]
+        await self.write(self._get_reply(SubCommand.SET_PLAYER_LIGHTS.value))
 
-        input_report.set_ack(0x80)
-        input_report.reply_to_subcommand_id(SubCommand.SET_PLAYER_LIGHTS.value)
-
-        await self.write(input_report)
+        if self._time_to_player_lights is None and self._connection_time is not None:
+            self._time_to_player_lights = asyncio.get_event_loop().time() - self._connection_time
+            logger.info(f'Player lights set {self._time_to_player_lights:.3f}s after connecting.')
 
         self.sig_set_player_lights.set()
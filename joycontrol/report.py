@@ -1,29 +1,58 @@
+import struct
 from enum import Enum
 
 from joycontrol.controller import Controller
 
 
+# Size of input reports by input report id, including the 0xA1 prefix
+_INPUT_REPORT_SIZES = {
+    0x21: 51,
+    0x30: 14,
+    0x31: 363
+}
+_INPUT_REPORT_DEFAULT_SIZE = 51
+_INPUT_REPORT_BUFFER_SIZE = 364
+
+_ZEROS = bytes(_INPUT_REPORT_BUFFER_SIZE)
+
+
 class InputReport:
     """
     Class to create Input Reports. Reference:
     https://github.com/dekuNukem/Nintendo_Switch_Reverse_Engineering/blob/master/bluetooth_hid_notes.md
+
+    The report is backed by a preallocated bytearray. Setters write into it in place and get_view() returns
+    a memoryview of the report without copying.
     """
+    __slots__ = ('data', '_view', '_size')
+
     def __init__(self, data=None):
         if not data:
-            self.data = [0x00] * 364
+            self.data = bytearray(_INPUT_REPORT_BUFFER_SIZE)
             # all input reports are prepended with 0xA1
             self.data[0] = 0xA1
         else:
             if data[0] != 0xA1:
                 raise ValueError('Input reports must start with 0xA1')
-            self.data = data
+            self.data = bytearray(data)
+        self._view = memoryview(self.data)
+        self._size = self._get_size(self.data[1])
+
+    def _get_size(self, _id):
+        return min(_INPUT_REPORT_SIZES.get(_id, _INPUT_REPORT_DEFAULT_SIZE), len(self.data))
+
+    def copy_from(self, other):
+        """
+        Overwrites this report with the contents of another report (e.g. a prepared reply template).
+        """
+        self._view[:] = other._view
+        self._size = other._size
 
     def clear_sub_command(self):
         """
         Clear sub command reply data of 0x21 input reports
         """
-        for i in range(14, 51):
-            self.data[i] = 0x00
+        self.data[14:51] = _ZEROS[14:51]
 
     def get_stick_data(self):
         # TODO: Not every input report has stick data
@@ -42,6 +71,7 @@ class InputReport:
                          etc... (TODO)
         """
         self.data[1] = _id
+        self._size = self._get_size(_id)
 
     def get_input_report_id(self):
         return self.data[1]
@@ -60,7 +90,7 @@ class InputReport:
         """
         Sets the button status bytes
         """
-        self.data[4:7] = iter(button_status)
+        self.data[4:7] = bytes(button_status)
 
     def set_stick_status(self, left_stick, right_stick):
         """
@@ -69,6 +99,13 @@ class InputReport:
         self.set_left_analog_stick(bytes(left_stick))
         self.set_right_analog_stick(bytes(right_stick))
 
+    def set_controller_status(self, status_bytes):
+        """
+        Sets button and stick status bytes at once.
+        :param status_bytes: 9 bytes, 3 button bytes followed by the left and right stick bytes
+        """
+        self.data[4:13] = status_bytes
+
     def set_left_analog_stick(self, left_stick_bytes):
         """
         Set left analog stick status bytes.
@@ -109,16 +146,14 @@ class InputReport:
         TODO
         """
         # HACK: Set all 0 for now
-        for i in range(14, 50):
-            self.data[i] = 0x00
+        self.data[14:50] = _ZEROS[14:50]
 
     def set_ir_nfc_data(self, data):
         if 50 + len(data) > len(self.data):
             raise ValueError('Too much data.')
 
         # write to data
-        for i in range(len(data)):
-            self.data[50 + i] = data[i]
+        self.data[50:50 + len(data)] = data
 
     def reply_to_subcommand_id(self, _id):
         if isinstance(_id, SubCommand):
@@ -151,10 +186,10 @@ class InputReport:
 
         # sub command reply data
         offset = 16
-        self.data[offset: offset + 2] = fm_version
+        self.data[offset: offset + 2] = bytes(fm_version)
         self.data[offset + 2] = controller.value
         self.data[offset + 3] = 0x02
-        self.data[offset + 4: offset + 10] = mac
+        self.data[offset + 4: offset + 10] = bytes(mac)
         self.data[offset + 10] = 0x01
         self.data[offset + 11] = 0x01
 
@@ -167,12 +202,22 @@ class InputReport:
         self.reply_to_subcommand_id(0x10)
 
         # write offset to data
-        for i in range(16, 16 + 4):
-            self.data[i] = offset % 0x100
-            offset = offset // 0x100
+        struct.pack_into('<IB', self.data, 16, offset, size)
+        self.data[21:21+len(data)] = bytes(data)
 
-        self.data[20] = size
-        self.data[21:21+len(data)] = data
+    def sub_0x11_spi_flash_write(self, status):
+        """
+        :param status: 0x00 success, 0x01 write protected
+        """
+        self.reply_to_subcommand_id(0x11)
+        self.data[16] = status
+
+    def sub_0x12_spi_sector_erase(self, status):
+        """
+        :param status: 0x00 success, 0x01 write protected
+        """
+        self.reply_to_subcommand_id(0x12)
+        self.data[16] = status
 
     def sub_0x04_trigger_buttons_elapsed_time(self, L_ms=0, R_ms=0, ZL_ms=0, ZR_ms=0, SL_ms=0, SR_ms=0, HOME_ms=0):
         """
@@ -181,31 +226,22 @@ class InputReport:
         if any(ms > 10*0xffff for ms in (L_ms, R_ms, ZL_ms, ZR_ms, SL_ms, SR_ms, HOME_ms)):
             raise ValueError(f'Values can not exceed {10*0xffff} ms.')
 
-        def set(offset, ms):
-            # reply data offset
-            sub_command_offset = 16
-            value = int(ms // 10)
-            self.data[sub_command_offset + offset] = 0xff & value
-            self.data[sub_command_offset + offset + 1] = (0xff00 & value) >> 8
-
-        set(0, L_ms)
-        set(2, R_ms)
-        set(4, ZL_ms)
-        set(6, ZR_ms)
-        set(8, SL_ms)
-        set(10, SR_ms)
-        set(12, HOME_ms)
+        # reply data offset 16, one 16 bit little endian value per button
+        struct.pack_into('<7H', self.data, 16,
+                         *(int(ms // 10) for ms in (L_ms, R_ms, ZL_ms, ZR_ms, SL_ms, SR_ms, HOME_ms)))
+
+    def get_view(self):
+        """
+        :returns memoryview of the report bytes to send, the length depends on the input report id.
+                 The view is only valid until the report is modified.
+        """
+        return self._view[:self._size]
+
+    def __len__(self):
+        return self._size
 
     def __bytes__(self):
-        _id = self.get_input_report_id()
-        if _id == 0x21:
-            return bytes(self.data[:51])
-        elif _id == 0x30:
-            return bytes(self.data[:14])
-        elif _id == 0x31:
-            return bytes(self.data[:363])
-        else:
-            return bytes(self.data[:51])
+        return bytes(self._view[:self._size])
 
     def __str__(self):
         _id = f'Input {self.get_input_report_id():x}'
@@ -223,6 +259,8 @@ class SubCommand(Enum):
     TRIGGER_BUTTONS_ELAPSED_TIME = 0x04
     SET_SHIPMENT_STATE = 0x08
     SPI_FLASH_READ = 0x10
+    SPI_FLASH_WRITE = 0x11
+    SPI_SECTOR_ERASE = 0x12
     SET_NFC_IR_MCU_CONFIG = 0x21
     SET_NFC_IR_MCU_STATE = 0x22
     SET_PLAYER_LIGHTS = 0x30
@@ -237,13 +275,28 @@ class OutputReportID(Enum):
 
 
 class OutputReport:
+    """
+    Class to create and parse Output Reports.
+
+    Received data is wrapped in a read-only memoryview without copying, the raw report id is data[1] and the raw
+    sub command id is data[11].
+    """
+    __slots__ = ('data',)
+
     def __init__(self, data=None):
         if not data:
-            data = 50 * [0x00]
+            data = bytearray(50)
             data[0] = 0xA2
-        elif data[0] != 0xA2:
-            raise ValueError('Output reports must start with a 0xA2 byte!')
-        self.data = data
+            self.data = memoryview(data)
+        else:
+            if data[0] != 0xA2:
+                raise ValueError('Output reports must start with a 0xA2 byte!')
+            if isinstance(data, memoryview) and data.readonly:
+                self.data = data
+            else:
+                if not isinstance(data, (bytes, bytearray, memoryview)):
+                    data = bytes(data)
+                self.data = memoryview(data).toreadonly()
 
     def get_output_report_id(self):
         try:
@@ -0,0 +1,343 @@
+import asyncio
+import enum
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Report periods in seconds
+NORMAL_PERIOD = 0.015
+# Period of a real Pro Controller
+FAST_PERIOD = 0.008
+
+# Adaptive rate: number of ticks evaluated at once
+ADAPTIVE_WINDOW = 64
+# Adaptive rate: fall back to the normal period if more ticks of a window are late
+ADAPTIVE_MAX_LATE_TICKS = ADAPTIVE_WINDOW // 10
+# Adaptive rate: number of windows without late ticks required before trying the fast period again
+ADAPTIVE_RECOVERY_WINDOWS = 8
+
+# Handshake pacing: longest pause after a sub command reply in seconds
+HANDSHAKE_MAX_PAUSE = 0.3
+# Handshake pacing: pause after a reply as multiple of the average output report inter-arrival time
+HANDSHAKE_PAUSE_FACTOR = 2
+# Handshake pacing: weight of a new inter-arrival time in the moving average
+HANDSHAKE_SMOOTHING = 0.25
+
+
+class ReportRate(enum.Enum):
+    """
+    Input report rates of the full input report mode.
+    """
+    # 15ms period (~66Hz)
+    NORMAL = 'normal'
+    # 8ms period (125Hz)
+    FAST = 'fast'
+    # 8ms period, falls back to 15ms while the host can not keep up
+    ADAPTIVE = 'adaptive'
+
+    def get_period(self):
+        """
+        :returns report period in seconds, the initial period for ReportRate.ADAPTIVE
+        """
+        if self == ReportRate.NORMAL:
+            return NORMAL_PERIOD
+        elif self in (ReportRate.FAST, ReportRate.ADAPTIVE):
+            return FAST_PERIOD
+        else:
+            raise NotImplementedError()
+
+    @staticmethod
+    def from_arg(arg):
+        if arg in ('normal', '15'):
+            return ReportRate.NORMAL
+        elif arg in ('fast', '8'):
+            return ReportRate.FAST
+        elif arg == 'adaptive':
+            return ReportRate.ADAPTIVE
+        else:
+            raise ValueError(f'Unknown report rate "{arg}".')
+
+
+def _release_waiter(waiter, early):
+    if not waiter.done():
+        waiter.set_result(early)
+
+
+class TickScheduler:
+    """
+    Paces periodic input reports using absolute deadlines on the event loop clock.
+
+    Tick N is due at t0 + N * period. Since deadlines do not depend on when the previous tick actually happened,
+    lateness of a single tick does not accumulate into drift. If the sender falls behind by one or more whole periods,
+    the missed ticks are skipped instead of being sent in a burst.
+
+    A pending tick can be released early using wake(), the schedule is then re-anchored at the early tick.
+    """
+    def __init__(self, rate: ReportRate = ReportRate.NORMAL, loop=None):
+        """
+        :param rate: report rate
+        :param loop: event loop providing the monotonic clock, defaults to the current event loop
+        """
+        self._loop = loop if loop is not None else asyncio.get_event_loop()
+
+        self._rate = rate
+        self._period = rate.get_period()
+
+        self._t0 = None
+        self._tick = 0
+        self._deadline = None
+        # time the last tick was released, used to measure the time spent between two ticks
+        self._woken = None
+
+        # future and timer handle of a pending tick
+        self._waiter = None
+        self._wait_handle = None
+
+        # adaptive rate state
+        self._window_ticks = 0
+        self._window_late_ticks = 0
+        self._clean_windows = 0
+
+        # optional callable(lateness, cost) invoked for every tick
+        self._tick_callback = None
+
+        # statistics
+        self.tick_count = 0
+        self.skipped_ticks = 0
+        self.last_lateness = 0.0
+        self.max_lateness = 0.0
+        self.last_cost = 0.0
+
+    def get_rate(self) -> ReportRate:
+        return self._rate
+
+    def set_rate(self, rate: ReportRate):
+        """
+        Changes the report rate, takes effect with the next tick.
+        """
+        self._rate = rate
+        self._window_ticks = self._window_late_ticks = self._clean_windows = 0
+        self._set_period(rate.get_period())
+
+    def get_period(self):
+        return self._period
+
+    def _set_period(self, period):
+        if period == self._period:
+            return
+        self._period = period
+        # continue the schedule from the last deadline with the new period
+        if self._deadline is not None:
+            self._t0 = self._deadline
+            self._tick = 0
+
+    def set_tick_callback(self, callback):
+        """
+        :param callback: callable(lateness, cost) invoked for every tick with the lateness of the tick and the time
+                         spent between the previous tick and this one, or None to remove the callback
+        """
+        self._tick_callback = callback
+
+    def start(self):
+        """
+        (Re-)anchors the schedule, the next tick is due one period from now.
+        """
+        self._t0 = self._loop.time()
+        self._tick = 0
+        self._deadline = None
+        self._woken = None
+
+    def reset_stats(self):
+        self.tick_count = 0
+        self.skipped_ticks = 0
+        self.last_lateness = 0.0
+        self.max_lateness = 0.0
+        self.last_cost = 0.0
+
+    async def wait_next(self):
+        """
+        Waits for the deadline of the next tick.
+
+        If the deadline already passed by less than a period, returns immediately (the tick is compressed).
+        If whole periods were missed, those ticks are skipped and the schedule continues with the next deadline
+        that can still be met, so the long term rate stays constant.
+
+        :returns lateness of this tick in seconds
+        """
+        if self._t0 is None:
+            self.start()
+
+        now = self._loop.time()
+        if self._woken is not None:
+            self.last_cost = now - self._woken
+
+        self._tick += 1
+        deadline = self._t0 + self._tick * self._period
+
+        missed = 0
+        if now < deadline:
+            self._waiter = self._loop.create_future()
+            self._wait_handle = self._loop.call_at(deadline, _release_waiter, self._waiter, False)
+            try:
+                early = await self._waiter
+            finally:
+                self._wait_handle.cancel()
+                self._waiter = self._wait_handle = None
+
+            if early:
+                # start a new schedule at the early tick
+                self._t0 = deadline = self._loop.time()
+                self._tick = 0
+        else:
+            # still yield to the event loop, otherwise a sender running late could starve the reader
+            await asyncio.sleep(0)
+
+            missed = int((now - deadline) // self._period)
+            if missed:
+                self._tick += missed
+                self.skipped_ticks += missed
+                deadline += missed * self._period
+                logger.debug(f'Skipped {missed} input report tick(s).')
+
+        self._deadline = deadline
+        self._woken = self._loop.time()
+        lateness = self._woken - deadline
+
+        self.tick_count += 1
+        self.last_lateness = lateness
+        if lateness > self.max_lateness:
+            self.max_lateness = lateness
+
+        if self._rate == ReportRate.ADAPTIVE:
+            self._adapt(lateness, missed)
+
+        if self._tick_callback is not None:
+            self._tick_callback(lateness, self.last_cost)
+
+        return lateness
+
+    def wake(self, min_spacing=0.0):
+        """
+        Releases a pending tick early, but not earlier than min_spacing seconds after the previous tick.
+
+        :param min_spacing: minimum time between the previous and the early tick in seconds
+        :returns True if a pending tick will be released early, False if no tick is pending
+        """
+        if self._waiter is None or self._waiter.done():
+            return False
+
+        now = self._loop.time()
+        earliest = now if self._woken is None else self._woken + min_spacing
+        if earliest <= now:
+            self._waiter.set_result(True)
+        elif earliest < self._wait_handle.when():
+            self._wait_handle.cancel()
+            self._wait_handle = self._loop.call_at(earliest, _release_waiter, self._waiter, True)
+        return True
+
+    def _adapt(self, lateness, missed):
+        """
+        Switches between the fast and the normal period depending on how many ticks of a window were late.
+        """
+        self._window_ticks += 1
+        if missed or lateness > self._period / 2:
+            self._window_late_ticks += 1
+
+        if self._window_ticks < ADAPTIVE_WINDOW:
+            return
+
+        if self._window_late_ticks > ADAPTIVE_MAX_LATE_TICKS:
+            self._clean_windows = 0
+            if self._period != NORMAL_PERIOD:
+                logger.info(f'{self._window_late_ticks}/{self._window_ticks} input reports were late, '
+                            f'reducing report rate.')
+                self._set_period(NORMAL_PERIOD)
+        elif self._window_late_ticks == 0:
+            self._clean_windows += 1
+            if self._period != FAST_PERIOD and self._clean_windows >= ADAPTIVE_RECOVERY_WINDOWS:
+                logger.info('Input reports are on time, increasing report rate.')
+                self._clean_windows = 0
+                self._set_period(FAST_PERIOD)
+        else:
+            self._clean_windows = 0
+
+        self._window_ticks = self._window_late_ticks = 0
+
+
+class HandshakePacer:
+    """
+    Paces input reports after sub command replies in full input report mode.
+
+    While the console sends sub commands (e.g. during pairing), regular input reports between the replies are not
+    wanted. After a reply, the sender pauses until the next output report of the console arrives or a pause derived
+    from the observed output report inter-arrival times expires, whichever happens first.
+    """
+    def __init__(self, min_pause=NORMAL_PERIOD, max_pause=HANDSHAKE_MAX_PAUSE, loop=None, scheduler=None):
+        """
+        :param min_pause: shortest pause after a reply in seconds, not used if a scheduler is given
+        :param max_pause: longest pause after a reply in seconds, also used before any inter-arrival time is known
+        :param loop: event loop providing the monotonic clock, defaults to the current event loop
+        :param scheduler: TickScheduler of the input reports, the shortest pause follows its current period, also
+                          while an adaptive rate changes it
+        """
+        self._loop = loop if loop is not None else asyncio.get_event_loop()
+        self._min_pause = min_pause
+        self._max_pause = max_pause
+        self._scheduler = scheduler
+
+        self._last_arrival = None
+        # moving average of the output report inter-arrival time
+        self._interval = None
+
+        # statistics
+        self.pauses = 0
+        self.early_pauses = 0
+        self.paused_time = 0.0
+
+    def output_report_received(self):
+        """
+        Records the arrival of an output report.
+        """
+        now = self._loop.time()
+        if self._last_arrival is not None:
+            # long gaps without requests are not part of a handshake
+            interval = min(now - self._last_arrival, self._max_pause)
+            if self._interval is None:
+                self._interval = interval
+            else:
+                self._interval += HANDSHAKE_SMOOTHING * (interval - self._interval)
+        self._last_arrival = now
+
+    def get_pause(self):
+        """
+        :returns current pause after a reply in seconds
+        """
+        if self._interval is None:
+            return self._max_pause
+        return min(self._max_pause, max(self.get_min_pause(), HANDSHAKE_PAUSE_FACTOR * self._interval))
+
+    def get_min_pause(self):
+        """
+        :returns shortest pause after a reply in seconds, the current period of the scheduler if given
+        """
+        if self._scheduler is not None:
+            return self._scheduler.get_period()
+        return self._min_pause
+
+    async def wait_after_reply(self, reader: asyncio.Future):
+        """
+        Pauses after a reply until the reader completes or the pause expires.
+
+        :param reader: future completed when the next output report was received
+        :returns True if the pause ended early because of an output report
+        """
+        start = self._loop.time()
+        if not reader.done():
+            await asyncio.wait([reader], timeout=self.get_pause())
+
+        self.pauses += 1
+        self.paused_time += self._loop.time() - start
+        if reader.done():
+            self.early_pauses += 1
+            return True
+        return False
@@ -6,6 +6,7 @@ import dbus
 import pkg_resources
 
 from joycontrol import utils
+from joycontrol.capture import CaptureWriter
 from joycontrol.device import HidDevice
 from joycontrol.report import InputReport
 from joycontrol.transport import L2CAP_Transport
@@ -114,18 +115,21 @@ async def create_hid_server(protocol_factory, ctl_psm=17, itr_psm=19, device_id=
         client_itr.setblocking(False)
 
     # create transport for the established connection and activate the HID protocol
-    transport = L2CAP_Transport(asyncio.get_event_loop(), protocol, client_itr, client_ctl, 50, capture_file=capture_file)
+    capture = None
+    if capture_file is not None:
+        capture = CaptureWriter(capture_file, controller=protocol.controller, address=client_itr.getsockname()[0])
+    transport = L2CAP_Transport(asyncio.get_event_loop(), protocol, client_itr, client_ctl, 50, capture=capture)
     protocol.connection_made(transport)
 
     # HACK: send some empty input reports until the Switch decides to reply
     future = asyncio.ensure_future(_send_empty_input_reports(transport))
     await protocol.wait_for_output_report()
-    """
+
+    # the Switch replied, stop sending empty reports
     future.cancel()
     try:
         await future
     except asyncio.CancelledError:
         pass
-    """
 
     return protocol.transport, protocol
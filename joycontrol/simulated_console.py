@@ -0,0 +1,384 @@
+import asyncio
+import logging
+import random
+
+from joycontrol.report import OutputReport, OutputReportID, SubCommand
+
+logger = logging.getLogger(__name__)
+
+# Sub commands send by the Switch when pairing in the "Change Grip/Order" menu, as (sub command, data) tuples.
+# SPI flash reads are (offset, size) of the serial number, colors, factory and user calibration data.
+PAIRING_SEQUENCE = (
+    (SubCommand.REQUEST_DEVICE_INFO, b''),
+    (SubCommand.SET_SHIPMENT_STATE, b'\x00'),
+    (SubCommand.SPI_FLASH_READ, (0x6000, 0x10)),
+    (SubCommand.SPI_FLASH_READ, (0x6050, 0x0D)),
+    (SubCommand.SET_INPUT_REPORT_MODE, b'\x30'),
+    (SubCommand.TRIGGER_BUTTONS_ELAPSED_TIME, b''),
+    (SubCommand.SPI_FLASH_READ, (0x6080, 0x18)),
+    (SubCommand.SPI_FLASH_READ, (0x6098, 0x12)),
+    (SubCommand.SPI_FLASH_READ, (0x8010, 0x18)),
+    (SubCommand.SPI_FLASH_READ, (0x603D, 0x19)),
+    (SubCommand.SPI_FLASH_READ, (0x8028, 0x18)),
+    (SubCommand.SPI_FLASH_READ, (0x6020, 0x18)),
+    (SubCommand.ENABLE_6AXIS_SENSOR, b'\x01'),
+    (SubCommand.ENABLE_VIBRATION, b'\x01'),
+    (SubCommand.SET_NFC_IR_MCU_STATE, b'\x01'),
+    (SubCommand.SET_PLAYER_LIGHTS, b'\x01'),
+)
+
+# MCU sub commands of 0x11 output reports
+MCU_REQUEST_STATUS = 0x01
+MCU_NFC_COMMAND = 0x02
+MCU_IR_ACK = 0x03
+
+# NFC commands, argument of MCU_NFC_COMMAND
+NFC_START_POLLING = 0x01
+NFC_STOP_POLLING = 0x02
+NFC_START_DISCOVERY = 0x04
+NFC_READ = 0x06
+NFC_WRITE = 0x08
+
+# data bytes of one packet of a MCU command split into several output reports
+MCU_PACKET_DATA_SIZE = 0x1F
+
+
+def _is_tag_detected(data):
+    """
+    :param data: 0x31 input report
+    :returns True if the MCU data of the report is an NFC state report with a detected tag
+    """
+    return len(data) > 57 and data[1] == 0x31 and data[50] == 0x2A and data[57] == 0x09
+
+
+def _is_ir_fragment(data):
+    """
+    :returns True if the MCU data of the report is an IR camera image fragment
+    """
+    return len(data) > 53 and data[1] == 0x31 and data[50] == 0x03
+
+
+def _is_write_finished(data):
+    """
+    :returns True if the MCU data of the report is an NFC state report of a finished tag write
+    """
+    return len(data) > 57 and data[1] == 0x31 and data[50] == 0x2A and data[57] == 0x05
+
+
+def _is_read_data(part):
+    """
+    :param part: 1 for the first, 2 for the second read data report
+    """
+    def predicate(data):
+        return len(data) > 53 and data[1] == 0x31 and data[50] == 0x3A and data[53] == part
+    return predicate
+
+
+class SimulatedConsole:
+    """
+    Console side of a loopback connection (see joycontrol.loopback.create_loopback_server).
+
+    Sends output reports like a Switch does and matches the received input reports, e.g. to run the pairing handshake
+    or NFC polling without a Switch. All input reports are received by a background task, arrival times are taken
+    from the event loop clock.
+    """
+    def __init__(self, itr_sock, ctl_sock, reply_timeout=1.0, retries=3, loop=None):
+        """
+        :param itr_sock: console side hid interrupt channel socket
+        :param ctl_sock: console side hid control channel socket
+        :param reply_timeout: seconds to wait for a sub command reply before sending the request again
+        :param retries: number of times a request is send again before giving up
+        :param loop: event loop, defaults to the current event loop
+        """
+        self._loop = loop if loop is not None else asyncio.get_event_loop()
+        self._itr_sock = itr_sock
+        self._ctl_sock = ctl_sock
+
+        self._reply_timeout = reply_timeout
+        self._retries = retries
+
+        self._timer = 0
+        # list of (predicate, future) tuples waiting for matching input reports
+        self._waiters = []
+        self._receiver = None
+
+        # statistics
+        self.input_reports = 0
+        self.output_reports = 0
+        self.last_input_report = None
+        self.last_input_report_time = None
+        self.retransmissions = 0
+
+    def start(self):
+        """
+        Starts receiving input reports.
+        """
+        if self._receiver is not None:
+            raise ValueError('Console is already started.')
+        self._receiver = asyncio.ensure_future(self._receive())
+
+    async def _receive(self):
+        while True:
+            data = await self._loop.sock_recv(self._itr_sock, 400)
+            if not data:
+                logger.info('Controller disconnected.')
+                break
+            now = self._loop.time()
+
+            self.input_reports += 1
+            self.last_input_report = data
+            self.last_input_report_time = now
+
+            if self._waiters:
+                remaining = []
+                for predicate, future in self._waiters:
+                    if future.done():
+                        continue
+                    if predicate is None or predicate(data):
+                        future.set_result((now, data))
+                    else:
+                        remaining.append((predicate, future))
+                self._waiters = remaining
+
+    def _add_waiter(self, predicate):
+        future = self._loop.create_future()
+        self._waiters.append((predicate, future))
+        return future
+
+    async def wait_for_input_report(self, predicate=None, timeout=None):
+        """
+        :param predicate: callable(data) returning True for the awaited input report, None to accept any report
+        :param timeout: seconds to wait, None to wait forever
+        :returns arrival time and data of the first matching input report
+        """
+        future = self._add_waiter(predicate)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            future.cancel()
+
+    async def send(self, report: OutputReport):
+        """
+        Sets the timer of the report and sends it to the controller.
+        """
+        report.set_timer(self._timer)
+        self._timer = (self._timer + 1) % 0x10
+        self.output_reports += 1
+        await self._loop.sock_sendall(self._itr_sock, bytes(report))
+
+    async def request(self, report: OutputReport, predicate):
+        """
+        Sends a request and waits for the reply. The request is send again if the reply takes longer than the
+        reply timeout.
+
+        :param report: request output report
+        :param predicate: callable(data) returning True for the reply
+        :returns arrival time and data of the reply
+        """
+        for attempt in range(self._retries + 1):
+            if attempt:
+                self.retransmissions += 1
+                logger.info(f'No reply to {report.data[1]:02x} {report.data[11]:02x}, sending again...')
+
+            # register the waiter before sending, the reply might arrive before send returns
+            reply = self._add_waiter(predicate)
+            await self.send(report)
+            try:
+                return await asyncio.wait_for(reply, self._reply_timeout)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                reply.cancel()
+        raise TimeoutError(f'No reply to output report {report.data[1]:02x} {report.data[11]:02x}.')
+
+    async def send_sub_command(self, sub_command: SubCommand, data=b''):
+        """
+        :param sub_command: SubCommand to send
+        :param data: sub command data. For SubCommand.SPI_FLASH_READ an (offset, size) tuple.
+        :returns arrival time and data of the 0x21 reply
+        """
+        report = OutputReport()
+        if sub_command == SubCommand.SPI_FLASH_READ:
+            report.sub_0x10_spi_flash_read(*data)
+        else:
+            report.set_output_report_id(OutputReportID.SUB_COMMAND)
+            report.set_sub_command(sub_command)
+            report.set_sub_command_data(data)
+
+        def is_reply(reply):
+            return reply[1] == 0x21 and reply[15] == sub_command.value
+
+        return await self.request(report, is_reply)
+
+    async def send_mcu_request(self, mcu_sub_command, data=b''):
+        """
+        Sends a 0x11 output report to the IR/NFC MCU. The MCU state is reported in the following 0x31 input reports,
+        so no reply is awaited.
+        """
+        report = OutputReport()
+        report.set_output_report_id(OutputReportID.REQUEST_IR_NFC_MCU)
+        report.set_sub_command(mcu_sub_command)
+        report.set_sub_command_data(data)
+        await self.send(report)
+
+    async def pair(self, sequence=PAIRING_SEQUENCE):
+        """
+        Runs the pairing handshake.
+
+        :param sequence: (sub command, data) tuples to send
+        :returns list of (sub command, reply time in seconds) tuples
+        """
+        reply_times = []
+        for sub_command, data in sequence:
+            start = self._loop.time()
+            arrival, _ = await self.send_sub_command(sub_command, data)
+            reply_times.append((sub_command, arrival - start))
+        return reply_times
+
+    async def poll_nfc(self, timeout=5.0, interval=0.05):
+        """
+        Switches the controller to NFC mode and polls for a tag, like a game reading an amiibo does.
+
+        :param timeout: seconds to wait for a tag
+        :param interval: seconds between two polling requests
+        :returns seconds until a tag was detected
+        """
+        start = self._loop.time()
+
+        await self.send_sub_command(SubCommand.SET_INPUT_REPORT_MODE, b'\x31')
+        await self.send_sub_command(SubCommand.SET_NFC_IR_MCU_STATE, b'\x01')
+        # configure the MCU for NFC
+        await self.send_sub_command(SubCommand.SET_NFC_IR_MCU_CONFIG, b'\x21\x00\x04')
+
+        await self.send_mcu_request(MCU_REQUEST_STATUS)
+        await self.send_mcu_request(MCU_NFC_COMMAND, bytes((NFC_START_DISCOVERY,)))
+
+        detected = asyncio.ensure_future(self.wait_for_input_report(_is_tag_detected, timeout))
+        try:
+            while not detected.done():
+                await self.send_mcu_request(MCU_NFC_COMMAND, bytes((NFC_START_POLLING,)))
+                await asyncio.wait([detected], timeout=interval)
+            arrival, _ = await detected
+        finally:
+            detected.cancel()
+            await self.send_mcu_request(MCU_NFC_COMMAND, bytes((NFC_STOP_POLLING,)))
+
+        return arrival - start
+
+    async def write_nfc(self, uid, writes, timeout=2.0):
+        """
+        Writes to the detected tag, like a game saving amiibo data does. The tag must have been polled before.
+
+        :param uid: 7 byte UID of the tag
+        :param writes: (page, data) tuples, data of at most 255 bytes
+        :param timeout: seconds to wait until the write is finished
+        :returns seconds until the write was finished
+        """
+        start = self._loop.time()
+
+        package = bytearray((0xD0, len(uid)))
+        package += uid
+        package += bytes(11)
+        package.append(len(writes))
+        for page, data in writes:
+            package += bytes((page, len(data)))
+            package += data
+
+        finished = self._add_waiter(_is_write_finished)
+        try:
+            packets = range(0, len(package), MCU_PACKET_DATA_SIZE)
+            for packet_id, offset in enumerate(packets):
+                data = package[offset:offset + MCU_PACKET_DATA_SIZE]
+                flag = 0x08 if packet_id == len(packets) - 1 else 0x00
+                await self.send_mcu_request(MCU_NFC_COMMAND, bytes((NFC_WRITE, packet_id, 0, flag, len(data))) + data)
+            arrival, _ = await asyncio.wait_for(finished, timeout)
+        finally:
+            finished.cancel()
+
+        return arrival - start
+
+    async def read_nfc(self, timeout=2.0):
+        """
+        Reads the detected tag. The tag must have been polled before.
+
+        :returns 540 bytes tag dump
+        """
+        first = self._add_waiter(_is_read_data(1))
+        second = self._add_waiter(_is_read_data(2))
+        try:
+            await self.send_mcu_request(MCU_NFC_COMMAND, bytes((NFC_READ,)))
+            _, first_data = await asyncio.wait_for(first, timeout)
+            _, second_data = await asyncio.wait_for(second, timeout)
+        finally:
+            first.cancel()
+            second.cancel()
+
+        # tag data starts after the read header of each report
+        return bytes(first_data[117:117 + 245] + second_data[57:57 + 295])
+
+    async def stream_ir(self, width, height, frames=1, drop_rate=0.0, seed=None, timeout=10.0):
+        """
+        Switches the controller to IR camera mode and receives image frames, acknowledging every fragment and
+        requesting missing fragments again.
+
+        :param width, height: IR camera resolution
+        :param frames: number of frames to receive
+        :param drop_rate: probability of ignoring a received fragment, to exercise retransmissions
+        :param seed: seed of the random fragment drops
+        :param timeout: seconds to wait for a fragment
+        :returns list of frames, (width * height) bytes each in row-major order
+        """
+        fragment_count = width * height // 300
+        rng = random.Random(seed)
+
+        await self.send_sub_command(SubCommand.SET_INPUT_REPORT_MODE, b'\x31')
+        await self.send_sub_command(SubCommand.SET_NFC_IR_MCU_STATE, b'\x01')
+        # configure the MCU for the IR camera
+        await self.send_sub_command(SubCommand.SET_NFC_IR_MCU_CONFIG, b'\x21\x00\x05')
+        # image transfer IR mode, index of the last fragment, MCU firmware version
+        await self.send_sub_command(SubCommand.SET_NFC_IR_MCU_CONFIG,
+                                    bytes((0x23, 0x01, 0x07, fragment_count - 1, 0x00, 0x05, 0x00, 0x18)))
+
+        images = []
+        while len(images) < frames:
+            fragments = [None] * fragment_count
+            # index of the last fragment received without gaps and of the last received fragment
+            complete = latest = -1
+            while complete < fragment_count - 1:
+                _, data = await self.wait_for_input_report(_is_ir_fragment, timeout)
+                fragment = data[53]
+                if fragment < fragment_count and fragments[fragment] is None and rng.random() >= drop_rate:
+                    fragments[fragment] = data[60:360]
+                    latest = max(latest, fragment)
+                    while complete < fragment_count - 1 and fragments[complete + 1] is not None:
+                        complete += 1
+
+                # nothing to acknowledge until fragment 0 arrived, the controller sends it again after its ack timeout
+                if complete < 0:
+                    continue
+                # acknowledge the received fragments, request the first missing one if later ones arrived
+                missing = complete + 1 if latest > complete else None
+                ack = bytes((0x00, 0x01 if missing is not None else 0x00, missing or 0, complete))
+                await self.send_mcu_request(MCU_IR_ACK, ack)
+
+            images.append(b''.join(fragments))
+        return images
+
+    async def close(self):
+        """
+        Stops receiving and closes the console side sockets.
+        """
+        if self._receiver is not None:
+            self._receiver.cancel()
+            try:
+                await self._receiver
+            except (asyncio.CancelledError, OSError):
+                pass
+            self._receiver = None
+
+        for _, future in self._waiters:
+            future.cancel()
+        self._waiters = []
+
+        self._itr_sock.close()
+        self._ctl_sock.close()
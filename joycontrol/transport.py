@@ -1,20 +1,25 @@
 import asyncio
 import logging
-import struct
-import time
 from typing import Any
 
 from joycontrol import utils
+from joycontrol.capture import CaptureWriter, Direction
+from joycontrol.report import InputReport
 
 logger = logging.getLogger(__name__)
 
+# Number of receive buffers used in turns by read_into. A received view stays valid until as many further
+# packets were received.
+READ_RING_SIZE = 8
+
 
 class NotConnectedError(ConnectionResetError):
     pass
 
 
 class L2CAP_Transport(asyncio.Transport):
-    def __init__(self, loop, protocol, itr_sock, ctr_sock, read_buffer_size, capture_file=None) -> None:
+    def __init__(self, loop, protocol, itr_sock, ctr_sock, read_buffer_size,
+                 capture: CaptureWriter = None) -> None:
         super(L2CAP_Transport, self).__init__()
 
         self._loop = loop
@@ -24,6 +29,7 @@ class L2CAP_Transport(asyncio.Transport):
         self._ctr_sock = ctr_sock
 
         self._read_buffer_size = read_buffer_size
+        self._create_read_ring()
 
         self._extra_info = {
             'peername': self._itr_sock.getpeername(),
@@ -32,19 +38,25 @@ class L2CAP_Transport(asyncio.Transport):
         }
 
         self._is_closing = False
-        self._is_reading = asyncio.Event()
+        # future completed when reading is resumed, None while reading is not paused
+        self._resume_reading = None
 
-        self._capture_file = capture_file
+        # captured reports are written in the background, the writer is closed with the transport
+        self._capture = capture
 
         # start underlying reader
         self._read_thread = None
-        self._is_reading.set()
         self.start_reader()
 
+    def _create_read_ring(self):
+        self._read_ring = [bytearray(self._read_buffer_size) for _ in range(READ_RING_SIZE)]
+        self._read_ring_views = [memoryview(buffer).toreadonly() for buffer in self._read_ring]
+        self._read_ring_index = 0
+
     async def _reader(self):
         while True:
             try:
-                data = await self.read()
+                data = await self.read_into()
             except NotConnectedError:
                 self._read_thread = None
                 break
@@ -95,7 +107,8 @@ class L2CAP_Transport(asyncio.Transport):
 
         :returns bytes
         """
-        await self._is_reading.wait()
+        if self._resume_reading is not None:
+            await asyncio.shield(self._resume_reading)
         data = await self._loop.sock_recv(self._itr_sock, self._read_buffer_size)
 
         # logger.debug(f'received "{list(data)}"')
@@ -106,11 +119,38 @@ class L2CAP_Transport(asyncio.Transport):
             self._protocol.connection_lost()
             raise NotConnectedError('No data received.')
 
-        if self._capture_file is not None:
+        if self._capture is not None:
+            # write data to log file
+            self._capture.write(data, Direction.RECEIVED)
+
+        return data
+
+    async def read_into(self):
+        """
+        Read data from the underlying socket into the next buffer of a ring of preallocated buffers.
+        This function waits, if reading is paused using the pause_reading function.
+
+        :returns read-only memoryview of the received data. The view is only valid until READ_RING_SIZE further
+                 packets were received, copy the data if it is needed for longer.
+        """
+        if self._resume_reading is not None:
+            await asyncio.shield(self._resume_reading)
+
+        index = self._read_ring_index
+        self._read_ring_index = (index + 1) % READ_RING_SIZE
+        size = await self._loop.sock_recv_into(self._itr_sock, self._read_ring[index])
+
+        if not size:
+            # disconnect happened
+            logger.error('No data received.')
+            self._protocol.connection_lost()
+            raise NotConnectedError('No data received.')
+
+        data = self._read_ring_views[index][:size]
+
+        if self._capture is not None:
             # write data to log file
-            _time = struct.pack('d', time.time())
-            size = struct.pack('i', len(data))
-            self._capture_file.write(_time + size + data)
+            self._capture.write(data, Direction.RECEIVED)
 
         return data
 
@@ -118,34 +158,40 @@ class L2CAP_Transport(asyncio.Transport):
         """
         :returns True if the reader is running
         """
-        return self._reader is not None and self._is_reading.is_set()
+        return self._read_thread is not None and self._resume_reading is None
 
     def pause_reading(self) -> None:
         """
         Pauses any 'read' function calls.
         """
-        self._is_reading.clear()
+        if self._resume_reading is None:
+            self._resume_reading = self._loop.create_future()
 
     def resume_reading(self) -> None:
         """
         Resumes all 'read' function calls.
         """
-        self._is_reading.set()
+        if self._resume_reading is not None:
+            if not self._resume_reading.done():
+                self._resume_reading.set_result(None)
+            self._resume_reading = None
 
     def set_read_buffer_size(self, size):
         self._read_buffer_size = size
+        self._create_read_ring()
 
     async def write(self, data: Any) -> None:
-        if isinstance(data, bytes):
+        if isinstance(data, InputReport):
+            # send the report buffer without copying
+            _bytes = data.get_view()
+        elif isinstance(data, (bytes, bytearray, memoryview)):
             _bytes = data
         else:
             _bytes = bytes(data)
 
-        if self._capture_file is not None:
+        if self._capture is not None:
             # write data to log file
-            _time = struct.pack('d', time.time())
-            size = struct.pack('i', len(_bytes))
-            self._capture_file.write(_time + size + _bytes)
+            self._capture.write(_bytes, Direction.SENT)
 
         # logger.debug(f'sending "{_bytes}"')
 
@@ -187,6 +233,10 @@ class L2CAP_Transport(asyncio.Transport):
             self._itr_sock.close()
             self._ctr_sock.close()
 
+            if self._capture is not None:
+                # write remaining captured reports without blocking the event loop
+                await self._loop.run_in_executor(None, self._capture.close)
+
     def set_protocol(self, protocol: asyncio.BaseProtocol) -> None:
         self._protocol = protocol
 
@@ -37,6 +37,33 @@ def get_output(path=None, open_flags='wb', default=None):
         yield default
 
 
+def _create_crc8_table(polynomial):
+    table = bytearray(256)
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = ((crc << 1) ^ polynomial) & 0xFF if crc & 0x80 else (crc << 1) & 0xFF
+        table[byte] = crc
+    return bytes(table)
+
+
+# CRC-8 lookup table of the polynomial x^8 + x^2 + x + 1 (0x07)
+CRC8_TABLE = _create_crc8_table(0x07)
+
+
+def crc8(data, crc=0x00):
+    """
+    Table driven CRC-8 (polynomial 0x07, initial value 0x00) as used by the IR/NFC MCU.
+    :param data: bytes to calculate the checksum of
+    :param crc: checksum of previous data to continue from
+    :returns checksum byte value
+    """
+    table = CRC8_TABLE
+    for byte in data:
+        crc = table[crc ^ byte]
+    return crc
+
+
 def get_bit(value, n):
     return (value >> n & 1) != 0
 
@@ -2,10 +2,10 @@
 
 import argparse
 import asyncio
+import functools
 import logging
 import os
 import keyboard
-import time
 import shelve
 #import board
 #import neopixel
@@ -15,9 +15,14 @@ from aioconsole import ainput
 from joycontrol import logging_default as log, utils
 from joycontrol.command_line_interface import ControllerCLI
 from joycontrol.controller import Controller
-from joycontrol.controller_state import ControllerState, button_push, StickState
-from joycontrol.memory import FlashMemory
+from joycontrol.controller_state import ControllerState, StickState
+from joycontrol.input_mixer import PRIORITY_KEYBOARD, STICK_MODES
+from joycontrol.ir_camera import FrameSource
+from joycontrol.macro_vm import compile_script
+from joycontrol.memory import FlashMemory, FlashJournal
+from joycontrol.nfc_library import NfcLibrary, DeferredNfcWriter, read_nfc_dump
 from joycontrol.protocol import controller_protocol_factory
+from joycontrol.scheduler import ReportRate
 from joycontrol.server import create_hid_server
 
 logger = logging.getLogger(__name__)
@@ -29,9 +34,13 @@ While running the cli, call "help" for an explanation of available commands.
 Usage:
     run_controller_cli.py <controller> [--device_id | -d  <bluetooth_adapter_id>]
                                        [--spi_flash <spi_flash_memory_file>]
+                                       [--spi_flash_journal <spi_flash_journal_file>]
                                        [--reconnect_bt_addr | -r <console_bluetooth_address>]
                                        [--log | -l <communication_log_file>]
                                        [--nfc <nfc_data_file>]
+                                       [--nfc_library <nfc_dump_directory>]
+                                       [--rate <report_rate>]
+                                       [--low_latency]
     run_controller_cli.py -h | --help
 
 Arguments:
@@ -48,6 +57,9 @@ Options:
                                             Allows displaying of JoyCon colors.
                                             Memory dumps can be created using the dump_spi_flash.py script.
 
+    --spi_flash_journal <spi_flash_journal_file>    Journal of flash memory writes by the Switch (e.g. stick
+                                                    calibration). Replayed on start, created if it does not exist.
+
     -r --reconnect_bt_addr <console_bluetooth_address>  Previously connected Switch console Bluetooth address in string
                                                         notation (e.g. "FF:FF:FF:FF:FF:FF") for reconnection.
                                                         Does not require the "Change Grip/Order" menu to be opened,
@@ -55,247 +67,108 @@ Options:
     -l --log <communication_log_file>       Write hid communication (input reports and output reports) to a file.
 
     --nfc <nfc_data_file>                   Sets the nfc data of the controller to a given nfc dump upon initial
-                                            connection.
+                                            connection. Tag writes of the console are written back to the dump.
+
+    --nfc_library <nfc_dump_directory>      Directory of nfc dumps, indexed and preloaded on start. Dumps can be
+                                            selected by name, UID or amiibo id using the "nfc" command.
+
+    --rate <report_rate>                    Input report rate, either "normal" (15ms, default), "fast" (8ms) or
+                                            "adaptive" (8ms, falls back to 15ms while the host can not keep up).
+                                            Can be changed at runtime using the "rate" command.
+
+    --low_latency                           Send controller state changes immediately instead of with the next
+                                            scheduled input report.
 """
+# controller buttons and stick directions by keyboard key
+KEY_BINDINGS = {'q': 'left', 'w': 'lStickUp', 'e': 'up', 'r': 'zl', 't': 'l', 'y': 'r', 'u': 'zr', 'i': 'rStickUp', 'a': 'lStickL', 's': 'lStickDown', 'd': 'lStickR', 'f': 'right', 'g': 'capture', 'h': 'home', 'j': 'rStickL', 'k': 'rStickDown', 'l':  'rStickR', 'c': 'down', 'up': 'x', 'down': 'b', 'left': 'y', 'right': 'a', '-': 'minus', '+': 'plus'}
+
+# stick sides and directions of the stick bindings
+_KEY_STICKS = {
+    'lStickUp': ('l', 'up'), 'lStickDown': ('l', 'down'), 'lStickL': ('l', 'left'), 'lStickR': ('l', 'right'),
+    'rStickUp': ('r', 'up'), 'rStickDown': ('r', 'down'), 'rStickL': ('r', 'left'), 'rStickR': ('r', 'right'),
+}
+
+
 def keyToConBtn(key): #this method translates recorded key events to respective controller buttons pressed for recording playback
     namedKey = None
-    keyBinding = {'q': 'left', 'w': 'lStickUp', 'e': 'up', 'r': 'zl', 't': 'l', 'y': 'r', 'u': 'zr', 'i': 'rStickUp', 'a': 'lStickL', 's': 'lStickDown', 'd': 'lStickR', 'f': 'right', 'g': 'capture', 'h': 'home', 'j': 'rStickL', 'k': 'rStickDown', 'l':  'rStickR', 'c': 'down', 'up': 'x', 'down': 'b', 'left': 'y', 'right': 'a', '-': 'minus', '+': 'plus'}
-    testKeys = ['q', 'w', 'e', 'r', 't', 'y', 'u', 'i', 'a', 's', 'd', 'f', 'g', 'h', 'j', 'k', 'l', 'c', 'up', 'down', 'left', 'right', '+', '-']
-    for testKey in testKeys:
+    for testKey in KEY_BINDINGS:
         testKeyCode = keyboard.key_to_scan_codes(testKey)
-        #print('testKeyCode:')
-        #print(testKeyCode)
         if testKeyCode[0] == key:
             namedKey = testKey
-            #print('namedKey:')
-            #print(namedKey)
-    if namedKey in keyBinding:
-        conBtnPressed = keyBinding[namedKey]
+    if namedKey in KEY_BINDINGS:
+        conBtnPressed = KEY_BINDINGS[namedKey]
         return conBtnPressed
 
 def bindKeyboard(controller_state: ControllerState):#this method binds specific keys to each button on the pro controller for keyboard control
-    #callbacks:
-    def APress(self):
-        controller_state.button_state.set_button('a')
-    def AUnpress(self):
-        controller_state.button_state.set_button('a', pushed=False)
-    def BPress(self):
-        controller_state.button_state.set_button('b')
-    def BUnpress(self):
-        controller_state.button_state.set_button('b', pushed=False)
-    def XPress(self):
-        controller_state.button_state.set_button('x')
-    def XUnpress(self):
-        controller_state.button_state.set_button('x', pushed=False)
-    def YPress(self):
-        controller_state.button_state.set_button('y')
-    def YUnpress(self):
-        controller_state.button_state.set_button('y', pushed=False)
-    def UPPress(self):
-        controller_state.button_state.set_button('up')
-    def UPUnpress(self):
-        controller_state.button_state.set_button('up', pushed=False)
-    def DOWNPress(self):
-        controller_state.button_state.set_button('down')
-    def DOWNUnpress(self):
-        controller_state.button_state.set_button('down', pushed=False)
-    def LEFTPress(self):
-        controller_state.button_state.set_button('left')
-    def LEFTUnpress(self):
-        controller_state.button_state.set_button('left', pushed=False)
-    def RIGHTPress(self):
-        controller_state.button_state.set_button('right')
-    def RIGHTUnpress(self):
-        controller_state.button_state.set_button('right', pushed=False)
-    def PLUSPress(self):
-        controller_state.button_state.set_button('plus')
-    def PLUSUnpress(self):
-        controller_state.button_state.set_button('plus', pushed=False)
-    def MINUSPress(self):
-        controller_state.button_state.set_button('minus')
-    def MINUSUnpress(self):
-        controller_state.button_state.set_button('minus', pushed=False)
-    def HOMEPress(self):
-        controller_state.button_state.set_button('home')
-    def HOMEUnpress(self):
-        controller_state.button_state.set_button('home', pushed=False)
-    def CAPPress(self):
-        controller_state.button_state.set_button('capture')
-    def CAPUnpress(self):
-        controller_state.button_state.set_button('capture', pushed=False)
-    def LBUMPPress(self):
-        controller_state.button_state.set_button('l')
-    def LBUMPUnpress(self):
-        controller_state.button_state.set_button('l', pushed=False)
-    def RBUMPPress(self):
-        controller_state.button_state.set_button('r')
-    def RBUMPUnpress(self):
-        controller_state.button_state.set_button('r', pushed=False)
-    def ZLPress(self):
-        controller_state.button_state.set_button('zl')
-    def ZLUnpress(self):
-        controller_state.button_state.set_button('zl', pushed=False)
-    def ZRPress(self):
-        controller_state.button_state.set_button('zr')
-    def ZRUnpress(self):
-        controller_state.button_state.set_button('zr', pushed=False)
-
-        # Stick state handler callbacks
-    LeftStick = controller_state.l_stick_state
-    RightStick = controller_state.r_stick_state
-
-    def UpLStickPress(self):
-        ControllerCLI._set_stick(LeftStick, 'up', None)
-    def DownLStickPress(self):
-        ControllerCLI._set_stick(LeftStick, 'down', None)
-    def LeftLStickPress(self):
-        ControllerCLI._set_stick(LeftStick, 'left', None)
-    def RightLStickPress(self):
-        ControllerCLI._set_stick(LeftStick, 'right', None)
-    def LStickUnpress(self):
-        ControllerCLI._set_stick(LeftStick, 'center', None)
-
-        #Right Stick
-
-    def UpRStickPress(self):
-        ControllerCLI._set_stick(RightStick, 'up', None)
-    def DownRStickPress(self):
-        ControllerCLI._set_stick(RightStick, 'down', None)
-    def LeftRStickPress(self):
-        ControllerCLI._set_stick(RightStick, 'left', None)
-    def RightRStickPress(self):
-        ControllerCLI._set_stick(RightStick, 'right', None)
-    def RStickUnpress(self):
-        ControllerCLI._set_stick(RightStick, 'center', None)
-
-    #key listeners
-    keyboard.on_press_key('q', LEFTPress)
-    keyboard.on_release_key('q', LEFTUnpress)
-
-    keyboard.on_press_key('w', UpLStickPress)
-    keyboard.on_release_key('w', LStickUnpress)
-
-    keyboard.on_press_key('e', UPPress)
-    keyboard.on_release_key('e', UPUnpress)
-
-    keyboard.on_press_key('r', ZLPress)
-    keyboard.on_release_key('r', ZLUnpress)
-
-    keyboard.on_press_key('t', LBUMPPress)
-    keyboard.on_release_key('t', LBUMPUnpress)
-
-    keyboard.on_press_key('y', RBUMPPress)
-    keyboard.on_release_key('y', RBUMPUnpress)
-
-    keyboard.on_press_key('u', ZRPress)
-    keyboard.on_release_key('u', ZRUnpress)
-
-    keyboard.on_press_key('i', UpRStickPress)
-    keyboard.on_release_key('i', RStickUnpress)
-
-    keyboard.on_press_key('a', LeftLStickPress)
-    keyboard.on_release_key('a', LStickUnpress)
-
-    keyboard.on_press_key('s', DownLStickPress)
-    keyboard.on_release_key('s', LStickUnpress)
-
-    keyboard.on_press_key('d', RightLStickPress)
-    keyboard.on_release_key('d', LStickUnpress)
-
-    keyboard.on_press_key('f', RIGHTPress)
-    keyboard.on_release_key('f', RIGHTUnpress)
-
-    keyboard.on_press_key('g', CAPPress)
-    keyboard.on_release_key('g', CAPUnpress)
-
-    keyboard.on_press_key('h', HOMEPress)
-    keyboard.on_release_key('h', HOMEUnpress)
-
-    keyboard.on_press_key('j', LeftRStickPress)
-    keyboard.on_release_key('j', RStickUnpress)
-
-    keyboard.on_press_key('k', DownRStickPress)
-    keyboard.on_release_key('k', RStickUnpress)
-
-    keyboard.on_press_key('l', RightRStickPress)
-    keyboard.on_release_key('l', RStickUnpress)
-
-    keyboard.on_press_key('c', DOWNPress)
-    keyboard.on_release_key('c', DOWNUnpress)
-
-    keyboard.on_press_key('+', PLUSPress)
-    keyboard.on_release_key('+', PLUSUnpress)
-
-    keyboard.on_press_key('-', MINUSPress)
-    keyboard.on_release_key('-', MINUSUnpress)
-
-    keyboard.on_press_key('up', XPress)
-    keyboard.on_release_key('up', XUnpress)
-
-    keyboard.on_press_key('down', BPress)
-    keyboard.on_release_key('down', BUnpress)
-
-    keyboard.on_press_key('left', YPress)
-    keyboard.on_release_key('left', YUnpress)
-
-    keyboard.on_press_key('right', APress)
-    keyboard.on_release_key('right', AUnpress)
+    """
+    Binds the keys of KEY_BINDINGS to buttons and sticks. Key events change a separate keyboard layer of the input
+    mixer, so they are merged with the other input sources instead of racing with them.
+    :returns the keyboard layer, remove it from the input mixer after unhooking the keyboard
+    """
+    loop = asyncio.get_event_loop()
+    layer = controller_state.get_input_mixer().create_layer('keyboard', priority=PRIORITY_KEYBOARD)
+
+    def bind(key, target):
+        if target in _KEY_STICKS:
+            side, direction = _KEY_STICKS[target]
+            on_press = functools.partial(layer.move_stick, side, direction)
+            on_release = functools.partial(layer.release_stick, side)
+        else:
+            on_press = functools.partial(layer.press, target)
+            on_release = functools.partial(layer.release, target)
+        # keyboard callbacks run in the thread of the keyboard library, the layer is changed in the event loop
+        keyboard.on_press_key(key, lambda event: loop.call_soon_threadsafe(on_press))
+        keyboard.on_release_key(key, lambda event: loop.call_soon_threadsafe(on_release))
+
+    for key, target in KEY_BINDINGS.items():
+        bind(key, target)
     print(' ')
-    #print('keys bound')
-
-async def directStateSet(btnTrans, controller_state: ControllerState): #this method sets button/stick states during recording playback (button PRESS/ stick UDLR)
-    LeftStick = controller_state.l_stick_state
-    RightStick = controller_state.r_stick_state
-    btnsList = ['x', 'y', 'b', 'a', 'plus', 'minus', 'home', 'capture', 'zl', 'zr', 'l', 'r', 'up', 'down', 'left', 'right']
-    lStickList = ['lStickUp', 'lStickDown', 'lStickL', 'lStickR']
-    rStickList = ['rStickUp', 'rStickDown', 'rStickL', 'rStickR']
-    if btnTrans in btnsList:
-        #print(btnTrans)
-        controller_state.button_state.set_button(btnTrans)
-        await controller_state.send()
-    elif btnTrans in lStickList:
-        #print(btnTrans)
-        if btnTrans == 'lStickDown':
-            ControllerCLI._set_stick(LeftStick, 'down', None)
-            await controller_state.send()
-        elif btnTrans == 'lStickUp':
-            ControllerCLI._set_stick(LeftStick, 'up', None)
-            await controller_state.send()
-        elif btnTrans == 'lStickL':
-            ControllerCLI._set_stick(LeftStick, 'left', None)
-            await controller_state.send()
-        elif btnTrans == 'lStickR':
-            ControllerCLI._set_stick(LeftStick, 'right', None)
-            await controller_state.send()
-    elif btnTrans in rStickList:
-        if btnTrans == 'rStickDown':
-            ControllerCLI._set_stick(RightStick, 'down', None)
-            await controller_state.send()
-        elif btnTrans == 'rStickUp':
-            ControllerCLI._set_stick(RightStick, 'up', None)
-            await controller_state.send()
-        elif btnTrans == 'rStickL':
-            ControllerCLI._set_stick(RightStick, 'left', None)
-            await controller_state.send()
-        elif btnTrans == 'rStickR':
-            ControllerCLI._set_stick(RightStick, 'right', None)
-            await controller_state.send()
-
-async def directStateUNSet(btnTrans, controller_state: ControllerState): #this method sets button/stick states during recording playback (button RELEASE/ stick CENTER)
-    LeftStick = controller_state.l_stick_state
-    RightStick = controller_state.r_stick_state
-    btnsList = ['x', 'y', 'b', 'a', 'plus', 'minus', 'home', 'capture', 'zl', 'zr', 'l', 'r', 'up', 'down', 'left', 'right']
-    lStickList = ['lStickUp', 'lStickDown', 'lStickL', 'lStickR']
-    rStickList = ['rStickUp', 'rStickDown', 'rStickL', 'rStickR']
-    if btnTrans in btnsList:
-        controller_state.button_state.set_button(btnTrans, pushed=False)
-        await controller_state.send()
-    elif btnTrans in lStickList:
-        ControllerCLI._set_stick(LeftStick, 'center', None)
-        await controller_state.send()
-    elif btnTrans in rStickList:
-        ControllerCLI._set_stick(RightStick, 'center', None)
-        await controller_state.send()
+    return layer
+
+def recording_to_script(recording):
+    """
+    Translates recorded keyboard events to a macro script, see joycontrol.macro_vm.
+    Events are separated by timed waits, so the playback keeps the recorded timing at any report rate.
+    Event times are rounded to microseconds relative to the first event, so rounding errors do not add up.
+    :param recording: list of keyboard events
+    """
+    lines = []
+    start_time = None
+    time_us = 0
+    for event in recording:
+        btnTrans = keyToConBtn(event.scan_code or event.name)
+        if btnTrans is None:
+            continue
+        if start_time is None:
+            start_time = event.time
+        event_us = round((event.time - start_time) * 1000000)
+        if event_us > time_us:
+            lines.append(f'wait {(event_us - time_us) / 1000:.3f}ms')
+            time_us = event_us
+
+        pushed = event.event_type == keyboard.KEY_DOWN
+        if btnTrans in _KEY_STICKS:
+            side, direction = _KEY_STICKS[btnTrans]
+            lines.append(f'stick {side} {direction if pushed else "center"}')
+        else:
+            lines.append(f'{"hold" if pushed else "release"} {btnTrans}')
+    # keep the last state for one frame
+    lines.append('wait 1')
+    return '\n'.join(lines)
+
+
+async def run_script_until_input(controller_state, program, prompt, name='script'):
+    """
+    Runs a macro script until it ends or the user presses <enter>.
+    :param name: name of the script and its input layer
+    """
+    user_input = asyncio.ensure_future(ainput(prompt=prompt))
+    script = asyncio.ensure_future(controller_state.run_script(program, name=name))
+    await asyncio.wait((user_input, script), return_when=asyncio.FIRST_COMPLETED)
+    controller_state.stop_script(name)
+    # await futures to trigger exceptions in case something went wrong
+    await script
+    await user_input
 
 #pixels = neopixel.NeoPixel(board.D12, 6)
 
@@ -330,8 +203,6 @@ async def recording_playback(controller_state: ControllerState): #This method re
     await controller_state.connect()
     savedRecordings = shelve.open('savedRecs', writeback=True)
     #pixels = neopixel.NeoPixel(board.D12, 6, auto_write=False)
-    LeftStick = controller_state.l_stick_state
-    RightStick = controller_state.r_stick_state
     recList = list(savedRecordings.keys())
     print('Saved Recordings:')
     print(recList)
@@ -343,20 +214,12 @@ async def recording_playback(controller_state: ControllerState): #This method re
         #pixels.fill((0, 10, 0))
         #pixels.fill((0, 10, 0))
         recording = savedRecordings[recordingName]
-        speed_factor = 1
-        last_time = None
-        for event in recording:
-            if speed_factor > 0 and last_time is not None:
-                time.sleep((event.time - last_time) / speed_factor)
-            last_time = event.time
-            key = event.scan_code or event.name
-            btnTrans = keyToConBtn(key)
-            await directStateSet(btnTrans, controller_state) if event.event_type == keyboard.KEY_DOWN else  await directStateUNSet(btnTrans, controller_state)
+        script = recording_to_script(recording)
+        await run_script_until_input(controller_state, compile_script(script, controller_state),
+                                     'Playing recording... Press <enter> to stop.', name='playback')
         keyboard.unhook_all()
         #pixels.fill((0, 0, 0))
         #pixels.fill((0, 0, 0))
-        ControllerCLI._set_stick(RightStick, 'center', None)
-        ControllerCLI._set_stick(LeftStick, 'center', None)
         await controller_state.send()
     else:
         print('Recording name not recognized')
@@ -373,9 +236,7 @@ async def record_keyboard(controller_state: ControllerState): #this method binds
 
     #button state handler callbacks
     savedRecordings = shelve.open('savedRecs', writeback=True)
-    LeftStick = controller_state.l_stick_state
-    RightStick = controller_state.r_stick_state
-    bindKeyboard(controller_state)
+    layer = bindKeyboard(controller_state)
     keyboard.start_recording()
     #pixels.fill((0, 0, 0))
     #pixels.fill((10, 0, 0))
@@ -390,8 +251,7 @@ async def record_keyboard(controller_state: ControllerState): #this method binds
     savedRecordings[recordingName] = recording
     savedRecordings.close()
 
-    ControllerCLI._set_stick(RightStick, 'center', None)
-    ControllerCLI._set_stick(LeftStick, 'center', None)
+    controller_state.get_input_mixer().remove_layer(layer)
     await controller_state.send()
 
 async def keyboard_control(controller_state: ControllerState):# this method binds keyboard to controller for CLI keyboard control of switch
@@ -403,17 +263,53 @@ async def keyboard_control(controller_state: ControllerState):# this method bind
     await ainput(prompt='Press <enter> to start keyboard control.')
 
     #button state handler callbacks
-    LeftStick = controller_state.l_stick_state
-    RightStick = controller_state.r_stick_state
-    bindKeyboard(controller_state)
+    layer = bindKeyboard(controller_state)
     await ainput(prompt='Press <enter> to exit keyboard control.')
     keyboard.unhook_all()
-    ControllerCLI._set_stick(RightStick, 'center', None)
-    ControllerCLI._set_stick(LeftStick, 'center', None)
+    controller_state.get_input_mixer().remove_layer(layer)
     await controller_state.send()
 
 
 
+# navigates from the Home menu to the "Test Controller Buttons" menu
+TEST_BUTTONS_NAVIGATION = """
+# Goto settings
+press down 1s
+press right 2s
+wait 300ms
+press left 100ms
+wait 300ms
+press a 100ms
+wait 300ms
+
+# go all the way down
+press down 4s
+wait 300ms
+
+# goto "Controllers and Sensors" menu
+repeat 2
+    press up 100ms
+    wait 300ms
+end
+press right 100ms
+wait 300ms
+
+# go all the way down
+press down 3s
+wait 300ms
+
+# goto "Test Input Devices" menu
+press up 100ms
+wait 300ms
+press a 100ms
+wait 300ms
+
+# goto "Test Controller Buttons" menu
+press a 100ms
+wait 300ms
+"""
+
+
 async def test_controller_buttons(controller_state: ControllerState): #this method navigates to the "Test Controller Buttons" menu and presses all buttons.
     """
     Example controller script.
@@ -429,84 +325,44 @@ async def test_controller_buttons(controller_state: ControllerState): #this meth
 
     """
     # We assume we are in the "Change Grip/Order" menu of the switch
-    await button_push(controller_state, 'home')
+    press home 100ms
 
     # wait for the animation
-    await asyncio.sleep(1)
+    wait 1s
     """
 
-    # Goto settings
-    await button_push(controller_state, 'down', sec=1)
-    await button_push(controller_state, 'right', sec=2)
-    await asyncio.sleep(0.3)
-    await button_push(controller_state, 'left')
-    await asyncio.sleep(0.3)
-    await button_push(controller_state, 'a')
-    await asyncio.sleep(0.3)
-
-    # go all the way down
-    await button_push(controller_state, 'down', sec=4)
-    await asyncio.sleep(0.3)
-
-    # goto "Controllers and Sensors" menu
-    for _ in range(2):
-        await button_push(controller_state, 'up')
-        await asyncio.sleep(0.3)
-    await button_push(controller_state, 'right')
-    await asyncio.sleep(0.3)
-
-    # go all the way down
-    await button_push(controller_state, 'down', sec=3)
-    await asyncio.sleep(0.3)
-
-    # goto "Test Input Devices" menu
-    await button_push(controller_state, 'up')
-    await asyncio.sleep(0.3)
-    await button_push(controller_state, 'a')
-    await asyncio.sleep(0.3)
-
-    # goto "Test Controller Buttons" menu
-    await button_push(controller_state, 'a')
-    await asyncio.sleep(0.3)
+    await controller_state.run_script(compile_script(TEST_BUTTONS_NAVIGATION, controller_state), name='test_buttons')
 
     # push all buttons except home and capture
-    button_list = controller_state.button_state.get_available_buttons()
-    if 'capture' in button_list:
-        button_list.remove('capture')
-    if 'home' in button_list:
-        button_list.remove('home')
-
-    user_input = asyncio.ensure_future(
-        ainput(prompt='Pressing all buttons... Press <enter> to stop.')
-    )
+    button_list = sorted(controller_state.button_state.get_available_buttons() - {'capture', 'home'})
 
     # push all buttons consecutively until user input
-    while not user_input.done():
-        for button in button_list:
-            await button_push(controller_state, button)
-            await asyncio.sleep(0.1)
-
-            if user_input.done():
-                break
-
-    # await future to trigger exceptions in case something went wrong
-    await user_input
+    push_all = ['loop']
+    for button in button_list:
+        push_all += [f'    press {button} 100ms', '    wait 100ms']
+    push_all.append('end')
+    await run_script_until_input(controller_state, compile_script('\n'.join(push_all), controller_state),
+                                 'Pressing all buttons... Press <enter> to stop.', name='test_buttons')
 
     # go back to home
-    await button_push(controller_state, 'home')
+    await controller_state.run_script(compile_script('press home 100ms', controller_state), name='test_buttons')
 
 
-async def set_nfc(controller_state, file_path):
+async def set_nfc(controller_state, file_path, writer=None):
     """
     Sets nfc content of the controller state to contents of the given file.
     :param controller_state: Emulated controller state
     :param file_path: Path to nfc dump file
+    :param writer: DeferredNfcWriter writing tag writes of the console back to the file, None to keep them in memory
     """
     loop = asyncio.get_event_loop()
 
-    with open(file_path, 'rb') as nfc_file:
-        content = await loop.run_in_executor(None, nfc_file.read)
-        controller_state.set_nfc(content)
+    content = await loop.run_in_executor(None, read_nfc_dump, file_path)
+    store = None
+    if writer is not None:
+        def store(new_content):
+            writer.schedule(file_path, new_content)
+    controller_state.set_nfc(content, store=store)
 
 
 async def mash_button(controller_state, button, interval):
@@ -515,33 +371,57 @@ async def mash_button(controller_state, button, interval):
 
     if button not in controller_state.button_state.get_available_buttons():
         raise ValueError(f'Button {button} does not exist on {controller_state.get_controller()}')
+    interval = float(interval)
 
-    user_input = asyncio.ensure_future(
-        ainput(prompt=f'Pressing the {button} button every {interval} seconds... Press <enter> to stop.')
-    )
     # push a button repeatedly until user input
-    while not user_input.done():
-        await button_push(controller_state, button)
-        await asyncio.sleep(float(interval))
+    script = f'''
+loop
+    press {button} 100ms
+    wait {interval}s
+end
+'''
+    await run_script_until_input(controller_state, compile_script(script, controller_state),
+                                 f'Pressing the {button} button every {interval} seconds... Press <enter> to stop.',
+                                 name='mash')
+
+
+async def run_script_file(controller_state, file_path):
+    """
+    Runs a macro script file until it ends or the user presses <enter>.
+    """
+    # waits until controller is fully connected
+    await controller_state.connect()
 
-    # await future to trigger exceptions in case something went wrong
-    await user_input
+    with open(file_path) as script_file:
+        program = compile_script(script_file.read(), controller_state)
+    await run_script_until_input(controller_state, program, f'Running {file_path}... Press <enter> to stop.')
 
 
 async def _main(args):
     # parse the spi flash
     if args.spi_flash:
-        with open(args.spi_flash, 'rb') as spi_flash_file:
-            spi_flash = FlashMemory(spi_flash_file.read())
+        spi_flash = FlashMemory.from_file(args.spi_flash)
     else:
         # Create memory containing default controller stick calibration
         spi_flash = FlashMemory()
 
+    if args.spi_flash_journal:
+        spi_flash.attach_journal(FlashJournal(args.spi_flash_journal))
+
+    # writes tags written by the console back to their dumps
+    nfc_writer = DeferredNfcWriter()
+    nfc_library = None
+    if args.nfc_library:
+        nfc_library = NfcLibrary(args.nfc_library, writer=nfc_writer)
+        await nfc_library.load_async()
+
     # Get controller name to emulate from arguments
     controller = Controller.from_arg(args.controller)
 
     with utils.get_output(path=args.log, default=None) as capture_file:
-        factory = controller_protocol_factory(controller, spi_flash=spi_flash)
+        factory = controller_protocol_factory(controller, spi_flash=spi_flash,
+                                              report_rate=ReportRate.from_arg(args.rate),
+                                              low_latency=args.low_latency)
         ctl_psm, itr_psm = 17, 19
         transport, protocol = await create_hid_server(factory, reconnect_bt_addr=args.reconnect_bt_addr,
                                                       ctl_psm=ctl_psm,
@@ -610,6 +490,44 @@ async def _main(args):
             button, interval = args
             await mash_button(controller_state, button, interval)
 
+        async def script(*args):
+            """
+            script - Runs a macro script file, see joycontrol.macro_vm for the syntax
+
+            Usage:
+                script <file>
+            """
+            if len(args) != 1:
+                raise ValueError('"script" command requires a file as argument!')
+            await run_script_file(controller_state, args[0])
+
+        async def mixer(*args):
+            """
+            mixer - Shows the input layers merged into the controller status or sets how sticks are merged
+
+            Usage:
+                mixer                           Lists the input layers, highest priority first
+                mixer sticks <priority|last_writer>   Sticks are controlled by the layer with the highest priority
+                                                      or by the layer which moved them last
+            """
+            input_mixer = controller_state.get_input_mixer()
+            if not args:
+                for layer in input_mixer.get_layers():
+                    print(f'{layer.name}: priority {layer.priority}, buttons 0x{layer.get_buttons():06x}, '
+                          f'mask 0x{layer.get_mask():06x}, sticks {layer.get_stick("l")} {layer.get_stick("r")}')
+                print(f'controller state (base), sticks: {input_mixer.get_stick_mode()}')
+            elif len(args) == 2 and args[0] == 'sticks' and args[1] in STICK_MODES:
+                input_mixer.set_stick_mode(args[1])
+            else:
+                raise ValueError(f'Usage: mixer [sticks <{"|".join(STICK_MODES)}>]')
+
+        def set_library_nfc(tag):
+            def store(new_content):
+                nfc_library.update(tag.name, new_content)
+            nfc_library.select(tag.name)
+            controller_state.set_nfc(nfc_library.get_content(tag.name), store=store)
+            print(f'Set nfc content to {tag.name}.')
+
         # Create nfc command
         async def nfc(*args):
             """
@@ -617,6 +535,10 @@ async def _main(args):
 
             Usage:
                 nfc <file_name>          Set controller state NFC content to file
+                nfc <tag>                Set controller state NFC content to a dump of the library, selected by
+                                         name, UID or amiibo id
+                nfc next                 Set controller state NFC content to the next dump of the library
+                nfc list                 List the dumps of the library
                 nfc remove               Remove NFC content from controller state
             """
             if controller_state.get_controller() == Controller.JOYCON_L:
@@ -626,8 +548,40 @@ async def _main(args):
             elif args[0] == 'remove':
                 controller_state.set_nfc(None)
                 print('Removed nfc content.')
+            elif args[0] in ('next', 'list'):
+                if nfc_library is None:
+                    raise ValueError(f'"nfc {args[0]}" requires the --nfc_library option!')
+                if args[0] == 'list':
+                    for tag in nfc_library.get_tags():
+                        print(f'{tag.name}  uid {tag.uid}  amiibo {tag.amiibo_id}')
+                else:
+                    set_library_nfc(nfc_library.next())
+            else:
+                tag = nfc_library.find(args[0]) if nfc_library is not None else None
+                if tag is not None:
+                    set_library_nfc(tag)
+                else:
+                    await set_nfc(controller_state, args[0], writer=nfc_writer)
+
+        # Create IR camera command
+        async def ir(*args):
+            """
+            ir - Sets the frames of the IR camera, requires NumPy and Pillow
+
+            Usage:
+                ir <path>                Stream an image file or all image files of a directory
+                ir remove                Remove the IR camera frames
+            """
+            if controller_state.get_controller() == Controller.JOYCON_L:
+                raise ValueError('IR camera frames cannot be set for JOYCON_L')
+            elif not args:
+                raise ValueError('"ir" command requires a path to an image or a directory of images as argument!')
+            elif args[0] == 'remove':
+                controller_state.set_ir_source(None)
+                print('Removed IR camera frames.')
             else:
-                await set_nfc(controller_state, args[0])
+                source = await asyncio.get_event_loop().run_in_executor(None, FrameSource, args[0])
+                controller_state.set_ir_source(source)
 
         cli.add_command('test_buttons', _run_test_controller_buttons)
         cli.add_command('keyboard', _run_keyboard_control)
@@ -635,8 +589,11 @@ async def _main(args):
         cli.add_command('playback', _run_recording_playback)
         cli.add_command('delete_rec', _run_delete_recording)
         cli.add_command('mash', call_mash_button)
+        cli.add_command('script', script)
+        cli.add_command('mixer', mixer)
         # add the script from above
         cli.add_command('nfc', nfc)
+        cli.add_command('ir', ir)
 
 
         if args.nfc is not None:
@@ -647,6 +604,9 @@ async def _main(args):
         finally:
             logger.info('Stopping communication...')
             await transport.close()
+            await nfc_writer.flush()
+            if spi_flash.get_journal() is not None:
+                await asyncio.get_event_loop().run_in_executor(None, spi_flash.get_journal().close)
 
 
 if __name__ == '__main__':
@@ -663,9 +623,15 @@ if __name__ == '__main__':
     parser.add_argument('-l', '--log')
     parser.add_argument('-d', '--device_id')
     parser.add_argument('--spi_flash')
+    parser.add_argument('--spi_flash_journal')
     parser.add_argument('-r', '--reconnect_bt_addr', type=str, default=None,
                         help='The Switch console Bluetooth address, for reconnecting as an already paired controller')
     parser.add_argument('--nfc', type=str, default=None)
+    parser.add_argument('--nfc_library', type=str, default=None,
+                        help='Directory of nfc dumps, indexed and preloaded on start')
+    parser.add_argument('--rate', type=str, default='normal', help='Input report rate: normal, fast or adaptive')
+    parser.add_argument('--low_latency', action='store_true',
+                        help='Send controller state changes immediately instead of with the next input report')
     args = parser.parse_args()
 
     loop = asyncio.get_event_loop()
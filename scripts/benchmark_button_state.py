@@ -0,0 +1,116 @@
+import argparse
+import time
+
+from joycontrol.controller import Controller
+from joycontrol.controller_state import ButtonState
+from joycontrol.report import InputReport
+from joycontrol import utils
+
+""" Compares setting buttons and writing them to an input report using the bitmask ButtonState with the previous
+implementation, which generated two closures per button for every instance.
+
+Every frame changes a number of buttons, like a macro or a remote client replaying input does.
+
+Usage:
+    benchmark_button_state.py [--frames <number>] [--buttons <number>]
+    benchmark_button_state.py -h | --help
+"""
+
+
+class ClosureButtonState:
+    """
+    The previous button state, reduced to the Pro Controller.
+    """
+    def __init__(self):
+        self._byte_1 = 0
+        self._byte_2 = 0
+        self._byte_3 = 0
+
+        def button_method_factory(byte, bit):
+            def setter(pushed=True):
+                _byte = getattr(self, byte)
+
+                if pushed != utils.get_bit(_byte, bit):
+                    setattr(self, byte, utils.flip_bit(_byte, bit))
+
+            def getter():
+                return utils.get_bit(getattr(self, byte), bit)
+            return setter, getter
+
+        self._available_buttons = set()
+        for byte, buttons in (('_byte_1', ('y', 'x', 'b', 'a', None, None, 'r', 'zr')),
+                              ('_byte_2', ('minus', 'plus', 'r_stick', 'l_stick', 'home', 'capture')),
+                              ('_byte_3', ('down', 'up', 'right', 'left', None, None, 'l', 'zl'))):
+            for bit, button in enumerate(buttons):
+                if button is not None:
+                    setter, getter = button_method_factory(byte, bit)
+                    setattr(self, button, setter)
+                    setattr(self, f'{button}_is_set', getter)
+                    self._available_buttons.add(button)
+
+    def set_button(self, button, pushed=True):
+        if button not in self._available_buttons:
+            raise ValueError(f'Given button "{button}" is not available.')
+        getattr(self, button)(pushed=pushed)
+
+    def __iter__(self):
+        yield self._byte_1
+        yield self._byte_2
+        yield self._byte_3
+
+
+def _frames(buttons, count, size):
+    """
+    :returns list of frames, each a list of (button, pushed) tuples
+    """
+    return [[(buttons[(i + j) % len(buttons)], (i + j) % 2 == 0) for j in range(size)] for i in range(count)]
+
+
+def _measure(name, create, apply, frames):
+    input_report = InputReport()
+
+    start = time.perf_counter()
+    instances = [create() for _ in range(1000)]
+    create_time = (time.perf_counter() - start) / len(instances)
+
+    button_state = instances[0]
+    start = time.perf_counter()
+    for frame in frames:
+        apply(button_state, frame)
+        input_report.set_button_status(button_state)
+    frame_time = (time.perf_counter() - start) / len(frames)
+
+    print(f'{name:>16}: create {create_time * 1e6:7.2f} us, {frame_time * 1e6:7.2f} us per frame')
+    return bytes(input_report.data[4:7])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--frames', type=int, default=100000)
+    parser.add_argument('--buttons', type=int, default=8, help='buttons changed per frame')
+    args = parser.parse_args()
+
+    buttons = sorted(ButtonState(Controller.PRO_CONTROLLER).get_available_buttons())
+    frames = _frames(buttons, args.frames, args.buttons)
+
+    def set_each(button_state, frame):
+        for button, pushed in frame:
+            button_state.set_button(button, pushed=pushed)
+
+    before = _measure('closures', ClosureButtonState, set_each, frames)
+    _measure('bitmask', lambda: ButtonState(Controller.PRO_CONTROLLER), set_each, frames)
+
+    # precompiled frames, as a macro would store them: masks of the pushed and released buttons
+    button_state = ButtonState(Controller.PRO_CONTROLLER)
+    masks = [(button_state.get_mask(*[button for button, pushed in frame if pushed]),
+              button_state.get_mask(*[button for button, pushed in frame if not pushed])) for frame in frames]
+    frame_masks = iter(masks)
+
+    def set_masks(button_state, _):
+        pushed, released = next(frame_masks)
+        button_state.release_many(released)
+        button_state.press_many(pushed)
+
+    after = _measure('bitmask bulk', lambda: ButtonState(Controller.PRO_CONTROLLER), set_masks, frames)
+    if before != after:
+        raise ValueError('Button states differ')
@@ -0,0 +1,92 @@
+import argparse
+import gc
+import os
+import tempfile
+import time
+
+from joycontrol.memory import FlashMemory, FLASH_SIZE
+
+""" Compares startup time and memory usage of the bytes/mmap backed FlashMemory
+with the previous list backed implementation.
+
+Creates the flash memories of several emulated controllers from one memory dump, like a process emulating
+multiple controllers would. If no dump is given, a blank dump is written to a temporary file.
+
+Usage:
+    benchmark_flash_memory.py [--spi_flash <spi_flash_memory_file>] [--controllers <number>]
+    benchmark_flash_memory.py -h | --help
+"""
+
+
+class ListFlashMemory:
+    """
+    The previous list backed flash memory, reduced to the constructor.
+    """
+    def __init__(self, spi_flash_memory_data=None, default_stick_cal=False, size=FLASH_SIZE):
+        if spi_flash_memory_data is None:
+            spi_flash_memory_data = [0xFF] * size
+            default_stick_cal = True
+
+        if len(spi_flash_memory_data) != size:
+            raise ValueError(f'Given data size {len(spi_flash_memory_data)} does not match size {size}.')
+        if isinstance(spi_flash_memory_data, bytes):
+            spi_flash_memory_data = list(spi_flash_memory_data)
+
+        if default_stick_cal:
+            spi_flash_memory_data[0x603D:0x6046] = [0x00, 0x07, 0x70, 0x00, 0x08, 0x80, 0x00, 0x07, 0x70]
+            spi_flash_memory_data[0x6046:0x604F] = [0x00, 0x08, 0x80, 0x00, 0x07, 0x70, 0x00, 0x07, 0x70]
+
+        self.data = spi_flash_memory_data
+
+
+def _rss():
+    """
+    :returns current resident set size in bytes
+    """
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def _measure(name, create, controllers):
+    gc.collect()
+    rss = _rss()
+    start = time.perf_counter()
+    memories = [create() for _ in range(controllers)]
+    duration = time.perf_counter() - start
+    rss = _rss() - rss
+
+    print(f'{name:>12}: startup {duration / controllers * 1000:8.3f} ms per controller, '
+          f'RSS +{rss / 2**20:7.2f} MiB for {controllers} controllers')
+    del memories
+
+
+def _read_dump(path):
+    with open(path, 'rb') as dump:
+        return dump.read()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--spi_flash')
+    parser.add_argument('--controllers', type=int, default=8)
+    args = parser.parse_args()
+
+    path = args.spi_flash
+    temp_file = None
+    if path is None:
+        temp_file = tempfile.NamedTemporaryFile(suffix='.bin', delete=False)
+        temp_file.write(b'\xFF' * FLASH_SIZE)
+        temp_file.close()
+        path = temp_file.name
+
+    try:
+        # every controller reads the dump, as run_controller_cli.py did
+        _measure('list', lambda: ListFlashMemory(_read_dump(path), default_stick_cal=True), args.controllers)
+        # every controller maps the dump, the page cache is shared
+        _measure('mmap', lambda: FlashMemory.from_file(path, default_stick_cal=True), args.controllers)
+        # one shared base image, copies share the mapping and copy only the modified pages
+        base = FlashMemory.from_file(path, default_stick_cal=True)
+        _measure('shared copy', base.copy, args.controllers)
+    finally:
+        if temp_file is not None:
+            os.unlink(temp_file.name)
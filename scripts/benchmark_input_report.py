@@ -0,0 +1,104 @@
+import argparse
+import timeit
+
+from joycontrol.report import InputReport
+
+""" Compares construction and serialization cost of the bytearray backed InputReport
+with the previous list backed implementation.
+
+Usage:
+    benchmark_input_report.py [--number <iterations>]
+    benchmark_input_report.py -h | --help
+"""
+
+
+class ListInputReport:
+    """
+    The previous list backed input report, reduced to the methods used in the benchmark.
+    """
+    def __init__(self):
+        self.data = [0x00] * 364
+        self.data[0] = 0xA1
+
+    def set_input_report_id(self, _id):
+        self.data[1] = _id
+
+    def set_timer(self, timer):
+        self.data[2] = timer % 256
+
+    def set_misc(self):
+        self.data[3] = 0x8E
+
+    def set_button_status(self, button_status):
+        self.data[4:7] = iter(button_status)
+
+    def set_stick_status(self, left_stick, right_stick):
+        self.data[7:10] = bytes(left_stick)
+        self.data[10:13] = bytes(right_stick)
+
+    def set_6axis_data(self):
+        for i in range(14, 50):
+            self.data[i] = 0x00
+
+    def set_ir_nfc_data(self, data):
+        for i in range(len(data)):
+            self.data[50 + i] = data[i]
+
+    def __bytes__(self):
+        _id = self.data[1]
+        if _id == 0x30:
+            return bytes(self.data[:14])
+        elif _id == 0x31:
+            return bytes(self.data[:363])
+        else:
+            return bytes(self.data[:51])
+
+
+BUTTONS = (0x08, 0x00, 0x40)
+STICK = (0x00, 0x08, 0x80)
+NFC = bytes(range(256)) + bytes(57)
+
+
+def construct_0x21(cls):
+    report = cls()
+    report.set_input_report_id(0x21)
+    report.set_misc()
+    report.set_timer(1)
+    return bytes(report)
+
+
+def tick_0x30(report):
+    report.set_6axis_data()
+    report.set_button_status(BUTTONS)
+    report.set_stick_status(STICK, STICK)
+    report.set_timer(1)
+    return report.get_view() if isinstance(report, InputReport) else bytes(report)
+
+
+def tick_0x31(report):
+    report.set_6axis_data()
+    report.set_ir_nfc_data(NFC)
+    report.set_button_status(BUTTONS)
+    report.set_stick_status(STICK, STICK)
+    report.set_timer(1)
+    return report.get_view() if isinstance(report, InputReport) else bytes(report)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--number', type=int, default=20000)
+    args = parser.parse_args()
+
+    for name, cls in (('list', ListInputReport), ('bytearray', InputReport)):
+        report_0x30 = cls()
+        report_0x30.set_input_report_id(0x30)
+        report_0x31 = cls()
+        report_0x31.set_input_report_id(0x31)
+
+        results = {
+            'construct+serialize 0x21': timeit.timeit(lambda: construct_0x21(cls), number=args.number),
+            'tick 0x30': timeit.timeit(lambda: tick_0x30(report_0x30), number=args.number),
+            'tick 0x31': timeit.timeit(lambda: tick_0x31(report_0x31), number=args.number),
+        }
+        for case, seconds in results.items():
+            print(f'{name:>10} {case:>25}: {seconds / args.number * 1e6:8.2f} us')
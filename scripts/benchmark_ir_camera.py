@@ -0,0 +1,81 @@
+import argparse
+import time
+
+import numpy as np
+
+from joycontrol.ir_camera import IrCamera, IrResolution, encode_fragments, downscale, to_grayscale, \
+    IR_FRAGMENT_DATA_SIZE, IR_FRAGMENT_DATA_OFFSET, IR_FRAGMENT_REPORT_ID, MCU_FRAME_SIZE
+from joycontrol.scheduler import NORMAL_PERIOD
+from joycontrol.utils import crc8
+
+""" Measures IR camera fragment encoding and the per tick cost of streaming, compared to encoding every fragment
+separately with the table driven CRC-8 of joycontrol.utils.
+
+One fragment is send per input report, a frame is encoded once per (fragments) ticks. The per tick cost includes the
+encoding of the frame amortized over its fragments and has to stay well below the input report period.
+
+Usage:
+    benchmark_ir_camera.py [--frames <number>] [--width <source_width>] [--height <source_height>]
+    benchmark_ir_camera.py -h | --help
+"""
+
+
+def encode_fragments_per_fragment(frame, resolution):
+    """
+    Fragment encoding without vectorised CRC.
+    """
+    image = downscale(frame, resolution).tobytes()
+    fragments = []
+    for i in range(resolution.get_fragments()):
+        fragment = bytearray(MCU_FRAME_SIZE)
+        fragment[0] = IR_FRAGMENT_REPORT_ID
+        fragment[3] = i
+        fragment[IR_FRAGMENT_DATA_OFFSET:IR_FRAGMENT_DATA_OFFSET + IR_FRAGMENT_DATA_SIZE] = \
+            image[i * IR_FRAGMENT_DATA_SIZE:(i + 1) * IR_FRAGMENT_DATA_SIZE]
+        fragment[-1] = crc8(memoryview(fragment)[:-1])
+        fragments.append(bytes(fragment))
+    return fragments
+
+
+def _measure(encode, frames, resolution):
+    start = time.perf_counter()
+    for frame in frames:
+        encode(frame, resolution)
+    return (time.perf_counter() - start) / len(frames)
+
+
+def _measure_stream(frames, resolution):
+    """
+    :returns seconds per tick streaming all frames, every fragment is acknowledged right away
+    """
+    camera = IrCamera()
+    camera.set_source(frames)
+    camera.start(resolution)
+
+    ticks = 0
+    start = time.perf_counter()
+    while camera.frames <= len(frames):
+        fragment = camera.get_fragment()
+        camera.acknowledge(fragment[3])
+        ticks += 1
+    return (time.perf_counter() - start) / ticks
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--frames', type=int, default=10)
+    parser.add_argument('--width', type=int, default=640)
+    parser.add_argument('--height', type=int, default=480)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    frames = [to_grayscale(rng.integers(0, 256, size=(args.height, args.width), dtype=np.uint8))
+              for _ in range(args.frames)]
+
+    print(f'input report period {NORMAL_PERIOD * 1000:.1f} ms')
+    for resolution in IrResolution:
+        per_fragment = _measure(encode_fragments_per_fragment, frames, resolution)
+        vectorised = _measure(encode_fragments, frames, resolution)
+        per_tick = _measure_stream(frames, resolution)
+        print(f'{resolution.name[1:]:>8}: encode per fragment {per_fragment * 1000:7.2f} ms, '
+              f'vectorised {vectorised * 1000:6.2f} ms per frame, streaming {per_tick * 1e6:6.1f} us per tick')
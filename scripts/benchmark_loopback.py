@@ -0,0 +1,125 @@
+import argparse
+import asyncio
+import logging
+import statistics
+
+from joycontrol import logging_default as log
+from joycontrol.controller import Controller
+from joycontrol.loopback import create_loopback_server
+from joycontrol.memory import FlashMemory
+from joycontrol.protocol import controller_protocol_factory
+from joycontrol.scheduler import ReportRate
+from joycontrol.simulated_console import SimulatedConsole
+
+logger = logging.getLogger(__name__)
+
+""" Benchmarks pairing time, steady state throughput and input latency against a simulated Switch console.
+
+The controller is connected to the simulated console over a loopback transport (unix socket pairs),
+no Switch or Bluetooth adapter is required.
+
+Usage:
+    benchmark_loopback.py [--controller <type>] [--rate <rate>] [--low_latency] [--runs <number>]
+                          [--duration <seconds>] [--presses <number>] [--nfc]
+    benchmark_loopback.py -h | --help
+"""
+
+
+def _percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+async def measure_latency(controller_state, console, presses):
+    """
+    Toggles a button and measures the time until an input report containing the new button state arrives.
+    """
+    button = 'a' if 'a' in controller_state.button_state.get_available_buttons() else 'left'
+    pushed = False
+
+    latencies = []
+    for _ in range(presses):
+        pushed = not pushed
+        controller_state.button_state.set_button(button, pushed=pushed)
+        expected = bytes(controller_state.button_state)
+
+        start = asyncio.get_event_loop().time()
+        arrival = asyncio.ensure_future(console.wait_for_input_report(lambda data: data[4:7] == expected, timeout=1))
+        await controller_state.send()
+        end, _ = await arrival
+        latencies.append(end - start)
+
+        # do not hit the same tick every time
+        await asyncio.sleep(0.0037)
+    return latencies
+
+
+async def run(args):
+    controller = Controller.from_arg(args.controller)
+    factory = controller_protocol_factory(controller, spi_flash=FlashMemory(),
+                                          report_rate=ReportRate.from_arg(args.rate), low_latency=args.low_latency)
+
+    loop = asyncio.get_event_loop()
+    start = loop.time()
+    transport, protocol, console_socks = await create_loopback_server(factory)
+    console = SimulatedConsole(*console_socks)
+    console.start()
+
+    result = {}
+    try:
+        reply_times = await console.pair()
+        result['pairing_s'] = loop.time() - start
+        result['reply_max_ms'] = max(reply_time for _, reply_time in reply_times) * 1000
+        result['player_lights_s'] = protocol.get_time_to_player_lights()
+        result['retransmits'] = console.retransmissions
+
+        # steady state
+        await asyncio.sleep(0.5)
+        reports = console.input_reports
+        steady_start = loop.time()
+        await asyncio.sleep(args.duration)
+        result['reports_per_s'] = (console.input_reports - reports) / (loop.time() - steady_start)
+
+        latencies = await measure_latency(protocol.get_controller_state(), console, args.presses)
+        result['latency_mean_ms'] = statistics.mean(latencies) * 1000
+        result['latency_p99_ms'] = _percentile(latencies, 99) * 1000
+
+        if args.nfc:
+            protocol.get_controller_state().set_nfc(bytes(540))
+            result['nfc_detect_s'] = await console.poll_nfc()
+    finally:
+        await console.close()
+        await transport.close()
+
+    return result
+
+
+async def _main(args):
+    results = [await run(args) for _ in range(args.runs)]
+
+    columns = list(results[0].keys())
+    print(' '.join(f'{column:>15}' for column in columns))
+    for result in results:
+        print(' '.join(f'{value:>15.3f}' if isinstance(value, float) else f'{value:>15}'
+                       for value in result.values()))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--controller', default='PRO_CONTROLLER')
+    parser.add_argument('--rate', default='normal', help='input report rate: normal, fast or adaptive')
+    parser.add_argument('--low_latency', action='store_true')
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--duration', type=float, default=2, help='seconds to measure the steady state report rate')
+    parser.add_argument('--presses', type=int, default=100, help='number of button presses to measure latency')
+    parser.add_argument('--nfc', action='store_true', help='also measure NFC tag detection time')
+    args = parser.parse_args()
+
+    log.configure(console_level=logging.WARNING)
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(
+        _main(args)
+    )
@@ -0,0 +1,138 @@
+import argparse
+import asyncio
+import collections
+import logging
+import time
+
+from joycontrol import logging_default as log
+from joycontrol.controller import Controller
+from joycontrol.controller_state import button_push
+from joycontrol.loopback import create_loopback_server
+from joycontrol.macro_vm import compile_script, MacroVM
+from joycontrol.memory import FlashMemory
+from joycontrol.protocol import controller_protocol_factory
+from joycontrol.scheduler import ReportRate
+from joycontrol.simulated_console import SimulatedConsole
+
+""" Compares mashing a button using a macro script stepped by the report loop with the previous coroutine of the CLI
+(button_push and asyncio.sleep), using a simulated Switch console.
+
+Shows the CPU time, the number of presses received by the console and how many input reports each press spanned.
+The number of instructions the VM executes per frame is measured without a connection.
+
+Usage:
+    benchmark_macro_vm.py [--rate <rate>] [--presses <number>] [--frames <number>]
+    benchmark_macro_vm.py -h | --help
+"""
+
+
+class _PressCounter:
+    """
+    Counts the presses of a button in the received input reports and the number of reports of every press.
+    """
+    def __init__(self, button_byte, button_mask):
+        self._button_byte = button_byte
+        self._button_mask = button_mask
+        self._length = 0
+        self.lengths = collections.Counter()
+
+    def __call__(self, data):
+        if len(data) > 13 and data[1] in (0x21, 0x30, 0x31):
+            if data[4 + self._button_byte] & self._button_mask:
+                self._length += 1
+            elif self._length:
+                self.lengths[self._length] += 1
+                self._length = 0
+        return False
+
+
+async def _mash_coroutine(controller_state, presses, period, frames):
+    for _ in range(presses):
+        await button_push(controller_state, 'a', sec=frames * period)
+        await asyncio.sleep(frames * period)
+
+
+async def _mash_script(controller_state, presses, period, frames):
+    script = f'''
+repeat {presses}
+    press a {frames}
+    wait {frames}
+end
+'''
+    await controller_state.run_script(compile_script(script, controller_state))
+
+
+async def _measure(name, console, controller_state, mash, presses, period, frames, button_bits):
+    counter = _PressCounter(*button_bits)
+    recorder = asyncio.ensure_future(console.wait_for_input_report(counter))
+
+    start_frame = controller_state.get_frame()
+    start_wall, start_cpu = time.perf_counter(), time.process_time()
+    await mash(controller_state, presses, period, frames)
+    wall, cpu = time.perf_counter() - start_wall, time.process_time() - start_cpu
+    reports = controller_state.get_frame() - start_frame
+
+    await controller_state.wait_frames(2)
+    await asyncio.sleep(0.002)
+    recorder.cancel()
+
+    print(f'{name:>9}: {wall:6.2f} s, cpu {cpu * 1e3 / presses:6.3f} ms per press, {reports} reports, '
+          f'{sum(counter.lengths.values())} presses received, reports per press {dict(sorted(counter.lengths.items()))}')
+
+
+def _measure_vm(controller_state, frames):
+    class Events:
+        @staticmethod
+        def get_player_lights():
+            return 1
+
+        @staticmethod
+        def is_rumbling():
+            return False
+
+    program = compile_script('loop\n    press a 1\n    wait 1\n    ramp l up 10\n    wait 10\nend', controller_state)
+    vm = MacroVM(program, controller_state, Events())
+    start = time.perf_counter()
+    for _ in range(frames):
+        vm.step()
+    step_time = (time.perf_counter() - start) / frames
+    print(f'VM step: {step_time * 1e6:.2f} us per frame, {vm.instructions / vm.frames:.2f} instructions per frame')
+
+
+async def run(args):
+    rate = ReportRate.from_arg(args.rate)
+    factory = controller_protocol_factory(Controller.PRO_CONTROLLER, spi_flash=FlashMemory(), report_rate=rate)
+    transport, protocol, console_socks = await create_loopback_server(factory)
+    controller_state = protocol.get_controller_state()
+    console = SimulatedConsole(*console_socks)
+    console.start()
+
+    _measure_vm(controller_state, args.frames)
+
+    button_bits = controller_state.button_state.BUTTON_BITS[Controller.PRO_CONTROLLER]['a']
+    try:
+        await console.pair()
+        await controller_state.wait_frames(10)
+
+        for frames in (1, 3):
+            print(f'{args.presses} presses of {frames} frames:')
+            await _measure('coroutine', console, controller_state, _mash_coroutine, args.presses, rate.get_period(),
+                           frames, button_bits)
+            await _measure('script', console, controller_state, _mash_script, args.presses, rate.get_period(),
+                           frames, button_bits)
+    finally:
+        await console.close()
+        await transport.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rate', default='fast', help='input report rate: normal, fast or adaptive')
+    parser.add_argument('--presses', type=int, default=100)
+    parser.add_argument('--frames', type=int, default=100000, help='frames of the VM step measurement')
+    args = parser.parse_args()
+
+    log.configure(console_level=logging.WARNING)
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(run(args))
@@ -0,0 +1,135 @@
+import argparse
+import os
+import time
+
+from joycontrol.ir_nfc_mcu import IrNfcMcu, Action, McuState
+from joycontrol.report import InputReport
+from joycontrol.utils import crc8
+
+""" Compares the per tick cost of the IR/NFC MCU data of 0x31 input reports with the previous implementation,
+which rebuilt the frame as a list and recalculated its checksum on every tick.
+
+The previous implementation used the crc8 package, it is used if installed.
+
+Usage:
+    benchmark_mcu_frames.py [--ticks <number>] [--nfc <nfc_file>]
+    benchmark_mcu_frames.py -h | --help
+"""
+
+
+def _legacy_crc8(data):
+    try:
+        from crc8 import crc8 as crc8_package
+    except ImportError:
+        return crc8(data)
+    crc = crc8_package()
+    crc.update(data)
+    return ord(crc.digest())
+
+
+def copyarray(dest, offset, src):
+    for i in range(len(src)):
+        dest[offset + i] = src[i]
+
+
+class ListIrNfcMcu(IrNfcMcu):
+    """
+    The previous list based frame construction, reduced to the tag polling and reading actions.
+    """
+    def __init__(self):
+        super().__init__()
+        self._bytes = [0] * 313
+
+    def set_nfc(self, nfc_content):
+        self._nfc_content = nfc_content
+
+    def set_action(self, v):
+        self._action = v
+
+    def update_nfc_report(self):
+        self._bytes = [0] * 313
+        if self.get_action() == Action.START_TAG_POLLING:
+            self._bytes[0] = 0x2a
+            self._bytes[1] = 0
+            self._bytes[2] = 5
+            self._bytes[3] = 0
+            self._bytes[4] = 0
+            data = [0x09, 0x31, 0x09, 0x00, 0x00, 0x00, 0x01, 0x01, 0x02, 0x00, 0x07]
+            copyarray(self._bytes, 5, data)
+            copyarray(self._bytes, 5 + len(data), self._nfc_content[0:3])
+            copyarray(self._bytes, 5 + len(data) + 3, self._nfc_content[4:8])
+        elif self.get_action() == Action.READ_FINISHED:
+            self._bytes[0] = 0x2a
+            self._bytes[1] = 0
+            self._bytes[2] = 5
+            self._bytes[3] = 0
+            self._bytes[4] = 0
+            data = bytes.fromhex('0931040000000101020007')
+            copyarray(self._bytes, 5, data)
+            copyarray(self._bytes, 5 + len(data), self._nfc_content[0:3])
+            copyarray(self._bytes, 5 + len(data) + 3, self._nfc_content[4:8])
+        else:
+            raise NotImplementedError(f'Action {self.get_action()} is not part of the benchmark')
+
+        self._bytes[-1] = _legacy_crc8(bytes(self._bytes[:-1]))
+
+    def __bytes__(self):
+        return bytes(self._bytes)
+
+
+def legacy_tick(mcu, input_report, nfc_content):
+    mcu.set_nfc(nfc_content)
+    mcu.update_nfc_report()
+    input_report.set_ir_nfc_data(bytes(mcu))
+
+
+def run(name, mcu, nfc_content, ticks, tick):
+    input_report = InputReport()
+    input_report.set_input_report_id(0x31)
+    mcu.set_state(McuState.NFC)
+
+    results = []
+    for action in (Action.START_TAG_POLLING, Action.READ_FINISHED):
+        mcu.set_action(action)
+        start = time.perf_counter()
+        for _ in range(ticks):
+            tick(mcu, input_report, nfc_content)
+        duration = time.perf_counter() - start
+        results.append((action, duration / ticks * 1e6, bytes(input_report.data[50:])))
+
+    for action, tick_us, _ in results:
+        print(f'{name:>8} {action.name:>18}: {tick_us:8.2f} us per tick')
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--ticks', type=int, default=20000)
+    parser.add_argument('--nfc', help='NFC tag dump, a random tag is used if not given')
+    args = parser.parse_args()
+
+    if args.nfc is not None:
+        with open(args.nfc, 'rb') as nfc_file:
+            nfc_content = nfc_file.read()
+    else:
+        nfc_content = os.urandom(540)
+
+    before = run('before', ListIrNfcMcu(), nfc_content, args.ticks, legacy_tick)
+
+    # current 0x31 tick of the protocol, the frame is only copied into the input report if it changed
+    mcu_frame = None
+
+    def tick(mcu, input_report, nfc_content):
+        global mcu_frame
+        mcu.set_nfc(nfc_content)
+        mcu.update_nfc_report()
+        frame = bytes(mcu)
+        if frame is not mcu_frame:
+            input_report.set_ir_nfc_data(frame)
+            mcu_frame = frame
+
+    after = run('after', IrNfcMcu(), nfc_content, args.ticks, tick)
+
+    for (action, _, before_data), (_, _, after_data) in zip(before, after):
+        if before_data != after_data:
+            raise ValueError(f'MCU data of action {action.name} differs')
@@ -0,0 +1,81 @@
+import argparse
+import os
+import tempfile
+import time
+
+from joycontrol.controller import Controller
+from joycontrol.controller_state import ControllerState
+from joycontrol.ir_nfc_mcu import IrNfcMcu, Action, McuState
+from joycontrol.memory import FlashMemory
+from joycontrol.nfc_library import NfcLibrary, NFC_TAG_SIZE
+
+""" Measures indexing of a NFC dump library and rotating through all of its tags, compared to reading every
+dump from disk when it is set, as the "nfc" command did before.
+
+If no library directory is given, random dumps are written to a temporary directory.
+
+Usage:
+    benchmark_nfc_library.py [--nfc_library <nfc_dump_directory>] [--tags <number>]
+    benchmark_nfc_library.py -h | --help
+"""
+
+
+def _create_library(directory, tags):
+    for i in range(tags):
+        with open(os.path.join(directory, f'tag_{i:04d}.bin'), 'wb') as nfc_file:
+            nfc_file.write(os.urandom(NFC_TAG_SIZE))
+
+
+def _rotate(controller_state, mcu, get_content, names):
+    start = time.perf_counter()
+    for name in names:
+        controller_state.set_nfc(get_content(name))
+        # first 0x31 input report containing the new tag
+        mcu.set_nfc(controller_state.get_nfc())
+        mcu.update_nfc_report()
+        bytes(mcu)
+    return time.perf_counter() - start
+
+
+def _read_file(path):
+    with open(path, 'rb') as nfc_file:
+        return nfc_file.read()
+
+
+def run(directory):
+    library = NfcLibrary(directory)
+
+    start = time.perf_counter()
+    library.load()
+    cold = time.perf_counter() - start
+
+    start = time.perf_counter()
+    library.load()
+    warm = time.perf_counter() - start
+
+    print(f'{len(library)} tags, index and preload: cold {cold * 1000:.1f} ms, warm {warm * 1000:.1f} ms')
+
+    controller_state = ControllerState(None, Controller.JOYCON_R, FlashMemory())
+    mcu = IrNfcMcu()
+    mcu.set_state(McuState.NFC)
+    mcu.set_action(Action.START_TAG_POLLING)
+
+    names = [tag.name for tag in library.get_tags()]
+    duration = _rotate(controller_state, mcu, lambda name: _read_file(os.path.join(directory, name)), names)
+    print(f'rotate through all tags, read from disk: {duration * 1000:8.2f} ms')
+    duration = _rotate(controller_state, mcu, library.get_content, names)
+    print(f'rotate through all tags, library:        {duration * 1000:8.2f} ms')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--nfc_library')
+    parser.add_argument('--tags', type=int, default=500)
+    args = parser.parse_args()
+
+    if args.nfc_library is not None:
+        run(args.nfc_library)
+    else:
+        with tempfile.TemporaryDirectory() as directory:
+            _create_library(directory, args.tags)
+            run(directory)
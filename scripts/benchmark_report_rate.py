@@ -0,0 +1,120 @@
+import argparse
+import asyncio
+import logging
+import statistics
+import threading
+import time
+
+from joycontrol import logging_default as log
+from joycontrol.controller import Controller
+from joycontrol.loopback import LoopbackTransport, create_socket_pairs
+from joycontrol.protocol import ControllerProtocol
+from joycontrol.scheduler import ReportRate
+
+logger = logging.getLogger(__name__)
+
+""" Benchmarks the full input report mode sender at the available report rates.
+
+The sender runs against a loopback transport (joycontrol.loopback), no Switch or Bluetooth adapter is required.
+For every rate the achieved report rate, tick lateness, the time spent per tick and the CPU usage are printed.
+
+Usage:
+    benchmark_report_rate.py [--duration <seconds>] [--load <threads>] [--rates <rate> ...]
+    benchmark_report_rate.py -h | --help
+"""
+
+
+def _percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def _busy_loop(stop):
+    # simulates CPU contention, competes with the event loop for the GIL
+    while not stop.is_set():
+        sum(range(1000))
+
+
+async def run_rate(rate, duration, controller=Controller.PRO_CONTROLLER):
+    loop = asyncio.get_event_loop()
+
+    (itr_sock, ctl_sock), (console_itr, console_ctl) = create_socket_pairs()
+
+    protocol = ControllerProtocol(controller, report_rate=rate)
+    transport = LoopbackTransport(loop, protocol, itr_sock, ctl_sock, 50)
+    protocol.connection_made(transport)
+
+    lateness = []
+    costs = []
+    protocol.get_report_scheduler().set_tick_callback(lambda late, cost: (lateness.append(late), costs.append(cost)))
+
+    # start the full input report mode directly, skipping the pairing
+    transport.pause_reading()
+    protocol._input_report_mode = 0x30
+    await transport.set_reader(asyncio.ensure_future(protocol.input_report_mode_full()))
+
+    received = 0
+    start = time.monotonic()
+    cpu_start = time.process_time()
+    while time.monotonic() - start < duration:
+        await loop.sock_recv(console_itr, 400)
+        received += 1
+    wall = time.monotonic() - start
+    cpu = time.process_time() - cpu_start
+
+    scheduler = protocol.get_report_scheduler()
+    await transport.close()
+    console_itr.close()
+    console_ctl.close()
+
+    return {
+        'rate': rate.value,
+        'period_ms': scheduler.get_period() * 1000,
+        'reports_per_s': received / wall,
+        'skipped': scheduler.skipped_ticks,
+        'late_p50_ms': _percentile(lateness, 50) * 1000,
+        'late_p99_ms': _percentile(lateness, 99) * 1000,
+        'cost_p50_ms': _percentile(costs, 50) * 1000,
+        'cost_p99_ms': _percentile(costs, 99) * 1000,
+        'cost_mean_ms': (statistics.mean(costs) if costs else 0) * 1000,
+        'cpu_percent': 100 * cpu / wall,
+    }
+
+
+async def _main(args):
+    rates = [ReportRate.from_arg(rate) for rate in args.rates]
+
+    stop = threading.Event()
+    threads = [threading.Thread(target=_busy_loop, args=(stop,), daemon=True) for _ in range(args.load)]
+    for thread in threads:
+        thread.start()
+
+    try:
+        results = []
+        for rate in rates:
+            results.append(await run_rate(rate, args.duration))
+    finally:
+        stop.set()
+
+    columns = list(results[0].keys())
+    print(' '.join(f'{column:>13}' for column in columns))
+    for result in results:
+        print(' '.join(f'{value:>13.3f}' if isinstance(value, float) else f'{value:>13}'
+                       for value in result.values()))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--duration', type=float, default=5, help='seconds to run each rate')
+    parser.add_argument('--load', type=int, default=0, help='number of busy threads simulating CPU contention')
+    parser.add_argument('--rates', nargs='+', default=['normal', 'fast', 'adaptive'])
+    args = parser.parse_args()
+
+    log.configure(console_level=logging.WARNING)
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(
+        _main(args)
+    )
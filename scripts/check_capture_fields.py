@@ -0,0 +1,101 @@
+import argparse
+import os
+import struct
+import sys
+import tempfile
+import time
+
+from joycontrol.capture import CaptureReader, CaptureWriter, Direction, analyse, load_fields
+from joycontrol.controller import Controller
+from joycontrol.report import InputReport, OutputReport, SubCommand
+
+""" Writes a sub command request and its reply to version 2 and version 1 capture files and checks the fields decoded
+by joycontrol.capture.load_fields, in particular the sub command id of 0x21 replies (byte 15, not the ACK byte 14).
+Empty records between the reports and captures of only empty records must be decoded as well.
+Requires NumPy.
+Exits with status 1 if a decoded field is wrong.
+
+Usage:
+    check_capture_fields.py [--records <number>]
+    check_capture_fields.py -h | --help
+"""
+
+
+def _create_reports():
+    request = OutputReport()
+    request.sub_0x10_spi_flash_read(0x6000, 0x10)
+
+    reply = InputReport()
+    reply.set_input_report_id(0x21)
+    reply.set_ack(0x90)
+    reply.sub_0x10_spi_flash_read(0x6000, 0x10, bytes(0x10))
+
+    return bytes(request), bytes(reply)
+
+
+def _write_v2(path, records):
+    with open(path, 'wb') as file:
+        writer = CaptureWriter(file, controller=Controller.PRO_CONTROLLER)
+        for data, direction in records:
+            writer.write(data, direction)
+        writer.close()
+
+
+def _write_v1(path, records):
+    with open(path, 'wb') as file:
+        for data, _ in records:
+            file.write(struct.pack('di', time.time(), len(data)))
+            file.write(data)
+
+
+def _check(name, path, request, reply, count):
+    with CaptureReader(path) as capture:
+        fields = load_fields(capture)
+
+    requests = fields[fields['report_id'] == 0x01]
+    replies = fields[fields['report_id'] == 0x21]
+    request_ids = set(requests['sub_command'].tolist())
+    reply_ids = set(replies['sub_command'].tolist())
+    print(f'{name}: {len(requests)} requests, sub commands {sorted(map(hex, request_ids))}, '
+          f'{len(replies)} replies, sub commands {sorted(map(hex, reply_ids))}')
+
+    expected = SubCommand.SPI_FLASH_READ.value
+    return (len(requests) == count and request_ids == {expected} and
+            len(replies) == count and reply_ids == {expected} and
+            all(row.tolist() == list(reply[4:7]) for row in replies['buttons']))
+
+
+def _check_empty(name, path, count):
+    with CaptureReader(path) as capture:
+        fields = load_fields(capture)
+        stats = analyse(capture)
+    print(f'{name}, empty records only: {len(fields)} records decoded, {stats.input_reports} input reports')
+    return len(fields) == count and not fields['size'].any()
+
+
+def run(args):
+    request, reply = _create_reports()
+    records = [(request, Direction.RECEIVED), (b'', Direction.SENT), (reply, Direction.SENT)] * args.records
+    empty_records = [(b'', Direction.SENT)] * args.records
+
+    passed = True
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'capture')
+        # version 1 captures derive the direction from the data, empty records are skipped
+        for name, write, empty_count in (('version 2', _write_v2, args.records), ('version 1', _write_v1, 0)):
+            write(path, records)
+            passed = _check(name, path, request, reply, args.records) and passed
+            write(path, empty_records)
+            passed = _check_empty(name, path, empty_count) and passed
+    return passed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--records', type=int, default=1000, help='number of request and reply pairs')
+    args = parser.parse_args()
+
+    if not run(args):
+        print('FAILED')
+        sys.exit(1)
+    print('ok')
@@ -0,0 +1,107 @@
+import argparse
+import asyncio
+import collections
+import logging
+import sys
+
+from joycontrol import logging_default as log
+from joycontrol.controller import Controller
+from joycontrol.controller_state import button_push
+from joycontrol.loopback import create_loopback_server
+from joycontrol.memory import FlashMemory
+from joycontrol.protocol import controller_protocol_factory
+from joycontrol.scheduler import ReportRate
+from joycontrol.simulated_console import SimulatedConsole
+
+""" Checks that timed button presses span exactly the requested number of input reports, using a simulated Switch
+console. The number of reports of the wall clock based button_push is shown for comparison.
+Exits with status 1 if a press spans a different number of reports.
+
+Usage:
+    check_frame_timing.py [--rate <rate>] [--low_latency] [--presses <number>] [--max_frames <number>]
+    check_frame_timing.py -h | --help
+"""
+
+
+async def _count_pushed_reports(console, press, button_byte, button_mask):
+    """
+    Runs a press and counts the consecutive input reports containing the button.
+    """
+    count = 0
+
+    def predicate(data):
+        nonlocal count
+        if data[4 + button_byte] & button_mask:
+            count += 1
+            return False
+        return count > 0
+
+    released = asyncio.ensure_future(console.wait_for_input_report(predicate, timeout=5))
+    await press()
+    await released
+    return count
+
+
+async def run(args):
+    rate = ReportRate.from_arg(args.rate)
+    factory = controller_protocol_factory(Controller.PRO_CONTROLLER, spi_flash=FlashMemory(),
+                                          report_rate=rate, low_latency=args.low_latency)
+    transport, protocol, console_socks = await create_loopback_server(factory)
+    controller_state = protocol.get_controller_state()
+    console = SimulatedConsole(*console_socks)
+    console.start()
+
+    button_byte, button_mask = controller_state.button_state.BUTTON_BITS[Controller.PRO_CONTROLLER]['a']
+    passed = True
+    try:
+        await console.pair()
+        await controller_state.wait_frames(10)
+
+        for frames in range(1, args.max_frames + 1):
+            press_counts = collections.Counter()
+            sleep_counts = collections.Counter()
+            for i in range(args.presses):
+                press_counts[await _count_pushed_reports(
+                    console, lambda: controller_state.press('a', frames=frames), button_byte, button_mask)] += 1
+                await controller_state.wait_frames(1 + i % 3)
+
+                sleep_counts[await _count_pushed_reports(
+                    console, lambda: button_push(controller_state, 'a', sec=frames * rate.get_period()),
+                    button_byte, button_mask)] += 1
+                await controller_state.wait_frames(1 + i % 3)
+
+            print(f'{frames} frames: press {dict(sorted(press_counts.items()))}, '
+                  f'button_push {dict(sorted(sleep_counts.items()))} (reports: presses)')
+            passed = passed and set(press_counts) == {frames}
+
+        # the frame counter of the protocol matches the reports received by the console,
+        # measured shortly after a report was send to let the console receive it
+        await controller_state.wait_frames(1)
+        await asyncio.sleep(0.002)
+        start_frame, start_reports = controller_state.get_frame(), console.input_reports
+        await controller_state.wait_frames(20)
+        await asyncio.sleep(0.002)
+        counted = controller_state.get_frame() - start_frame, console.input_reports - start_reports
+        print(f'wait_frames(20): {counted[0]} frames, {counted[1]} reports received')
+        passed = passed and counted[0] == counted[1] == 20
+    finally:
+        await console.close()
+        await transport.close()
+    return passed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rate', default='normal', help='input report rate: normal, fast or adaptive')
+    parser.add_argument('--low_latency', action='store_true')
+    parser.add_argument('--presses', type=int, default=10, help='presses per number of frames')
+    parser.add_argument('--max_frames', type=int, default=5)
+    args = parser.parse_args()
+
+    log.configure(console_level=logging.WARNING)
+
+    loop = asyncio.get_event_loop()
+    if not loop.run_until_complete(run(args)):
+        print('FAILED')
+        sys.exit(1)
+    print('ok')
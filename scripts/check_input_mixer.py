@@ -0,0 +1,130 @@
+import argparse
+import asyncio
+import logging
+import random
+import sys
+import time
+
+from joycontrol import logging_default as log
+from joycontrol.controller import Controller
+from joycontrol.input_mixer import PRIORITY_KEYBOARD
+from joycontrol.loopback import create_loopback_server
+from joycontrol.macro_vm import compile_script
+from joycontrol.memory import FlashMemory
+from joycontrol.protocol import controller_protocol_factory
+from joycontrol.scheduler import ReportRate
+from joycontrol.simulated_console import SimulatedConsole
+
+""" Runs three input sources at the same time against a simulated Switch console and checks that no press is lost:
+- a thread pushing and releasing X within a fraction of a report period, like keyboard callbacks
+- a macro script mashing A
+- a coroutine pushing B using the controller state (base layer), like CLI commands
+Shows the composition time per input report for the number of layers.
+Exits with status 1 if the console did not receive every press.
+
+Usage:
+    check_input_mixer.py [--rate <rate>] [--presses <number>]
+    check_input_mixer.py -h | --help
+"""
+
+
+class _PressCounter:
+    """
+    Counts the presses of buttons in the received input reports.
+    """
+    def __init__(self, bits):
+        # (byte, mask) by button
+        self._bits = bits
+        self._pushed = {button: False for button in bits}
+        self.presses = {button: 0 for button in bits}
+
+    def __call__(self, data):
+        if len(data) > 13 and data[1] in (0x21, 0x30, 0x31):
+            for button, (byte, mask) in self._bits.items():
+                pushed = bool(data[4 + byte] & mask)
+                if pushed and not self._pushed[button]:
+                    self.presses[button] += 1
+                self._pushed[button] = pushed
+        return False
+
+
+def _keyboard_thread(loop, layer, presses, period, seed):
+    rng = random.Random(seed)
+    for _ in range(presses):
+        loop.call_soon_threadsafe(layer.press, 'x')
+        time.sleep(rng.uniform(0, period / 4))
+        loop.call_soon_threadsafe(layer.release, 'x')
+        # the release must be contained in a report before the next press
+        time.sleep(period * rng.uniform(2.5, 4))
+
+
+async def _base_presses(controller_state, presses):
+    for i in range(presses):
+        await controller_state.press('b', frames=1)
+        await controller_state.wait_frames(1 + i % 3)
+
+
+def _measure_compose(input_mixer, count=100000):
+    start = time.perf_counter()
+    for _ in range(count):
+        input_mixer.compose()
+    return (time.perf_counter() - start) / count
+
+
+async def run(args):
+    rate = ReportRate.from_arg(args.rate)
+    factory = controller_protocol_factory(Controller.PRO_CONTROLLER, spi_flash=FlashMemory(), report_rate=rate)
+    transport, protocol, console_socks = await create_loopback_server(factory)
+    controller_state = protocol.get_controller_state()
+    input_mixer = controller_state.get_input_mixer()
+    console = SimulatedConsole(*console_socks)
+    console.start()
+
+    bits = {button: controller_state.button_state.BUTTON_BITS[Controller.PRO_CONTROLLER][button]
+            for button in ('x', 'a', 'b')}
+    counter = _PressCounter(bits)
+    try:
+        await console.pair()
+        await controller_state.wait_frames(10)
+        recorder = asyncio.ensure_future(console.wait_for_input_report(counter))
+
+        layer = input_mixer.create_layer('keyboard', priority=PRIORITY_KEYBOARD)
+        print(f'compose: {_measure_compose(input_mixer) * 1e6:.2f} us per report with {len(input_mixer.get_layers())} '
+              f'layers')
+
+        script = asyncio.ensure_future(controller_state.run_script(
+            compile_script(f'repeat {args.presses}\n    press a 1\n    wait 2\nend', controller_state), name='mash'))
+        # let the script add its layer
+        await asyncio.sleep(0)
+        # composing consumes latched presses, measure before the keyboard thread starts
+        print(f'compose: {_measure_compose(input_mixer) * 1e6:.2f} us per report with {len(input_mixer.get_layers())} '
+              f'layers')
+        loop = asyncio.get_event_loop()
+        keyboard = loop.run_in_executor(None, _keyboard_thread, loop, layer, args.presses, rate.get_period(), 0)
+        await asyncio.gather(keyboard, script, _base_presses(controller_state, args.presses))
+
+        await controller_state.wait_frames(2)
+        await asyncio.sleep(0.002)
+        recorder.cancel()
+        input_mixer.remove_layer(layer)
+    finally:
+        await console.close()
+        await transport.close()
+
+    print(f'presses received: {counter.presses} of {args.presses} each')
+    return all(presses == args.presses for presses in counter.presses.values())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rate', default='normal', help='input report rate: normal, fast or adaptive')
+    parser.add_argument('--presses', type=int, default=100, help='presses per source')
+    args = parser.parse_args()
+
+    log.configure(console_level=logging.WARNING)
+
+    loop = asyncio.get_event_loop()
+    if not loop.run_until_complete(run(args)):
+        print('FAILED')
+        sys.exit(1)
+    print('ok')
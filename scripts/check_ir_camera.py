@@ -0,0 +1,83 @@
+import argparse
+import asyncio
+import logging
+import sys
+import time
+
+import numpy as np
+
+from joycontrol import logging_default as log
+from joycontrol.controller import Controller
+from joycontrol.ir_camera import IrResolution, downscale, to_grayscale
+from joycontrol.loopback import create_loopback_server
+from joycontrol.memory import FlashMemory
+from joycontrol.protocol import controller_protocol_factory
+from joycontrol.scheduler import ReportRate
+from joycontrol.simulated_console import SimulatedConsole
+
+""" Checks the IR camera emulation against a simulated Switch console.
+
+Frames are generated as RGB NumPy arrays of a higher resolution. The console switches the controller to IR camera
+mode, drops a share of the received fragments and requests them again. Every received frame must equal the
+generated frame downscaled to the requested resolution. Exits with status 1 if a check fails.
+
+Usage:
+    check_ir_camera.py [--resolution <resolution>] [--frames <number>] [--drop_rate <rate>]
+    check_ir_camera.py -h | --help
+"""
+
+
+def _check(condition, message):
+    if not condition:
+        print(f'FAILED: {message}')
+        sys.exit(1)
+    print(f'ok: {message}')
+
+
+async def run(resolution, frames, drop_rate):
+    factory = controller_protocol_factory(Controller.JOYCON_R, spi_flash=FlashMemory(), report_rate=ReportRate.FAST)
+    transport, protocol, console_socks = await create_loopback_server(factory)
+    controller_state = protocol.get_controller_state()
+    console = SimulatedConsole(*console_socks)
+    console.start()
+
+    rng = np.random.default_rng(1)
+    generated = []
+
+    def generate_frames():
+        while True:
+            frame = rng.integers(0, 256, size=(480, 640, 3), dtype=np.uint8)
+            generated.append(frame)
+            yield frame
+
+    try:
+        await console.pair()
+        controller_state.set_ir_source(generate_frames())
+
+        start = time.perf_counter()
+        images = await console.stream_ir(*resolution.value, frames=frames, drop_rate=drop_rate, seed=2)
+        duration = time.perf_counter() - start
+        print(f'received {len(images)} frames in {duration:.2f} s, '
+              f'{console.output_reports} output reports, {protocol.get_ir_camera().retransmissions} retransmissions')
+
+        for i, image in enumerate(images):
+            expected = downscale(to_grayscale(generated[i]), resolution)
+            _check(image == expected.tobytes(), f'frame {i} matches the downscaled source frame')
+    finally:
+        await console.close()
+        await transport.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--resolution', default='80x60', help='320x240, 160x120, 80x60 or 40x30')
+    parser.add_argument('--frames', type=int, default=2)
+    parser.add_argument('--drop_rate', type=float, default=0.05)
+    args = parser.parse_args()
+
+    log.configure(console_level=logging.WARNING)
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(
+        run(IrResolution.from_arg(args.resolution), args.frames, args.drop_rate)
+    )
@@ -0,0 +1,134 @@
+import argparse
+import asyncio
+import logging
+import sys
+import time
+
+from joycontrol import logging_default as log
+from joycontrol.controller import Controller
+from joycontrol.loopback import create_loopback_server
+from joycontrol.macro import Macro, TIMELINE_ROW_SIZE
+from joycontrol.memory import FlashMemory
+from joycontrol.protocol import controller_protocol_factory
+from joycontrol.report import InputReport
+from joycontrol.scheduler import ReportRate
+from joycontrol.simulated_console import SimulatedConsole
+
+""" Plays a compiled macro to a simulated Switch console several times and checks that the console receives exactly
+the timeline rows in every run. Shows the compile time and the cost of setting the status bytes of one input report
+from the timeline and from the controller state.
+Exits with status 1 if the received reports differ from the timeline.
+
+Usage:
+    check_macro_timeline.py [--rate <rate>] [--low_latency] [--runs <number>] [--repeat <number>]
+    check_macro_timeline.py -h | --help
+"""
+
+
+def _create_macro(buttons, repeat):
+    """
+    :returns macro pushing every button and moving the left stick, like the test_buttons command of the CLI
+    """
+    macro = Macro()
+    for _ in range(repeat):
+        for button in buttons:
+            macro.press(button, frames=3).wait(2)
+        for direction in ('up', 'right', 'down', 'left'):
+            macro.stick('l', direction).wait(5)
+        macro.stick('l', 'center').hold('l', 'r').wait(4).release()
+    return macro
+
+
+def _find_rows(received, timeline):
+    """
+    :returns True if the received status bytes contain the rows of the timeline consecutively
+    """
+    data = b''.join(received)
+    expected = timeline.get_data()
+    index = data.find(expected)
+    while index != -1 and index % TIMELINE_ROW_SIZE != 0:
+        index = data.find(expected, index + 1)
+    return index != -1
+
+
+def _measure_status_cost(controller_state, timeline, count=100000):
+    input_report = InputReport()
+    data = timeline.get_data()
+    length = len(timeline)
+
+    start = time.perf_counter()
+    for frame in range(count):
+        offset = (frame % length) * TIMELINE_ROW_SIZE
+        input_report.set_controller_status(data[offset:offset + TIMELINE_ROW_SIZE])
+    timeline_time = (time.perf_counter() - start) / count
+
+    start = time.perf_counter()
+    for _ in range(count):
+        input_report.set_button_status(controller_state.button_state)
+        input_report.set_stick_status(controller_state.l_stick_state, controller_state.r_stick_state)
+    state_time = (time.perf_counter() - start) / count
+
+    print(f'status bytes per report: timeline {timeline_time * 1e6:.2f} us, controller state {state_time * 1e6:.2f} us')
+
+
+async def run(args):
+    factory = controller_protocol_factory(Controller.PRO_CONTROLLER, spi_flash=FlashMemory(),
+                                          report_rate=ReportRate.from_arg(args.rate), low_latency=args.low_latency)
+    transport, protocol, console_socks = await create_loopback_server(factory)
+    controller_state = protocol.get_controller_state()
+    console = SimulatedConsole(*console_socks)
+    console.start()
+
+    buttons = sorted(controller_state.button_state.get_available_buttons())
+    macro = _create_macro(buttons, args.repeat)
+    start = time.perf_counter()
+    timeline = macro.compile(controller_state)
+    compile_time = time.perf_counter() - start
+    print(f'compiled {len(macro)} steps to {len(timeline)} frames in {compile_time * 1e3:.2f} ms')
+    _measure_status_cost(controller_state, timeline)
+
+    passed = True
+    try:
+        await console.pair()
+        await controller_state.wait_frames(10)
+
+        for i in range(args.runs):
+            received = []
+
+            def record(data):
+                if len(data) > 13 and data[1] in (0x21, 0x30, 0x31):
+                    received.append(data[4:13])
+                return False
+
+            recorder = asyncio.ensure_future(console.wait_for_input_report(record))
+            start_frame = controller_state.get_frame()
+            await controller_state.play(timeline)
+            await controller_state.wait_frames(2)
+            await asyncio.sleep(0.002)
+            recorder.cancel()
+
+            found = _find_rows(received, timeline)
+            print(f'run {i}: {controller_state.get_frame() - start_frame} frames, {len(received)} reports received, '
+                  f'timeline {"found" if found else "NOT found"}')
+            passed = passed and found and not protocol.is_playing_timeline()
+    finally:
+        await console.close()
+        await transport.close()
+    return passed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rate', default='normal', help='input report rate: normal, fast or adaptive')
+    parser.add_argument('--low_latency', action='store_true')
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--repeat', type=int, default=2, help='repetitions of the test macro')
+    args = parser.parse_args()
+
+    log.configure(console_level=logging.WARNING)
+
+    loop = asyncio.get_event_loop()
+    if not loop.run_until_complete(run(args)):
+        print('FAILED')
+        sys.exit(1)
+    print('ok')
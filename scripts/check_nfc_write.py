@@ -0,0 +1,120 @@
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import tempfile
+from contextlib import suppress
+
+from joycontrol import logging_default as log
+from joycontrol.controller import Controller
+from joycontrol.ir_nfc_mcu import MCU_FRAME_SIZE
+from joycontrol.loopback import create_loopback_server
+from joycontrol.memory import FlashMemory
+from joycontrol.nfc_library import DeferredNfcWriter, NFC_TAG_SIZE, get_uid, read_nfc_dump, write_nfc_dump
+from joycontrol.protocol import controller_protocol_factory
+from joycontrol.simulated_console import SimulatedConsole
+from joycontrol.utils import crc8
+
+""" Checks NTAG writes of the emulated IR/NFC MCU against a simulated Switch console.
+
+The console pairs, polls and reads a tag and writes amiibo data to it twice, in several MCU packets each.
+Both writes are checked by reading the tag again. The writes must be coalesced into a single write of the dump file.
+A write addressing another tag must be rejected. Removing the tag during a read must not corrupt the MCU frames.
+Exits with status 1 if a check fails.
+
+Usage:
+    check_nfc_write.py [--nfc <nfc_file>] [--write_delay <seconds>]
+    check_nfc_write.py -h | --help
+"""
+
+
+def _check(condition, message):
+    if not condition:
+        print(f'FAILED: {message}')
+        sys.exit(1)
+    print(f'ok: {message}')
+
+
+async def run(dump_path, write_delay):
+    writer = DeferredNfcWriter(delay=write_delay)
+    content = read_nfc_dump(dump_path)
+
+    factory = controller_protocol_factory(Controller.JOYCON_R, spi_flash=FlashMemory())
+    transport, protocol, console_socks = await create_loopback_server(factory)
+    controller_state = protocol.get_controller_state()
+    console = SimulatedConsole(*console_socks)
+    console.start()
+
+    try:
+        await console.pair()
+        controller_state.set_nfc(content, store=lambda new_content: writer.schedule(dump_path, new_content))
+
+        await console.poll_nfc()
+        _check(await console.read_nfc() == content, 'read tag matches the dump')
+
+        # amiibo application data, more than one page and more than one packet
+        expected = bytearray(content)
+        writes = [(0x2C, os.urandom(0x60)), (0x3C, os.urandom(0x20))]
+        for page, data in writes:
+            expected[page * 4:page * 4 + len(data)] = data
+        write_time = await console.write_nfc(get_uid(content), writes)
+        print(f'write finished after {write_time * 1000:.1f} ms')
+        _check(controller_state.get_nfc() == expected, 'write updated the tag in memory')
+        _check(await console.read_nfc() == expected, 'read tag matches the write')
+
+        writes = [(0x5C, os.urandom(0x08))]
+        for page, data in writes:
+            expected[page * 4:page * 4 + len(data)] = data
+        await console.write_nfc(get_uid(content), writes)
+        _check(await console.read_nfc() == expected, 'read tag matches the second write')
+
+        try:
+            await console.write_nfc(bytes(7), [(0x2C, bytes(4))], timeout=0.3)
+            rejected = False
+        except asyncio.TimeoutError:
+            rejected = True
+        _check(rejected and controller_state.get_nfc() == expected, 'write to another tag is rejected')
+
+        _check(writer.has_pending() and read_nfc_dump(dump_path) == content, 'dump file is written deferred')
+        await writer.flush()
+        _check(read_nfc_dump(dump_path) == expected, 'dump file contains both writes')
+        _check(writer.written_dumps == 1, 'writes were coalesced into a single file write')
+
+        # remove the tag while the console reads it
+        frames = []
+
+        def record(data):
+            if len(data) >= 50 + MCU_FRAME_SIZE and data[1] == 0x31:
+                frames.append(bytes(data[50:50 + MCU_FRAME_SIZE]))
+            return False
+
+        recorder = asyncio.ensure_future(console.wait_for_input_report(record))
+        read = asyncio.ensure_future(console.read_nfc(timeout=0.3))
+        controller_state.set_nfc(None)
+        with suppress(asyncio.TimeoutError):
+            await read
+        recorder.cancel()
+        _check(frames and all(crc8(frame[:-1]) == frame[-1] for frame in frames),
+               'MCU frames stay intact if the tag is removed during a read')
+    finally:
+        await console.close()
+        await transport.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--nfc', help='NFC tag dump, a random tag is used if not given. The dump is not modified.')
+    parser.add_argument('--write_delay', type=float, default=5.0)
+    args = parser.parse_args()
+
+    log.configure(console_level=logging.WARNING)
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'tag.bin')
+        write_nfc_dump(path, read_nfc_dump(args.nfc) if args.nfc is not None else os.urandom(NFC_TAG_SIZE))
+
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(
+            run(path, args.write_delay)
+        )
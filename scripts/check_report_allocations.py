@@ -0,0 +1,127 @@
+import argparse
+import asyncio
+import functools
+import sys
+import tracemalloc
+
+from joycontrol.controller import Controller
+from joycontrol.protocol import ControllerProtocol
+from joycontrol.report import InputReport, SubCommand
+
+""" Checks that steady state input report ticks and constant sub command replies do not allocate report buffers.
+
+Drives the 0x30/0x31 send path of ControllerProtocol and the sub command handlers against a transport discarding all
+data and measures allocations using tracemalloc. Ticks call the coroutines directly, so only the send path itself is
+measured. The only transient allocations left are the coroutine frames of the send path.
+Exits with status 1 if a tick retains or allocates as much as a new input report.
+
+Usage:
+    check_report_allocations.py [--ticks <number>]
+    check_report_allocations.py -h | --help
+"""
+
+
+class NullTransport:
+    async def write(self, data):
+        pass
+
+    def get_extra_info(self, name, default=None):
+        if name == 'sockname':
+            return '00:00:00:00:00:00', 19
+        return default
+
+
+def _input_report_size():
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    report = InputReport()
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del report
+    return size
+
+
+async def measure(name, tick, ticks):
+    # warm up, e.g. to populate caches
+    for _ in range(100):
+        await tick()
+
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    max_peak = 0
+    for _ in range(ticks):
+        tracemalloc.reset_peak()
+        current = tracemalloc.get_traced_memory()[0]
+        await tick()
+        max_peak = max(max_peak, tracemalloc.get_traced_memory()[1] - current)
+    retained = (tracemalloc.get_traced_memory()[0] - start) / ticks
+    tracemalloc.stop()
+
+    print(f'{name:>35}: retained {retained:6.2f} bytes, max transient {max_peak:6d} bytes per tick')
+    return retained, max_peak
+
+
+async def _main(args):
+    report_size = _input_report_size()
+    print(f'{"new InputReport":>35}: {report_size} bytes')
+
+    protocol = ControllerProtocol(Controller.PRO_CONTROLLER)
+    protocol.connection_made(NullTransport())
+
+    full_reports = {}
+    for report_id in (0x30, 0x31):
+        input_report = InputReport()
+        input_report.set_vibrator_input()
+        input_report.set_misc()
+        input_report.set_input_report_id(report_id)
+        full_reports[report_id] = input_report
+    mcu_frame = None
+
+    # ticks return the coroutine instead of awaiting it, so no coroutine frame of this script is measured
+    def full_tick_0x30():
+        input_report = full_reports[0x30]
+        input_report.set_6axis_data()
+        return protocol.write(input_report)
+
+    def full_tick_0x31():
+        nonlocal mcu_frame
+        input_report = full_reports[0x31]
+        input_report.set_6axis_data()
+        mcu_frame = protocol._set_mcu_data(input_report, mcu_frame)
+        return protocol.write(input_report)
+
+    # the outgoing buffer passed to the transport
+    def baseline_tick():
+        return protocol.transport.write(full_reports[0x30].get_view())
+
+    cases = [('0x30 tick', full_tick_0x30), ('0x31 tick', full_tick_0x31)]
+    for sub_command, handler, data in (
+            (SubCommand.SET_SHIPMENT_STATE, protocol._command_set_shipment_state, b'\x01'),
+            (SubCommand.ENABLE_6AXIS_SENSOR, protocol._command_enable_6axis_sensor, b'\x01'),
+            (SubCommand.ENABLE_VIBRATION, protocol._command_enable_vibration, b'\x01'),
+            (SubCommand.SET_PLAYER_LIGHTS, protocol._command_set_player_lights, b'\x01'),
+            # cached read of the controller colors
+            (SubCommand.SPI_FLASH_READ, protocol._command_spi_flash_read, b'\x50\x60\x00\x00\x0D')):
+        cases.append((f'{sub_command.name} reply', functools.partial(handler, data)))
+
+    await measure('baseline (outgoing buffer only)', baseline_tick, args.ticks)
+
+    failed = False
+    for name, tick in cases:
+        retained, max_peak = await measure(name, tick, args.ticks)
+        if retained > report_size or max_peak > report_size:
+            print(f'FAILED: {name}')
+            failed = True
+
+    return failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--ticks', type=int, default=2000)
+    args = parser.parse_args()
+
+    loop = asyncio.get_event_loop()
+    if loop.run_until_complete(_main(args)):
+        sys.exit(1)
+    print('ok')
@@ -0,0 +1,106 @@
+import argparse
+import asyncio
+import logging
+import sys
+
+from joycontrol import logging_default as log
+from joycontrol.controller import Controller
+from joycontrol.loopback import create_loopback_server
+from joycontrol.macro_vm import compile_script
+from joycontrol.memory import FlashMemory
+from joycontrol.protocol import controller_protocol_factory
+from joycontrol.scheduler import NORMAL_PERIOD, ReportRate
+from joycontrol.simulated_console import SimulatedConsole
+
+""" Checks that timed waits of macro scripts keep wall clock timing at every report rate, using a simulated Switch
+console. A script pushes a button repeatedly for a duration in milliseconds, the console measures when the presses
+arrive. Runs the normal and fast rates with and without low latency mode, and the adaptive rate after it fell back to
+the normal period.
+Exits with status 1 if a press starts more than two report periods early or late, or if the error adds up.
+
+Usage:
+    check_script_timing.py [--presses <number>] [--interval <ms>]
+    check_script_timing.py -h | --help
+"""
+
+
+class _PressTimes:
+    """
+    Records the arrival times of the presses of a button.
+    """
+    def __init__(self, button_byte, button_mask):
+        self._button_byte = button_byte
+        self._button_mask = button_mask
+        self._pushed = False
+        self.times = []
+
+    def __call__(self, data):
+        if len(data) > 13 and data[1] in (0x21, 0x30, 0x31):
+            pushed = bool(data[4 + self._button_byte] & self._button_mask)
+            if pushed and not self._pushed:
+                self.times.append(asyncio.get_event_loop().time())
+            self._pushed = pushed
+        return False
+
+
+async def _measure(name, console, controller_state, period, args):
+    button_bits = controller_state.button_state.BUTTON_BITS[Controller.PRO_CONTROLLER]['a']
+    presses = _PressTimes(*button_bits)
+    recorder = asyncio.ensure_future(console.wait_for_input_report(presses))
+
+    script = f'repeat {args.presses}\n    press a {args.interval}ms\n    wait {args.interval}ms\nend'
+    await controller_state.run_script(compile_script(script, controller_state))
+    await controller_state.wait_frames(2)
+    await asyncio.sleep(0.002)
+    recorder.cancel()
+
+    step = 2 * args.interval / 1000
+    errors = [time - presses.times[0] - i * step for i, time in enumerate(presses.times)]
+    max_error = max(abs(error) for error in errors)
+    print(f'{name:>26}: {len(presses.times)} presses, max error {max_error * 1000:5.1f} ms, '
+          f'last press {errors[-1] * 1000:5.1f} ms')
+    return len(presses.times) == args.presses and max_error <= 2 * period
+
+
+async def run(args):
+    passed = True
+    for rate, low_latency, fallback in ((ReportRate.NORMAL, False, False), (ReportRate.NORMAL, True, False),
+                                        (ReportRate.FAST, False, False), (ReportRate.FAST, True, False),
+                                        (ReportRate.ADAPTIVE, False, True)):
+        factory = controller_protocol_factory(Controller.PRO_CONTROLLER, spi_flash=FlashMemory(), report_rate=rate,
+                                              low_latency=low_latency)
+        transport, protocol, console_socks = await create_loopback_server(factory)
+        controller_state = protocol.get_controller_state()
+        console = SimulatedConsole(*console_socks)
+        console.start()
+        try:
+            await console.pair()
+            await controller_state.wait_frames(10)
+
+            name = f'{rate.value}{" low latency" if low_latency else ""}'
+            if fallback:
+                # like an adaptive scheduler which could not keep up
+                protocol.get_report_scheduler()._set_period(NORMAL_PERIOD)
+                name += ' (fallback)'
+            period = protocol.get_report_scheduler().get_period()
+            passed = await _measure(name, console, controller_state, max(period, rate.get_period()), args) \
+                and passed
+        finally:
+            await console.close()
+            await transport.close()
+    return passed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--presses', type=int, default=10)
+    parser.add_argument('--interval', type=int, default=50, help='press and release duration in milliseconds')
+    args = parser.parse_args()
+
+    log.configure(console_level=logging.WARNING)
+
+    loop = asyncio.get_event_loop()
+    if not loop.run_until_complete(run(args)):
+        print('FAILED')
+        sys.exit(1)
+    print('ok')
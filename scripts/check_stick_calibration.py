@@ -0,0 +1,105 @@
+import argparse
+import asyncio
+import logging
+import struct
+import sys
+
+from joycontrol import logging_default as log
+from joycontrol.controller import Controller
+from joycontrol.flash_layout import USER_CALIBRATION_MAGIC
+from joycontrol.loopback import create_loopback_server
+from joycontrol.memory import FlashMemory
+from joycontrol.protocol import controller_protocol_factory
+from joycontrol.report import SubCommand
+from joycontrol.simulated_console import SimulatedConsole
+
+""" Checks that stick calibration written to the flash memory by the console is used by the stick states.
+
+A simulated Switch console writes user calibration of both sticks like the calibration menu, the centered sticks must
+move to the new center and set_center/set_up must use the new values. Erasing the user calibration sector must restore
+the factory calibration. Exits with status 1 if a check fails.
+
+Usage:
+    check_stick_calibration.py [--h_center <value>] [--v_center <value>]
+    check_stick_calibration.py -h | --help
+"""
+
+
+def _check(condition, message):
+    if not condition:
+        print(f'FAILED: {message}')
+        sys.exit(1)
+    print(f'ok: {message}')
+
+
+def _pack(h, v):
+    return bytes((h & 0xFF, (h >> 8) | ((v & 0xF) << 4), v >> 4))
+
+
+def _encode_calibration(side, h_center, v_center, max_above, max_below):
+    """
+    :returns 9 calibration bytes, see joycontrol.flash_layout.decode_l_stick_calibration
+    """
+    if side == 'l':
+        return _pack(max_above, max_above) + _pack(h_center, v_center) + _pack(max_below, max_below)
+    return _pack(h_center, v_center) + _pack(max_below, max_below) + _pack(max_above, max_above)
+
+
+def _get_position(stick_state):
+    return stick_state.get_h(), stick_state.get_v()
+
+
+async def _write_flash(console, offset, data):
+    _, reply = await console.send_sub_command(SubCommand.SPI_FLASH_WRITE,
+                                              struct.pack('<IB', offset, len(data)) + data)
+    return reply[16] == 0x00
+
+
+async def run(args):
+    factory = controller_protocol_factory(Controller.PRO_CONTROLLER, spi_flash=FlashMemory())
+    transport, protocol, console_socks = await create_loopback_server(factory)
+    controller_state = protocol.get_controller_state()
+    console = SimulatedConsole(*console_socks)
+    console.start()
+
+    factory_centers = [_get_position(stick) for stick in (controller_state.l_stick_state,
+                                                          controller_state.r_stick_state)]
+    print(f'factory centers: {factory_centers}')
+    try:
+        await console.pair()
+
+        # magic and calibration of the left stick directly followed by the right stick, as send by the console
+        data = b''
+        for side in ('l', 'r'):
+            data += USER_CALIBRATION_MAGIC + _encode_calibration(side, args.h_center, args.v_center, 0x500, 0x400)
+        _check(await _write_flash(console, 0x8010, data), 'console wrote user calibration')
+
+        expected = (args.h_center, args.v_center)
+        for side in ('l', 'r'):
+            stick_state = getattr(controller_state, f'{side}_stick_state')
+            _check(_get_position(stick_state) == expected, f'{side} stick moved to the new center {expected}')
+            stick_state.set_up()
+            _check(_get_position(stick_state) == (args.h_center, args.v_center + 0x500),
+                   f'{side} stick set_up uses the new calibration')
+            stick_state.set_center()
+            _check(_get_position(stick_state) == expected, f'{side} stick set_center uses the new calibration')
+
+        _, reply = await console.send_sub_command(SubCommand.SPI_SECTOR_ERASE, struct.pack('<I', 0x8000))
+        _check(reply[16] == 0x00, 'console erased the user calibration')
+        _check([_get_position(stick) for stick in (controller_state.l_stick_state, controller_state.r_stick_state)]
+               == factory_centers, 'sticks moved back to the factory centers')
+    finally:
+        await console.close()
+        await transport.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--h_center', type=lambda value: int(value, 0), default=0x7A0, help='new horizontal center')
+    parser.add_argument('--v_center', type=lambda value: int(value, 0), default=0x850, help='new vertical center')
+    args = parser.parse_args()
+
+    log.configure(console_level=logging.WARNING)
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(run(args))
@@ -1,64 +1,61 @@
 import argparse
-import struct
 
-from joycontrol.report import InputReport, OutputReport, SubCommand
+from joycontrol.capture import CaptureReader, analyse
+from joycontrol.report import SubCommand
 
-""" joycontrol capture parsing example.
+""" Prints summary statistics of a joycontrol capture.
+
+Reads version 2 and version 1 capture files. The capture is analysed in a single streaming pass,
+requires NumPy ("pip install joycontrol[analysis]").
+For custom investigations see joycontrol.capture.CaptureReader and joycontrol.capture.load_fields.
 
 Usage:
-    parse_capture.py <capture_file>
+    parse_capture.py <capture_file> [--jitter_bin_ms <ms>] [--jitter_max_ms <ms>]
     parse_capture.py -h | --help
 """
 
 
-def _eof_read(file, size):
-    """
-    Raises EOFError if end of file is reached.
-    """
-    data = file.read(size)
-    if not data:
-        raise EOFError()
-    return data
+def _sub_command_name(_id):
+    try:
+        return SubCommand(_id).name
+    except ValueError:
+        return hex(_id)
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('capture_file')
+    parser.add_argument('--jitter_bin_ms', type=float, default=1, help='width of the inter-arrival histogram bins')
+    parser.add_argument('--jitter_max_ms', type=float, default=50, help='last edge of the inter-arrival histogram')
     args = parser.parse_args()
 
-    # list of time, report tuples
-    input_reports = []
-    output_reports = []
+    bins = int(args.jitter_max_ms / args.jitter_bin_ms)
+    bin_edges = [i * args.jitter_bin_ms for i in range(bins + 1)]
+
+    with CaptureReader(args.capture_file) as capture:
+        print(f'Capture version {capture.version}')
+        if capture.version >= 2:
+            print(f'Controller: {capture.controller}, adapter address: {capture.address}')
 
-    with open(args.capture_file, 'rb') as capture:
-        try:
-            start_time = None
-            while True:
-                # parse capture time
-                time = struct.unpack('d', _eof_read(capture, 8))[0]
-                if start_time is None:
-                    start_time = time
+        stats = analyse(capture, jitter_bin_edges_ms=bin_edges)
 
-                # parse data size
-                size = struct.unpack('i', _eof_read(capture, 4))[0]
-                # parse data
-                data = list(_eof_read(capture, size))
+    print(f'Duration: {stats.get_duration():.3f} s')
+    print('Input reports:', stats.input_reports)
+    print('Output reports:', stats.output_reports)
+    print(f'Input report rate: {stats.get_report_rate():.2f} Hz')
+    print('Dropped input report timer values:', stats.dropped_timer_values)
 
-                if data[0] == 0xA1:
-                    report = InputReport(data)
-                    # normalise time
-                    input_reports.append((time - start_time, report))
-                elif data[0] == 0xA2:
-                    report = OutputReport(data)
-                    # normalise time
-                    output_reports.append((time - start_time, report))
-                else:
-                    raise ValueError(f'Unexpected data.')
-        except EOFError:
-            pass
+    print('Input report ids:')
+    for _id, count in enumerate(stats.input_report_ids):
+        if count:
+            print(f'    0x{_id:02X}: {count}')
 
-    print('Finished parsing reports.')
-    print('Input reports:', len(input_reports))
-    print('Output reports:', len(output_reports))
+    print('Sub commands:')
+    for _id, count in enumerate(stats.sub_commands):
+        if count:
+            print(f'    {_sub_command_name(_id)}: {count}')
 
-    # Do some investigation...
+    print('Input report inter-arrival times:')
+    for i, count in enumerate(stats.jitter_histogram):
+        if count:
+            print(f'    {bin_edges[i]:6.1f} - {bin_edges[i + 1]:6.1f} ms: {count}')
@@ -3,12 +3,12 @@ import asyncio
 import logging
 import os
 import socket
-import struct
-import time
 
 import hid
 
 from joycontrol import logging_default as log, utils
+from joycontrol.capture import CaptureWriter, Direction
+from joycontrol.controller import Controller
 from joycontrol.device import HidDevice
 from joycontrol.server import PROFILE_PATH
 from joycontrol.utils import AsyncHID
@@ -20,10 +20,22 @@ PRODUCT_ID_JL = 8198
 PRODUCT_ID_JR = 8199
 PRODUCT_ID_PC = 8201
 
+CONTROLLERS = {
+    PRODUCT_ID_JL: Controller.JOYCON_L,
+    PRODUCT_ID_JR: Controller.JOYCON_R,
+    PRODUCT_ID_PC: Controller.PRO_CONTROLLER
+}
+
 
 class Relay:
-    def __init__(self, capture_file=None):
-        self._capture_file = capture_file
+    def __init__(self, capture_file=None, controller=None, address=None):
+        self._capture = None
+        if capture_file is not None:
+            self._capture = CaptureWriter(capture_file, controller=controller, address=address)
+
+    def close(self):
+        if self._capture is not None:
+            self._capture.close()
 
     async def relay_input(self, hid_device, client_itr):
         loop = asyncio.get_event_loop()
@@ -33,11 +45,9 @@ class Relay:
             # add adding byte for input report
             data = b'\xa1' + data
 
-            if self._capture_file is not None:
+            if self._capture is not None:
                 # write data to log file
-                current_time = struct.pack('d', time.time())
-                size = struct.pack('i', len(data))
-                self._capture_file.write(current_time + size + data)
+                self._capture.write(data, Direction.SENT)
 
             await loop.sock_sendall(client_itr, data)
             await asyncio.sleep(0)
@@ -48,11 +58,9 @@ class Relay:
         while True:
             data = await loop.sock_recv(client_itr, 50)
 
-            if self._capture_file is not None:
+            if self._capture is not None:
                 # write data to log file
-                current_time = struct.pack('d', time.time())
-                size = struct.pack('i', len(data))
-                self._capture_file.write(current_time + size + data)
+                self._capture.write(data, Direction.RECEIVED)
 
             # remove padding byte for output report (not required when using the hid driver)
             data = data[1:]
@@ -143,7 +151,8 @@ async def _main(capture_file=None, reconnect_bt_addr=None):
         client_ctl.setblocking(False)
         client_itr.setblocking(False)
 
-    relay = Relay(capture_file)
+    relay = Relay(capture_file, controller=CONTROLLERS[controller['product_id']],
+                  address=client_itr.getsockname()[0])
 
     logger.info('Relaying starting...')
 
@@ -157,6 +166,7 @@ async def _main(capture_file=None, reconnect_bt_addr=None):
         logger.info('Stopping communication...')
         client_itr.close()
         client_ctl.close()
+        relay.close()
 
 
 if __name__ == '__main__':
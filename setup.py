@@ -10,7 +10,11 @@ setup(name='joycontrol',
       package_data={'joycontrol': ['profile/sdp_record_hid.xml']},
       zip_safe=False,
       install_requires=[
-          'hid', 'aioconsole', 'dbus-python', 'crc8'
-      ]
+          'hid', 'aioconsole', 'dbus-python'
+      ],
+      extras_require={
+          'analysis': ['numpy'],
+          'ir_camera': ['numpy', 'Pillow']
+      }
       )
 